@@ -0,0 +1,202 @@
+'''
+Season archive of the published RAWS and PSA attributes, for charts and reviews of a station or PSA over time without
+keeping daily copies of raws_data.csv and psa_data.csv.
+
+Runs are appended to one Parquet file per layer and month of the run date:
+
+    <archive_dir>/raws/run_month=2024-07/part.parquet
+    <archive_dir>/psa/run_month=2024-07/part.parquet
+    <archive_dir>/<layer>/_index.parquet
+
+Rows of a month are sorted by station or PSA id, then run time, and written in row groups of row_group_size rows, so
+all runs of one id sit in one or two row groups. The index lists the row groups of each id with the first and last run
+date they hold. A series query reads only the index and those row groups (skipping months outside the date range), so a
+full season of one station or PSA is read from a handful of row groups instead of scanning every run.
+
+    archive = OutputArchive('C:/.../Archive')
+    archive.append(run_time, {'raws': raws_df, 'psa': psa_df})
+    archive.series('psa', 'NW01', start='2024-06-01', columns=['avg_ec_percentile','avg_ec_trend'])
+
+Or from the command line:
+    python NFDRS_archive.py C:/.../Archive psa NW01 --start 2024-06-01 --columns avg_ec_percentile avg_ec_trend
+'''
+
+# Import libraries and modules
+import argparse, os, sys, threading
+import pandas, pyarrow, pyarrow.compute, pyarrow.parquet
+
+# Id column of each layer
+archive_keys = {'raws': 'NWSID_Clean', 'psa': 'PSANationalCode'}
+
+# Text columns of each layer. Trend codes (ec_trend, avg_bi_fcast_trend, ec_trend_7d, ec_trend_V, ...) and URLs are text
+# in every layer, date times are stored as timestamps and every other column as float64, whatever its type in the run
+archive_text_columns = {'raws': ['StationName','NESSID','NWSID','State','County','Agency','Unit','StationID','MesoWestURL',
+                                 'Display','StnName_Clean','NWSID_Clean','GACC','Dispatch','PSA','FuelModelCode','GlobalID',
+                                 'Creator','Editor','nfdr_dt','nfdr_tm'],
+                        'psa': ['PSANationalCode','PSANAME','PSAName','GACC','GlobalID','Creator','Editor','nfdr_dt']}
+
+# Columns of the index
+_index_schema = pyarrow.schema([('id', pyarrow.string()), ('file', pyarrow.string()), ('row_group', pyarrow.int32()),
+                                ('first_date', pyarrow.date32()), ('last_date', pyarrow.date32())])
+
+
+def _tmp_path(path):
+    '''Temporary file next to the output, so readers never see a partly written file.'''
+    return os.path.join(os.path.dirname(path), '.tmp_' + os.path.basename(path))
+
+
+def _is_text(layer, col):
+    '''True if the column of the layer is archived as text, see archive_text_columns.'''
+    return col == archive_keys[layer] or col in archive_text_columns[layer] or '_trend' in col or col.endswith('_URL')
+
+
+def _archive_table(df, layer, run_time):
+    '''
+    Arrow table of one layer with types that stay the same from run to run, from the layer's fixed schema rather than
+    the dtypes of the run: text columns as strings, date times as UTC timestamps and everything else as float64 (values
+    that are not numbers become null), so the runs of a season can be stored together.
+    '''
+    out = {'run_date': pandas.Series([run_time.date()] * len(df), dtype='object'),
+           'run_time': pandas.Series([run_time] * len(df), dtype='datetime64[ms]')}
+    for col in df.columns:
+        vals = df[col].reset_index(drop=True)
+        if(isinstance(vals.dtype, pandas.CategoricalDtype)):
+            vals = vals.astype('object')
+        if(_is_text(layer, col)):
+            out[col] = vals.astype('object').where(vals.notna(), None).map(lambda v: v if v is None else str(v))
+        elif(pandas.api.types.is_datetime64_any_dtype(vals.dtype)):
+            if(getattr(vals.dt, 'tz', None) is not None):
+                vals = vals.dt.tz_convert('UTC').dt.tz_localize(None)
+            out[col] = vals.astype('datetime64[ms]')
+        else:
+            if(pandas.api.types.is_numeric_dtype(vals.dtype) == False):
+                vals = pandas.to_numeric(vals.astype('object').where(vals.notna(), None), errors='coerce')
+            out[col] = vals.astype('float64')
+    return pyarrow.Table.from_pandas(pandas.DataFrame(out), preserve_index=False)
+
+
+class OutputArchive:
+    '''Month-partitioned Parquet archive of published layers with an id index.'''
+
+    def __init__(self, archive_dir, row_group_size=1024):
+        '''
+        archive_dir: folder of the archive, created on the first append.
+        row_group_size: rows per Parquet row group. Smaller groups read less data per id at the cost of larger footers.
+        '''
+        self.archive_dir = archive_dir
+        self.row_group_size = row_group_size
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _index_path(self, layer):
+        return os.path.join(self.archive_dir, layer, '_index.parquet')
+
+    def index(self, layer):
+        '''Index of the layer (id, file, row_group, first_date, last_date), reloaded if it changed on disk.'''
+        path = self._index_path(layer)
+        if(not os.path.exists(path)):
+            return _index_schema.empty_table()
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            if(layer not in self._indexes or self._indexes[layer][0] != mtime):
+                self._indexes[layer] = (mtime, pyarrow.parquet.read_table(path))
+            return self._indexes[layer][1]
+
+    def append(self, run_time, layers):
+        '''
+        Add the layers of one run (dict of layer name -> data frame without geometry) to the month of the run date. A
+        run with the same run time as one already in the archive (e.g. a resumed run) replaces it. Returns the paths
+        written.
+        '''
+        written = []
+        for layer, df in layers.items():
+            key = archive_keys[layer]
+            rel_path = 'run_month=' + run_time.strftime('%Y-%m') + '/part.parquet'
+            path = os.path.join(self.archive_dir, layer, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # The month so far without this run time, plus this run, in id and run time order
+            month = _archive_table(df, layer, run_time)
+            if(os.path.exists(path)):
+                prev = pyarrow.parquet.read_table(path)
+                prev = prev.filter(pyarrow.compute.not_equal(prev.column('run_time'), pyarrow.scalar(run_time, pyarrow.timestamp('ms'))))
+                month = pyarrow.concat_tables([prev, month], promote_options='default')
+            month = month.sort_by([(key, 'ascending'), ('run_time', 'ascending')])
+            pyarrow.parquet.write_table(month, _tmp_path(path), row_group_size=self.row_group_size, compression='zstd')
+
+            # Row groups holding each id, with the dates they cover
+            meta = pyarrow.parquet.ParquetFile(_tmp_path(path)).metadata
+            row_groups = []
+            for rg in range(meta.num_row_groups):
+                row_groups.extend([rg] * meta.row_group(rg).num_rows)
+            month_index = pyarrow.table({'id': month.column(key).cast(pyarrow.string()), 'row_group': pyarrow.array(row_groups, pyarrow.int32()),
+                                         'run_date': month.column('run_date')})
+            month_index = month_index.group_by(['id','row_group']).aggregate([('run_date', 'min'), ('run_date', 'max')])
+            month_index = pyarrow.table({'id': month_index.column('id'), 'file': pyarrow.array([rel_path] * len(month_index), pyarrow.string()),
+                                         'row_group': month_index.column('row_group'), 'first_date': month_index.column('run_date_min'),
+                                         'last_date': month_index.column('run_date_max')}, schema=_index_schema)
+            os.replace(_tmp_path(path), path)
+
+            # Replace the month's entries and keep the index sorted by id, then file
+            index = self.index(layer)
+            index = index.filter(pyarrow.compute.not_equal(index.column('file'), rel_path))
+            index = pyarrow.concat_tables([index, month_index]).sort_by([('id', 'ascending'), ('file', 'ascending'), ('row_group', 'ascending')])
+            pyarrow.parquet.write_table(index, _tmp_path(self._index_path(layer)), compression='zstd')
+            os.replace(_tmp_path(self._index_path(layer)), self._index_path(layer))
+            written.append(path)
+        return written
+
+    def series(self, layer, id, start=None, end=None, columns=None, daily=False):
+        '''
+        All archived runs of one station (layer 'raws') or PSA (layer 'psa') between start and end (dates, inclusive),
+        as a data frame ordered by run time. columns limits the attributes read. With daily, only the last run of each
+        day is kept.
+        '''
+        key = archive_keys[layer]
+        start = None if start is None else pandas.Timestamp(start).date()
+        end = None if end is None else pandas.Timestamp(end).date()
+
+        # Row groups of the id that overlap the date range
+        index = self.index(layer)
+        keep = pyarrow.compute.equal(index.column('id'), str(id))
+        if(start is not None):
+            keep = pyarrow.compute.and_(keep, pyarrow.compute.greater_equal(index.column('last_date'), start))
+        if(end is not None):
+            keep = pyarrow.compute.and_(keep, pyarrow.compute.less_equal(index.column('first_date'), end))
+        hits = index.filter(keep)
+
+        # Read only those row groups, then the rows of the id and date range within them
+        tables = []
+        for rel_path, row_group in zip(hits.column('file').to_pylist(), hits.column('row_group').to_pylist()):
+            pf = pyarrow.parquet.ParquetFile(os.path.join(self.archive_dir, layer, rel_path))
+            read_cols = None
+            if(columns is not None):
+                read_cols = [c for c in ['run_date','run_time',key] + list(columns) if c in pf.schema_arrow.names]
+            rg_table = pf.read_row_group(row_group, columns=read_cols)
+            rows = pyarrow.compute.equal(rg_table.column(key), str(id))
+            if(start is not None):
+                rows = pyarrow.compute.and_(rows, pyarrow.compute.greater_equal(rg_table.column('run_date'), start))
+            if(end is not None):
+                rows = pyarrow.compute.and_(rows, pyarrow.compute.less_equal(rg_table.column('run_date'), end))
+            tables.append(rg_table.filter(rows))
+        if(len(tables) == 0):
+            return pandas.DataFrame(columns=['run_date','run_time',key] + ([] if columns is None else list(columns)))
+        out = pyarrow.concat_tables(tables, promote_options='default').to_pandas()
+        out = out.sort_values(by='run_time', kind='stable').reset_index(drop=True)
+        if(daily == True):
+            out = out.drop_duplicates(subset=['run_date'], keep='last').reset_index(drop=True)
+        return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the archived series of a station or PSA as CSV.')
+    parser.add_argument('archive_dir')
+    parser.add_argument('layer', choices=sorted(archive_keys))
+    parser.add_argument('id', help='Station NWSID or PSA national code')
+    parser.add_argument('--start', default=None, help='First run date, YYYY-MM-DD')
+    parser.add_argument('--end', default=None, help='Last run date, YYYY-MM-DD')
+    parser.add_argument('--columns', nargs='*', default=None)
+    parser.add_argument('--daily', action='store_true', help='Only the last run of each day')
+    args = parser.parse_args()
+    series = OutputArchive(args.archive_dir).series(args.layer, args.id, args.start, args.end, args.columns, args.daily)
+    series.to_csv(sys.stdout, index=False)
@@ -0,0 +1,140 @@
+'''
+Interpolates RAWS ERC/BI percentiles onto a regular grid and writes the result as a compressed, tiled GeoTIFF.
+Station values are projected to CONUS Albers (EPSG:5070), indexed with a KD-tree and interpolated with either
+nearest-neighbor or inverse distance weighting (IDW). The grid is processed in blocks of rows so memory use stays
+bounded regardless of the grid resolution.
+'''
+
+# Import libraries and modules
+import numpy, rasterio
+from pyproj import Transformer
+from rasterio.features import geometry_mask
+from rasterio.transform import from_origin
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+from scipy.spatial import cKDTree
+
+# Projected coordinate system used for the grid (units of meters)
+grid_crs = 'EPSG:5070'
+
+# No data value for the 0-100 percentile bands
+grid_nodata = 255
+
+
+def project_stations(lon, lat):
+    '''Project station longitude/latitude (WGS84) to grid coordinates.'''
+    transformer = Transformer.from_crs('EPSG:4326', grid_crs, always_xy=True)
+    x, y = transformer.transform(numpy.asarray(lon, dtype='float64'), numpy.asarray(lat, dtype='float64'))
+    return numpy.column_stack([x, y])
+
+
+def grid_extent(stn_xy, cell_size, pad):
+    '''Return (xmin, ymax, ncols, nrows) for a grid covering the stations plus a padding distance.'''
+    xmin = numpy.floor((stn_xy[:,0].min() - pad) / cell_size) * cell_size
+    xmax = numpy.ceil((stn_xy[:,0].max() + pad) / cell_size) * cell_size
+    ymin = numpy.floor((stn_xy[:,1].min() - pad) / cell_size) * cell_size
+    ymax = numpy.ceil((stn_xy[:,1].max() + pad) / cell_size) * cell_size
+    ncols = int(round((xmax - xmin) / cell_size))
+    nrows = int(round((ymax - ymin) / cell_size))
+    return float(xmin), float(ymax), ncols, nrows
+
+
+def query_neighbors(tree, cells_xy, k, max_dist):
+    '''
+    Find the k nearest stations for each cell center. Missing neighbors (beyond max_dist) are returned with an
+    infinite distance and an index equal to the number of stations.
+    '''
+    k = min(k, tree.n)
+    dist, idx = tree.query(cells_xy, k=k, distance_upper_bound=max_dist, workers=-1)
+    if(k == 1):
+        dist = dist[:,None]
+        idx = idx[:,None]
+    return dist, idx
+
+
+def interpolate_cells(dist, idx, stn_values, method, power):
+    '''
+    Interpolate one band of station values from a shared neighbor query. Stations with NaN values for the band are
+    skipped, and cells with no valid neighbor get NaN.
+    '''
+    vals = numpy.append(stn_values, numpy.nan)[idx]
+    valid = numpy.isfinite(dist) & numpy.isfinite(vals)
+    vals = numpy.where(valid, vals, 0.0)
+
+    # Nearest neighbor uses the closest station with a valid value
+    if(method == 'Nearest'):
+        first = valid.argmax(axis=1)
+        rows = numpy.arange(len(first))
+        return numpy.where(valid[rows,first], vals[rows,first], numpy.nan)
+
+    # Inverse distance weights, cells that fall exactly on a station take that station's value
+    with numpy.errstate(divide='ignore'):
+        weights = numpy.where(valid, 1.0 / (dist * dist if power == 2 else numpy.power(dist, power)), 0.0)
+    exact = valid & (dist == 0)
+    has_exact = exact.any(axis=1)
+    if(has_exact.any()):
+        weights[has_exact] = exact[has_exact]
+    wsum = weights.sum(axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        out = (weights * vals).sum(axis=1) / wsum
+    out[wsum == 0] = numpy.nan
+    return out
+
+
+def write_percentile_grid(out_path, lon, lat, bands, cell_size=2000, method='IDW', k=8, power=2,
+                          max_dist=150000, clip_shapes=None, clip_crs=None, chunk_cells=2000000, block_size=256):
+    '''
+    Build a multi-band percentile grid and write it to out_path.
+
+    lon, lat: station coordinates (WGS84).
+    bands: dict of band name -> array of station percentiles (NaN for non-reporting stations).
+    clip_shapes: optional list of GeoJSON-like polygons (e.g. PSAs) in clip_crs, cells outside them are set to no data.
+    Returns a dict with the grid dimensions and the number of stations used in each band.
+    '''
+    stn_xy = project_stations(lon, lat)
+    xmin, ymax, ncols, nrows = grid_extent(stn_xy, cell_size, max_dist)
+    transform = from_origin(xmin, ymax, cell_size, cell_size)
+
+    # Reproject the clipping polygons once
+    if(clip_shapes is not None):
+        clip_shapes = [transform_geom(clip_crs, grid_crs, shp) for shp in clip_shapes]
+
+    # One KD-tree of stations reporting in any band, so each chunk needs a single neighbor query for all bands
+    band_names = list(bands.keys())
+    band_vals = numpy.column_stack([numpy.asarray(bands[name], dtype='float64') for name in band_names])
+    reporting = numpy.isfinite(band_vals).any(axis=1)
+    band_vals = band_vals[reporting]
+    tree = cKDTree(stn_xy[reporting]) if reporting.any() else None
+
+    # Process whole tile rows at a time so writes line up with the GeoTIFF tiles
+    chunk_rows = max(block_size, (chunk_cells // max(ncols, 1)) // block_size * block_size)
+    col_x = xmin + (numpy.arange(ncols) + 0.5) * cell_size
+
+    profile = {'driver': 'GTiff', 'width': ncols, 'height': nrows, 'count': len(band_names), 'dtype': 'uint8',
+               'crs': grid_crs, 'transform': transform, 'nodata': grid_nodata, 'tiled': True,
+               'blockxsize': block_size, 'blockysize': block_size, 'compress': 'deflate', 'predictor': 2,
+               'BIGTIFF': 'IF_SAFER'}
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        for b, name in enumerate(band_names):
+            dst.set_band_description(b + 1, name)
+        for row0 in range(0, nrows, chunk_rows):
+            nr = min(chunk_rows, nrows - row0)
+            row_y = ymax - (row0 + numpy.arange(nr) + 0.5) * cell_size
+            cells_xy = numpy.column_stack([numpy.tile(col_x, nr), numpy.repeat(row_y, ncols)])
+            window = Window(0, row0, ncols, nr)
+            if(clip_shapes is not None):
+                inside = geometry_mask(clip_shapes, out_shape=(nr, ncols), transform=rasterio.windows.transform(window, transform),
+                                       invert=True).ravel()
+            else:
+                inside = numpy.ones(nr * ncols, dtype=bool)
+            if(tree is not None and inside.any()):
+                dist, idx = query_neighbors(tree, cells_xy[inside], k, max_dist)
+            for b in range(len(band_names)):
+                out = numpy.full(nr * ncols, grid_nodata, dtype='uint8')
+                if(tree is not None and inside.any()):
+                    est = interpolate_cells(dist, idx, band_vals[:,b], method, power)
+                    out[inside] = numpy.where(numpy.isnan(est), grid_nodata, numpy.clip(numpy.rint(est), 0, 100))
+                dst.write(out.reshape(nr, ncols), b + 1, window=window)
+
+    return {'ncols': ncols, 'nrows': nrows, 'cell_size': cell_size,
+            'stations': {name: int(numpy.isfinite(band_vals[:,b]).sum()) for b, name in enumerate(band_names)}}
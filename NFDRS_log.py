@@ -0,0 +1,70 @@
+'''
+Structured logging for the NFDRS percentile and trend analysis.
+
+Records are written to the log file as JSON lines (one object per record with the time, level, message and any extra
+fields such as the stage and station), so logs of many runs can be searched and filtered with standard tools:
+
+    {"time": "2024-10-21T16:31:02.114", "level": "INFO", "msg": ".STATION 051234 OK", "stage": "RAWS NFDRS ...", ...}
+
+Logging calls only put the record on a queue. A background thread formats the records and writes them to the file in
+batches, so the cost of logging stays small and flat however many stations are processed. Records at or above
+console_level are also printed, as plain messages.
+'''
+
+# Import libraries and modules
+import datetime, json, logging, logging.handlers, queue, sys
+
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per record, with the extra fields of the record.'''
+
+    def format(self, record):
+        out = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+               'level': record.levelname, 'msg': record.getMessage()}
+        out.update(getattr(record, 'fields', {}))
+        return json.dumps(out, default=str)
+
+
+class RunLog:
+    '''Buffered JSON lines log file of a run, written by a background thread.'''
+
+    def __init__(self, path, level='INFO', console_level='INFO', buffer_records=500, name='NFDRS'):
+        '''
+        path: log file, replaced if it exists.
+        level, console_level: lowest level written to the file and printed ('DEBUG', 'INFO', 'WARNING' or 'ERROR').
+        buffer_records: number of records written to the file at once. ERROR records are written right away.
+        '''
+        self.file_handler = logging.FileHandler(path, mode='w', encoding='utf-8')
+        self.file_handler.setFormatter(JsonFormatter())
+        buffered = logging.handlers.MemoryHandler(buffer_records, flushLevel=logging.ERROR, target=self.file_handler)
+        buffered.setLevel(level)
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter('%(message)s'))
+        console.setLevel(console_level)
+        self.handlers = [buffered, console]
+
+        # The logger only queues records, the listener thread formats and writes them
+        records = queue.SimpleQueue()
+        self.logger = logging.getLogger(name)
+        self.logger.handlers = [logging.handlers.QueueHandler(records)]
+        self.logger.setLevel(min(buffered.level, console.level))
+        self.logger.propagate = False
+        self.listener = logging.handlers.QueueListener(records, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def enabled(self, level):
+        '''True if records of level are written anywhere, so callers can skip building them.'''
+        return self.logger.isEnabledFor(logging.getLevelName(level))
+
+    def log(self, level, msg, **fields):
+        '''Queue a record with the extra fields.'''
+        self.logger.log(logging.getLevelName(level), msg, extra={'fields': fields})
+
+    def close(self):
+        '''Write the remaining records and close the file.'''
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.flush()
+            handler.close()
+        self.file_handler.close()
+        self.logger.handlers = []
@@ -0,0 +1,190 @@
+'''
+Percentile lookup for RAWS ERC and BI values against the historical percentile tables (Percentiles.csv).
+
+The breakpoint tables are loaded once into flat sorted arrays so that any number of (station, component, value)
+queries can be answered with a single binary search. Single queries are cached (LRU, bounded) for callers that ask
+about the same station values repeatedly. Tables for several fuel models can be kept side by side with an optional
+FuelModel column, rows without one belong to default_fuel_model.
+
+Can be used as a library:
+    lookup = PercentileLookup.from_csv('Percentiles.csv')
+    lookup.percentile('051234', 'ERC', 62)
+    lookup.lookup(['051234','051234'], ['ERC','BI'], [62, 40])
+    lookup.lookup(['051234','051234'], ['ERC','ERC'], [62, 62], fuel_models=['Y','V'])
+
+Or run as a small local HTTP service:
+    python NFDRS_percentile_lookup.py Percentiles.csv --port 8765
+    GET  /percentile?station=051234&component=ERC&value=62&fuel_model=Y
+    POST /percentiles  {"station": [...], "component": [...], "value": [...], "fuel_model": [...]}
+'''
+
+# Import libraries and modules
+import argparse, functools, json, numpy, pandas, urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Lookup outcomes
+_NO_TABLE, _BELOW, _IN_RANGE, _ABOVE, _UNDETERMINED = 0, 1, 2, 3, 4
+
+
+class PercentileLookup:
+    '''Vectorized percentile lookup over the historical percentile tables.'''
+
+    def __init__(self, percentiles, cache_size=65536, default_fuel_model='Y'):
+        '''
+        percentiles: data frame with StationID, Component, GreaterThanEqualTo, LessThan and Percentile columns, and an
+                     optional FuelModel column.
+        cache_size: maximum number of single-query results kept in the LRU cache.
+        default_fuel_model: fuel model of table rows without one, and of queries that do not give one.
+        '''
+        self.default_fuel_model = str(default_fuel_model).upper()
+        tbl = percentiles[['StationID','Component','GreaterThanEqualTo','LessThan','Percentile']].copy()
+        tbl['StationID'] = tbl['StationID'].astype(str)
+        tbl['Component'] = tbl['Component'].astype(str).str.upper()
+        if('FuelModel' in percentiles.columns):
+            tbl['FuelModel'] = percentiles['FuelModel'].fillna(self.default_fuel_model).astype(str).str.strip().str.upper()
+        else:
+            tbl['FuelModel'] = self.default_fuel_model
+        tbl = tbl.sort_values(by=['StationID','Component','FuelModel','GreaterThanEqualTo'], kind='stable').reset_index(drop=True)
+
+        # Each station/component/fuel model table is a contiguous block of the flat arrays
+        codes, keys = pandas.factorize(tbl['StationID'] + '|' + tbl['Component'] + '|' + tbl['FuelModel'])
+        self._keys = pandas.Index(keys)
+        self._start = numpy.searchsorted(codes, numpy.arange(len(keys)), side='left')
+        self._end = numpy.searchsorted(codes, numpy.arange(len(keys)), side='right')
+        self._lb = tbl['GreaterThanEqualTo'].to_numpy(dtype='float64')
+        self._ub = tbl['LessThan'].to_numpy(dtype='float64')
+        self._pct = tbl['Percentile'].to_numpy(dtype='float64')
+        self._pct_raw = tbl['Percentile'].tolist()
+
+        # Lower bounds offset by table so one searchsorted covers every table
+        self._base = self._lb.min() if len(self._lb) > 0 else 0.0
+        self._span = (self._lb.max() - self._base + 2.0) if len(self._lb) > 0 else 1.0
+        self._sorted_lb = codes * self._span + (self._lb - self._base)
+
+        self.percentile = functools.lru_cache(maxsize=cache_size)(self._percentile)
+
+    @classmethod
+    def from_csv(cls, path, cache_size=65536, default_fuel_model='Y'):
+        '''Load the percentile tables from a Percentiles.csv file.'''
+        return cls(pandas.read_csv(path, converters={'StationID': str}), cache_size=cache_size, default_fuel_model=default_fuel_model)
+
+    def _classify(self, stations, components, values, fuel_models=None):
+        '''Return the lookup outcome and the table row for each query.'''
+        # Positional arrays, so query series with any index line up
+        stations = pandas.Series(numpy.asarray(stations, dtype='object')).astype(str)
+        components = pandas.Series(numpy.asarray(components, dtype='object')).astype(str).str.upper()
+        values = numpy.asarray(values, dtype='float64')
+        if(fuel_models is None or isinstance(fuel_models, str)):
+            fuel_models = [self.default_fuel_model if fuel_models is None else fuel_models] * len(stations)
+        fuel_models = pandas.Series(numpy.asarray(fuel_models, dtype='object')).fillna(self.default_fuel_model).astype(str).str.upper()
+        k = self._keys.get_indexer(stations.str.cat([components, fuel_models], sep='|'))
+
+        state = numpy.full(len(values), _UNDETERMINED, dtype='int8')
+        row = numpy.full(len(values), -1, dtype='int64')
+        state[k < 0] = _NO_TABLE
+        ok = (k >= 0) & ~numpy.isnan(values)
+        if(not ok.any()):
+            return state, row
+
+        kk = k[ok]
+        vv = values[ok]
+        q = kk * self._span + numpy.clip(vv - self._base, 0.0, self._span - 1.0)
+        idx = numpy.searchsorted(self._sorted_lb, q, side='right') - 1
+        idx_safe = numpy.clip(idx, 0, max(len(self._lb) - 1, 0))
+        below = vv < self._lb[self._start[kk]]
+        in_range = ~below & (self._lb[idx_safe] <= vv) & (vv < self._ub[idx_safe])
+        above = ~below & ~in_range & (idx == self._end[kk] - 1) & (vv > self._ub[idx_safe])
+
+        sub = numpy.full(len(vv), _UNDETERMINED, dtype='int8')
+        sub[below] = _BELOW
+        sub[in_range] = _IN_RANGE
+        sub[above] = _ABOVE
+        state[ok] = sub
+        row[ok] = idx_safe
+        return state, row
+
+    def lookup(self, stations, components, values, fuel_models=None):
+        '''
+        Percentiles for many (station, component, value) queries at once. Values below a station's table get 0, values
+        above it get 100, and queries without a table or percentile (including NaN values) get NaN.
+        fuel_models: fuel model of each query (or one for all), default_fuel_model if None.
+        '''
+        state, row = self._classify(stations, components, values, fuel_models)
+        out = numpy.full(len(state), numpy.nan)
+        out[state == _BELOW] = 0
+        out[state == _ABOVE] = 100
+        hit = state == _IN_RANGE
+        out[hit] = self._pct[row[hit]]
+        return out
+
+    def _percentile(self, station, component, value, fuel_model=None):
+        '''Percentile for a single query, or None if it cannot be determined.'''
+        state, row = self._classify([station], [component], [value], None if fuel_model is None else [fuel_model])
+        if(state[0] == _IN_RANGE):
+            pct = self._pct_raw[row[0]]
+            return pct.item() if hasattr(pct, 'item') else pct
+        if(state[0] == _BELOW):
+            return 0
+        if(state[0] == _ABOVE):
+            return 100
+        return None
+
+
+def serve(lookup, host='127.0.0.1', port=8765):
+    '''Answer percentile queries over HTTP from a loaded lookup until interrupted.'''
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if(url.path != '/percentile'):
+                self._reply(404, {'error': 'unknown path'})
+                return
+            q = urllib.parse.parse_qs(url.query)
+            try:
+                pct = lookup.percentile(q['station'][0], q['component'][0], float(q['value'][0]), q.get('fuel_model', [None])[0])
+            except (KeyError, ValueError) as e:
+                self._reply(400, {'error': 'expected station, component and numeric value: ' + str(e)})
+                return
+            self._reply(200, {'percentile': pct})
+
+        def do_POST(self):
+            if(urllib.parse.urlparse(self.path).path != '/percentiles'):
+                self._reply(404, {'error': 'unknown path'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                pct = lookup.lookup(body['station'], body['component'], body['value'], body.get('fuel_model'))
+            except (KeyError, ValueError, TypeError) as e:
+                self._reply(400, {'error': 'expected station, component and value lists: ' + str(e)})
+                return
+            self._reply(200, {'percentile': [None if numpy.isnan(p) else p for p in pct.tolist()]})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve ERC/BI percentile lookups from a Percentiles.csv table.')
+    parser.add_argument('percentiles_csv')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-size', type=int, default=65536)
+    parser.add_argument('--fuel-model', default='Y', help='Fuel model of table rows and queries without one')
+    args = parser.parse_args()
+    serve(PercentileLookup.from_csv(args.percentiles_csv, cache_size=args.cache_size, default_fuel_model=args.fuel_model),
+          args.host, args.port)
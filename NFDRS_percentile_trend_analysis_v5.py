@@ -8,12 +8,13 @@ WIMS with emphasis on ERC and BI percentiles and trends.
 '''
 
 # Import libraries and modules
-import arcgis, os, sys, datetime, pandas, requests, statistics, urllib
+import arcgis, argparse, concurrent.futures, contextlib, hashlib, os, pickle, sys, datetime, numpy, pandas, requests, statistics, urllib
 import xml.etree.ElementTree as ET
 from time import sleep
 from arcgis.gis import GIS
 from arcgis.features import FeatureLayerCollection
 from arcgis.geometry import filters
+import NFDRS_percentile_lookup, NFDRS_rate
 pandas.set_option('chained_assignment',None)
 pandas.set_option('display.max_columns', None)
 pandas.set_option('display.max_rows', None)
@@ -37,1089 +38,2101 @@ agol_password = 'XXXXXXXX'
 toggle_run_date = 'Current Date'
 #toggle_run_date = '2024-07-22 14:00:00'
 
-# Get datetime object for run day based on user inputs
-if(toggle_run_date == 'Current Date'):
-    datetime_today = datetime.datetime.today() #today
-else:
-    datetime_today = datetime.datetime.strptime(toggle_run_date, '%Y-%m-%d %H:%M:%S')
-
-# Start log file and define function to print to both
-lf = open(wdir + '/NFDRS_log_' + datetime_today.strftime('%m%d%Y') + '.txt', 'w')
-def print_both(ptext):
-    print(ptext)
-    lf.write(ptext)
-
-# Read in allstation and percentile tables
-allstations = pandas.read_csv('C:/Users/BenjaminGannon/Desktop/NFDRS_services/Percentile_tables/AllStation.csv',
-                              converters={'StationID': str})
-percentiles = pandas.read_csv('C:/Users/BenjaminGannon/Desktop/NFDRS_services/Percentile_tables/Percentiles.csv',
-                              converters={'StationID': str})
+# Toggle for gridded percentile surfaces interpolated from the RAWS percentiles (written to wdir as a tiled GeoTIFF)
+toggle_grid_output = False
+grid_cell_size = 2000 # Grid resolution in meters
+grid_method = 'IDW' # Specify either 'IDW' or 'Nearest'
+grid_neighbors = 8 # Number of nearest stations used for IDW
+grid_max_dist = 150000 # Cells farther than this distance (meters) from a reporting station are left as no data
+grid_clip_to_psa = True # Set cells outside of the analysis PSAs to no data
+
+# Toggle for the spread of the next 1-day forecast percentiles across all WIMS model priority (mp) records, reported
+# for stations and PSAs as min/median/max percentile and the fraction of records at or above each threshold percentile.
+# Written to fcast_spread_raws.csv and fcast_spread_psa.csv, and to any matching fields in the service layers (e.g.
+# avg_ec_fcast_per_med or avg_bi_fcast_frac_p90), which are published with the other dynamic fields.
+toggle_fcast_spread = False
+fcast_spread_thresholds = [90, 97]
+
+# Toggle for additional observed trend windows. Each window compares today's ERC/BI with the value that many days
+# earlier, with its own change threshold (window days: threshold). The NFDRS download is extended back to the longest
+# window, and the daily values are also kept in trend_history_path so gaps in WIMS history can be filled from earlier
+# runs. Written to trend_windows_raws.csv and trend_windows_psa.csv, and to any matching fields in the service layers (e.g.
+# avg_ec_trend_7d or avg_bi_diff_14d), which are published with the other dynamic fields.
+toggle_trend_windows = False
+trend_windows = {1: 3, 3: 3, 7: 5, 14: 8}
+trend_history_path = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/trend_history.pkl'
+trend_history_days = 30 # Days of daily values kept in trend_history_path
+
+# Fuel models computed for every station alongside the service's fuel model (FuelModelCode of each RAWS), e.g.
+# ['V','W','X','Y'] for grass, grass-shrub, shrub and timber views from the same run. Their NFDRS observations and
+# forecasts are requested with one WIMS request per station and fuel model. Set wims_combined_fuel_models to True to
+# request them with the service's fuel model in one request per station instead (fmodel with a comma separated list,
+# split on the model code msgc); check that WIMS returns every requested fuel model before relying on it.
+# Percentiles use the Percentiles.csv rows with a matching FuelModel column, rows without one are percentiles_fuel_model.
+# Written to fuel_models_raws.csv and fuel_models_psa.csv, and to any matching fields in the service layers (the field
+# name with the fuel model appended, e.g. ec_percentile_V or avg_bi_trend_W), which are published with the other
+# dynamic fields.
+fuel_models = []
+wims_combined_fuel_models = False
+percentiles_fuel_model = 'Y'
+
+# Toggle for quality control of WIMS values (range limits, day-over-day jumps and stuck values) before percentiles
+toggle_qc = True
+qc_action = 'Flag' # Specify either 'Flag' to only report suspicious values in qc_flags.csv or 'Drop' to remove them
+qc_history_days = 7 # Days of NFDRS observations downloaded for the jump and stuck value checks
+qc_stuck_days = 5 # Number of consecutive days with the same value to be considered stuck
+
+# Toggle for sharded execution. 'None' runs all stations in one process. 'Shard' downloads and computes only the
+# stations in shard_id and saves the partial results to shard_dir. 'Merge' combines the saved shards, aggregates PSAs
+# and updates the service once. The mode and shard id can also be given on the command line (--shard-mode, --shard-id).
+toggle_shard_mode = 'None'
+shard_by = 'GACC' # Specify either 'GACC' (shard_id is a GACC name) or 'Hash' (shard_id is a number from 0 to shard_count - 1)
+shard_count = 4 # Number of shards when sharding by hash
+shard_id = None
+shard_dir = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/Shards' # Shared by all shards and the merge step
+
+# The log of each run (NFDRS_log_<date>.jsonl in wdir) has one JSON record per line, written in batches by a background
+# thread. Per-station details (downloads, each trend step) are DEBUG records and each station gets one INFO summary
+# record, so the default levels keep the log size flat per station. Levels are 'DEBUG', 'INFO', 'WARNING' or 'ERROR'.
+log_level = 'INFO' # Lowest level written to the log file
+log_console_level = 'INFO' # Lowest level printed to the console
+log_buffer_records = 500 # Records written to the log file at once, errors are written right away
+
+# Toggle for profiling each stage of the run (also --profile on the command line). Writes a pstats file
+# ('Deterministic', cProfile) or a collapsed stack file for flame graphs ('Sampling') per stage, plus a summary of the
+# time and peak traced memory of each stage and the largest allocation sites, next to the log file. Requires no extra
+# packages, but slows the run down, most of all the allocation heavy stages.
+toggle_profile = False
+profile_mode = 'Deterministic' # Specify either 'Deterministic' or 'Sampling'
+
+# Local outputs written alongside the service update, any of 'GeoParquet', 'GeoJSON', 'FlatGeobuf' or 'GeoPackage'
+output_sinks = []
+output_dir = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/Outputs'
+
+# Toggle for the season archive of the published RAWS and PSA attributes (NFDRS_archive.py). Each run is appended to
+# archive_dir as Parquet files partitioned by run date, with an index of the runs and row groups of each station and PSA,
+# so a station's or PSA's season can be queried without reading the daily files. Requires pyarrow.
+toggle_archive = False
+archive_dir = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/Archive'
+
+# Toggle for static files of the final values for dashboards (NFDRS_static.py), written to static_dir for any static
+# host or cache: a simplified GeoJSON feature per PSA, a GeoJSON collection of all PSAs and a per-station JSON index,
+# with a hash of the content in each file name, and manifest.json listing the current files. Only PSAs re-aggregated by
+# the run (see toggle_incremental_psa) are rendered again. Requires shapely and pyproj.
+toggle_static_export = False
+static_dir = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/Static'
+static_simplify_tolerance = 500 # Geometry simplification tolerance in the PSA layer's units (meters for Web Mercator)
+
+# Toggle for publishing to the feature service, set to False to only write the local outputs
+toggle_publish = True
+
+# Toggle for checkpoints of the downloaded WIMS data and station results, appended to a file per run day as each
+# station completes. With toggle_resume (or --resume), stations already checkpointed for the run day are not downloaded
+# or processed again. The file is kept open for the run and each record is flushed as it is written, so it survives the
+# script stopping, but the file is only synced to disk every checkpoint_sync_records records and at the end of the
+# download and station stages. WIMS downloads are checkpointed with only the fields a resumed run uses.
+toggle_checkpoint = True
+toggle_resume = False
+checkpoint_dir = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/Checkpoints'
+checkpoint_keep_days = 7 # Checkpoint files older than this are deleted
+checkpoint_sync_records = 100 # Checkpoint records written between syncs to disk
+
+# Toggle for incremental PSA updates. Station results are compared with the last published run of the same day (kept in
+# psa_state_path), and only PSAs with changed member stations are re-aggregated and sent to the service.
+toggle_incremental_psa = True
+psa_state_path = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/psa_state.pkl'
+
+# Input tables of key RAWS for each PSA and the historical ERC and BI percentiles
+allstations_csv = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/Percentile_tables/AllStation.csv'
+percentiles_csv = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/Percentile_tables/Percentiles.csv'
 
 # Static attributes in RAWS layer to skip in updates
 RAWS_static_attrs = ['OBJECTID','StationName','NESSID','NWSID','Elevation','Latitude','Longitude','State','County',
                      'Agency','Unit','StationID','MesoWestURL','Display','StnName_Clean','NWSID_Clean','GACC',
                      'Dispatch','PSA','FuelModelCode','GlobalID','CreationDate','Creator','EditDate','SHAPE']
 
+# Static attributes in PSA layer to skip in updates. Every other field is dynamic, including those filled by the optional
+# forecast spread, trend window and fuel model stages.
+PSA_static_attrs = ['OBJECTID','PSANationalCode','PSANAME','PSAName','GACC','GlobalID','CreationDate','Creator','EditDate',
+                    'Editor','Shape__Area','Shape__Length','SHAPE']
+
+# Compact working types. Ids and trend codes are held as categoricals and computed percentiles as float32 with a nullable
+# mask, and are converted to the service's types only when publishing.
+trend_categories = ['Increase','Decrease','No Change']
+RAWS_percentile_fields = ['ec_percentile','ec_fcast_percentile','bi_percentile','bi_fcast_percentile']
+RAWS_trend_fields = ['ec_trend','ec_fcast_trend','bi_trend','bi_fcast_trend']
+PSA_percentile_fields = ['avg_ec_percentile','avg_ec_fcast_percentile','avg_bi_percentile','avg_bi_fcast_percentile']
+PSA_trend_fields = ['avg_ec_trend','avg_ec_fcast_trend','avg_bi_trend','avg_bi_fcast_trend']
+
+# Toggle for attribute-only layer queries. Geometries and static attributes are kept in a local snapshot, refreshed with a
+# full query when it is missing, older than static_snapshot_days or does not cover the features in the analysis.
+toggle_static_snapshot = True
+static_snapshot_path = 'C:/Users/BenjaminGannon/Desktop/NFDRS_services/static_snapshot.pkl'
+static_snapshot_days = 30
+
 # Create url variables of basic NFDRS and Observation urls to RAWS xml data
 raws_nfdrs_url = 'https://famprod.nwcg.gov/prod-wims/xsql/nfdrs.xsql?stn=&sig=&type=N&fmodel=&start=&end=&time=&sort=&ndays=&user='
 raws_nfdrs_fcast_url = 'https://famprod.nwcg.gov/prod-wims/xsql/nfdrs.xsql?stn=&sig=&type=F&fmodel=&start=&end=&time=&sort=&ndays=&user='
 raws_obs_url = 'https://famprod.nwcg.gov/prod-wims/xsql/obs.xsql?stn=&sig=&type=&fmodel=&start=&end=&time=&sort=&ndays=&user='
 
-# Create date variables to grab data for observation and forecast ranges
-datetime_obs_start = datetime_today - datetime.timedelta(days=2)
-datetime_tomorrow = datetime_today + datetime.timedelta(days=1)
-datetime_for_end = datetime_today + datetime.timedelta(days=3)
+
+#########################################################################################################################
+### RUN SETUP
+#########################################################################################################################
+
+def set_run_date(run_date):
+    '''Set the run day and the observation/forecast date windows from 'Current Date' or a date time string.'''
+    global datetime_today, datetime_obs_start, datetime_tomorrow, datetime_for_end, datetime_nfdrs_start
+
+    # Get datetime object for run day based on user inputs
+    if(run_date == 'Current Date'):
+        datetime_today = datetime.datetime.today() #today
+    else:
+        datetime_today = datetime.datetime.strptime(run_date, '%Y-%m-%d %H:%M:%S')
+
+    # Create date variables to grab data for observation and forecast ranges
+    datetime_obs_start = datetime_today - datetime.timedelta(days=2)
+    datetime_tomorrow = datetime_today + datetime.timedelta(days=1)
+    datetime_for_end = datetime_today + datetime.timedelta(days=3)
+
+    # Start date for the NFDRS observation download, extended back for the QC history if needed
+    datetime_nfdrs_start = datetime_obs_start
+    if(toggle_qc == True):
+        datetime_nfdrs_start = min(datetime_obs_start, datetime_today - datetime.timedelta(days=qc_history_days))
+    if(toggle_trend_windows == True):
+        datetime_nfdrs_start = min(datetime_nfdrs_start, datetime_today - datetime.timedelta(days=max(trend_windows)))
+
+
+# Log of the run, opened by open_log(), and the stage and station the logged messages belong to
+run_log = None
+log_context = {'stage': None, 'station': None}
+
+# Stage profiler for the run, started with the log file if toggle_profile is on
+profiler = None
+
+def open_log(log_suffix=''):
+    '''Start the log file for the run day, and the stage profiler writing next to it.'''
+    global run_log, profiler
+    import NFDRS_log
+    log_path = wdir + '/NFDRS_log_' + datetime_today.strftime('%m%d%Y') + log_suffix + '.jsonl'
+    run_log = NFDRS_log.RunLog(log_path, level=log_level, console_level=log_console_level, buffer_records=log_buffer_records)
+    log_context.update({'stage': None, 'station': None})
+    if(toggle_profile == True):
+        import NFDRS_profile
+        profiler = NFDRS_profile.StageProfiler(profile_mode, log_path[:-len('.jsonl')] + '_profile')
+
+def close_log():
+    '''Close the log file for the run day, writing the profile summary if the run was profiled.'''
+    global run_log, profiler
+    if(profiler is not None):
+        for stage_row in profiler.finish():
+            print_both('.PROFILE ' + stage_row['stage'] + ': ' + str(stage_row['seconds']) + ' S' +
+                       (', PEAK ' + str(stage_row['peak_mb']) + ' MB' if 'peak_mb' in stage_row else '') + '\r', **stage_row)
+        profiler = None
+    run_log.close()
+    run_log = None
+
+def profile_stage(name):
+    '''Context manager around a stage of the run, profiled if the stage profiler is running.'''
+    if(profiler is None):
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+def print_both(ptext, *args, level=None, **fields):
+    '''
+    Log a message of the run, to the console and the log file. Unless level is given, the leading dots of the message
+    give its level: titles and one dot are INFO, two or more dots are DEBUG. Titles start a new stage. As with logging,
+    args are merged into the message with % only once it is known to be written, so per-station DEBUG messages cost
+    nothing when DEBUG is off. Keyword arguments are added to the JSON record. Printed only if no log is open.
+    '''
+    msg = ptext.rstrip('\r\n')
+    if(msg.strip() == ''):
+        return
+    depth = len(msg) - len(msg.lstrip('.'))
+    if(level is None):
+        level = 'INFO' if depth <= 1 else 'DEBUG'
+    if(depth == 0 and level == 'INFO'):
+        log_context['stage'] = msg % args if len(args) > 0 else msg
+    if(run_log is not None and run_log.enabled(level) == False):
+        return
+    if(len(args) > 0):
+        msg = msg % args
+    if(run_log is None):
+        print(msg)
+    else:
+        run_log.log(level, msg, **{**{k: v for k, v in log_context.items() if v is not None}, **fields})
+
+def log_enabled(level):
+    '''True if messages of the level are written (always when no log is open).'''
+    return run_log is None or run_log.enabled(level)
+
+def load_tables():
+    '''Read in the allstation and percentile tables and load the percentile lookup.'''
+
+    # Read in allstation and percentile tables
+    allstations = pandas.read_csv(allstations_csv, converters={'StationID': str})
+    allstations = allstations.astype({c: 'category' for c in ['StationID','PSA','GACC'] if c in allstations.columns})
+    percentiles = pandas.read_csv(percentiles_csv, converters={'StationID': str})
+
+    # Load the percentile tables into a lookup that answers all station percentile queries
+    percentile_lookup = NFDRS_percentile_lookup.PercentileLookup(percentiles, default_fuel_model=percentiles_fuel_model)
+
+    return allstations, percentiles, percentile_lookup
+
+
+#########################################################################################################################
+### CHECKPOINTS
+#########################################################################################################################
+
+def checkpoint_path():
+    '''Checkpoint file of the run day (one per shard when sharding).'''
+    shard_suffix = '_shard_' + str(shard_id) if toggle_shard_mode == 'Shard' else ''
+    return checkpoint_dir + '/checkpoint_' + datetime_today.strftime('%Y%m%d') + shard_suffix + '.pkl'
+
+# Checkpoint file open for the run, and the records written to it since the last sync to disk
+checkpoint_file = {'path': None, 'handle': None, 'unsynced': 0}
+
+# WIMS fields kept in the checkpoints besides the fields of the RAWS layer: record keys and the values used for the
+# percentiles, trends, forecast spread, trend windows and fuel models
+checkpoint_wims_fields = ['nfdr_dt','nfdr_tm','obs_dt','obs_tm','mp','fuel_model','ec','bi']
+
+def checkpoint_wims(station_data, keep_fields):
+    '''WIMS download of a station with its data frames cut down to the keep_fields they have, for the checkpoint.'''
+    return {k: v if k == 'urls' else v[[c for c in v.columns if c in keep_fields]] for k, v in station_data.items()}
+
+def write_checkpoint(kind, station, data):
+    '''
+    Append one record to the checkpoint file of the run day, through a handle kept open for the run. Records are never
+    rewritten, only appended and flushed. The file is synced to disk every checkpoint_sync_records records, see
+    sync_checkpoint() and close_checkpoint() for the rest.
+    '''
+    if(toggle_checkpoint == False):
+        return
+    try:
+        if(checkpoint_file['path'] != checkpoint_path()):
+            close_checkpoint()
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            checkpoint_file['handle'] = open(checkpoint_path(), 'ab')
+            checkpoint_file['path'] = checkpoint_path()
+        cf = checkpoint_file['handle']
+        pickle.dump({'kind': kind, 'station': station, 'run_date': datetime_today.strftime('%Y%m%d'), 'data': data}, cf)
+        cf.flush()
+        checkpoint_file['unsynced'] = checkpoint_file['unsynced'] + 1
+        if(checkpoint_file['unsynced'] >= checkpoint_sync_records):
+            os.fsync(cf.fileno())
+            checkpoint_file['unsynced'] = 0
+    except Exception as e:
+        print_both('...UNABLE TO WRITE CHECKPOINT: %s\r', e)
+
+def sync_checkpoint():
+    '''Sync the checkpoint records written since the last sync to disk, at the end of a stage.'''
+    if(checkpoint_file['handle'] is None or checkpoint_file['unsynced'] == 0):
+        return
+    try:
+        os.fsync(checkpoint_file['handle'].fileno())
+        checkpoint_file['unsynced'] = 0
+    except Exception as e:
+        print_both('...UNABLE TO SYNC CHECKPOINT: %s\r', e)
+
+def close_checkpoint():
+    '''Sync and close the checkpoint file once the run has written its last record.'''
+    if(checkpoint_file['handle'] is None):
+        return
+    sync_checkpoint()
+    try:
+        checkpoint_file['handle'].close()
+    except Exception as e:
+        print_both('...UNABLE TO CLOSE CHECKPOINT: %s\r', e)
+    checkpoint_file.update({'path': None, 'handle': None, 'unsynced': 0})
+
+def read_checkpoints():
+    '''
+    Read the checkpoints of the run day. Returns dicts of station -> latest WIMS download and station -> latest result.
+    A record cut off by a crash ends the read, everything before it is kept.
+    '''
+    wims_checkpoints = {}
+    result_checkpoints = {}
+    if(not os.path.exists(checkpoint_path())):
+        return wims_checkpoints, result_checkpoints
+    with open(checkpoint_path(), 'rb') as cf:
+        while(True):
+            try:
+                record = pickle.load(cf)
+            except EOFError:
+                break
+            except Exception:
+                print_both('.INCOMPLETE CHECKPOINT RECORD, IGNORING THE REST OF THE FILE\r')
+                break
+            if(record['run_date'] != datetime_today.strftime('%Y%m%d')):
+                continue
+            if(record['kind'] == 'wims'):
+                wims_checkpoints[record['station']] = record['data']
+            if(record['kind'] == 'result'):
+                result_checkpoints[record['station']] = record['data']
+    return wims_checkpoints, result_checkpoints
+
+def clean_checkpoints():
+    '''Delete checkpoint files older than checkpoint_keep_days.'''
+    if(not os.path.isdir(checkpoint_dir)):
+        return
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=checkpoint_keep_days)
+    for cf_name in os.listdir(checkpoint_dir):
+        cf_path = checkpoint_dir + '/' + cf_name
+        if(cf_name.startswith('checkpoint_') and datetime.datetime.fromtimestamp(os.path.getmtime(cf_path)) < cutoff):
+            os.remove(cf_path)
+
+def resume_stations(raws_update_sdf, raws2psa_df):
+    '''
+    Restore the checkpointed stations of the run day. Station results are copied into raws_update_sdf and raws2psa_df
+    in place. Returns the WIMS data of all downloaded stations (finished ones too, for the stages after the station
+    results), the set of finished stations, and the fuel_models data of all checkpointed stations.
+    '''
+    print_both('\r')
+    print_both('RESUMING FROM CHECKPOINTS\r')
+    wims_checkpoints, result_checkpoints = read_checkpoints()
+    for curr_NWSID, result in result_checkpoints.items():
+        raws_rows = (raws_update_sdf['NWSID_Clean'] == curr_NWSID)
+        for curr_column, curr_value in result['raws'].items():
+            if(curr_column in raws_update_sdf.columns):
+                raws_update_sdf.loc[raws_rows, curr_column] = curr_value
+        r2p_rows = (raws2psa_df['StationID'] == curr_NWSID)
+        for curr_column, curr_value in result['raws2psa'].items():
+            raws2psa_df.loc[r2p_rows, curr_column] = curr_value
+    done_stations = set(result_checkpoints.keys())
+    fuel_model_checkpoints = {k: {s: v[s] for s in ['fm_nfdrs','fm_fcast'] if s in v} for k, v in wims_checkpoints.items()}
+    wims_checkpoints = {k: v for k, v in wims_checkpoints.items() if all(s in v for s in ['urls','nfdrs','fcast','obs'])}
+    print_both('.' + str(len(done_stations)) + ' STATIONS FINISHED, ' + str(len(set(wims_checkpoints) - done_stations)) + ' MORE DOWNLOADED\r')
+    return wims_checkpoints, done_stations, fuel_model_checkpoints
 
 
 #########################################################################################################################
 ### DATA SETUP
 #########################################################################################################################
-print_both('\r')
-print_both('DATA SETUP\r')
-
-# Create RAWS data frame for PSA level calcs
-print_both('.CREATE RAWS 2 PSA TRANSFER TABLE\r')
-raws2psa_df = allstations[['StationID','StationName']].drop_duplicates()
-raws2psa_df = raws2psa_df.reset_index(drop=True)
-raws2psa_df['ERC_per'] = pandas.NA
-raws2psa_df['ERC_initial'] = pandas.NA
-raws2psa_df['ERC_final'] = pandas.NA
-raws2psa_df['ERC_fcast_per'] = pandas.NA
-raws2psa_df['ERC_fcast_initial'] = pandas.NA
-raws2psa_df['ERC_fcast_final'] = pandas.NA
-raws2psa_df['BI_per'] = pandas.NA
-raws2psa_df['BI_initial'] = pandas.NA
-raws2psa_df['BI_final'] = pandas.NA
-raws2psa_df['BI_fcast_per'] = pandas.NA
-raws2psa_df['BI_fcast_initial'] = pandas.NA
-raws2psa_df['BI_fcast_final'] = pandas.NA
-
-# Establish connection to the ArcGIS Online Org
-print_both('.REQUESTING API ACCESS TOKEN\r')
-gis = GIS(agol_portalurl, agol_username, agol_password)
-
-# Get RAWS/PSA Feature Service
-print_both('.CONNECTING TO RAWS/PSA FEATURE SERVICE\r')
-erc_service = gis.content.get(erc_itemid)
-erc_layers = erc_service.layers
-
-# Get RAWS layer
-raws_layer = erc_layers[0]
-raws_layer_url = raws_layer.url
-
-# Get PSA layer
-psa_layer = erc_layers[1]
-psa_layer_url = psa_layer.url
-
-# Query PSA feature service to subset to PSAs in the analysis
-print_both('.SUBSET TO TARGET PSA DATA\r')
-wherefield = 'PSANationalCode'
-wherevalues = str(tuple(allstations['PSA'].tolist()))
-whereClause = '"' + wherefield + '"' + ' IN ' + wherevalues
-psa_query = psa_layer.query(where=whereClause)
-psa_orig_sdf = psa_query.sdf
-psa_update_sdf = psa_orig_sdf.sort_values(by=['PSANationalCode']) # Sort the dataframe by PSA Code
-
-# Query RAWS feature service to subset to stations in the analysis
-print_both('.SUBSET TO TARGET RAWS DATA\r')
-wherefield = 'NWSID_clean'
-wherevalues = str(tuple(list(str(n).zfill(6) for n in allstations['StationID'].tolist())))
-whereClause = '"' + wherefield + '"' + ' IN ' + wherevalues
-raws_query = raws_layer.query(where=whereClause)
-raws_update_sdf = raws_query.sdf
+
+def create_raws2psa_table(allstations):
+    '''Create the RAWS data frame for PSA level calcs.'''
+    print_both('\r')
+    print_both('DATA SETUP\r')
+
+    # Create RAWS data frame for PSA level calcs
+    print_both('.CREATE RAWS 2 PSA TRANSFER TABLE\r')
+    raws2psa_df = allstations[['StationID','StationName']].drop_duplicates()
+    raws2psa_df = raws2psa_df.reset_index(drop=True)
+    raws2psa_df['StationID'] = raws2psa_df['StationID'].astype('category')
+    raws2psa_df['ERC_per'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['ERC_initial'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['ERC_final'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['ERC_fcast_per'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['ERC_fcast_initial'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['ERC_fcast_final'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['BI_per'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['BI_initial'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['BI_final'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['BI_fcast_per'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['BI_fcast_initial'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+    raws2psa_df['BI_fcast_final'] = pandas.array([pandas.NA] * len(raws2psa_df), dtype='Float32')
+
+    return raws2psa_df
+
+def connect_service():
+    '''Connect to ArcGIS Online and get the RAWS and PSA layers of the feature service.'''
+
+    # Establish connection to the ArcGIS Online Org
+    print_both('.REQUESTING API ACCESS TOKEN\r')
+    gis = GIS(agol_portalurl, agol_username, agol_password)
+
+    # Get RAWS/PSA Feature Service
+    print_both('.CONNECTING TO RAWS/PSA FEATURE SERVICE\r')
+    erc_service = gis.content.get(erc_itemid)
+    erc_layers = erc_service.layers
+
+    # Get RAWS layer
+    raws_layer = erc_layers[0]
+    raws_layer_url = raws_layer.url
+
+    # Get PSA layer
+    psa_layer = erc_layers[1]
+    psa_layer_url = psa_layer.url
+
+    return gis, raws_layer, psa_layer
+
+def load_static_snapshot(psa_where, raws_where, psa_layer, raws_layer):
+    '''
+    Attribute-only query of the layers joined to the local snapshot of geometries and static attributes. Returns None
+    for both data frames if the snapshot is missing, out of date or does not cover the queried features.
+    '''
+    if(not os.path.exists(static_snapshot_path)):
+        print_both('..NO STATIC SNAPSHOT\r')
+        return None, None
+    snapshot = pandas.read_pickle(static_snapshot_path)
+    if(datetime.datetime.now() - snapshot['created'] > datetime.timedelta(days=static_snapshot_days)):
+        print_both('..STATIC SNAPSHOT OLDER THAN %s DAYS\r', static_snapshot_days)
+        return None, None
+
+    # OBJECTID and dynamic fields only, without geometries
+    update_sdfs = []
+    for name, layer, where, static_df, columns in [('PSA', psa_layer, psa_where, snapshot['psa'], snapshot['psa_columns']),
+                                                   ('RAWS', raws_layer, raws_where, snapshot['raws'], snapshot['raws_columns'])]:
+        dynamic_fields = [c for c in columns if c not in static_df.columns]
+        attr_df = layer.query(where=where, out_fields=','.join(['OBJECTID'] + dynamic_fields), return_geometry=False).sdf
+        if(not attr_df['OBJECTID'].isin(static_df['OBJECTID']).all()):
+            print_both('..STATIC SNAPSHOT MISSING %s FEATURES\r', name)
+            return None, None
+        update_sdfs.append(attr_df[['OBJECTID'] + dynamic_fields].merge(static_df, on='OBJECTID', how='left')[columns])
+    print_both('..USING STATIC SNAPSHOT FROM %s\r', snapshot['created'].strftime('%m/%d/%Y'))
+    return update_sdfs[0], update_sdfs[1]
+
+def save_static_snapshot(psa_update_sdf, raws_update_sdf):
+    '''Save the geometries and static attributes of the full layer queries.'''
+    snapshot = {'created': datetime.datetime.now(),
+                'psa': psa_update_sdf[[c for c in psa_update_sdf.columns if c in PSA_static_attrs]],
+                'psa_columns': list(psa_update_sdf.columns),
+                'raws': raws_update_sdf[[c for c in raws_update_sdf.columns if c in RAWS_static_attrs]],
+                'raws_columns': list(raws_update_sdf.columns)}
+    pandas.to_pickle(snapshot, static_snapshot_path + '.tmp')
+    os.replace(static_snapshot_path + '.tmp', static_snapshot_path)
+    print_both('..STATIC SNAPSHOT SAVED\r')
+
+def compact_types(raws_update_sdf, psa_update_sdf):
+    '''Hold the ids, trend codes and percentiles of the update tables in compact typed columns while processing.'''
+    trend_dtype = pandas.CategoricalDtype(trend_categories)
+    for sdf, id_fields, percentile_fields, trend_fields in [(raws_update_sdf, ['NWSID_Clean'], RAWS_percentile_fields, RAWS_trend_fields),
+                                                            (psa_update_sdf, ['PSANationalCode','GACC'], PSA_percentile_fields, PSA_trend_fields)]:
+        for field in id_fields:
+            sdf[field] = sdf[field].astype('category')
+        for field in [f for f in percentile_fields if f in sdf.columns]:
+            sdf[field] = pandas.to_numeric(sdf[field], errors='coerce').astype('Float32')
+        for field in [f for f in trend_fields if f in sdf.columns]:
+            sdf[field] = sdf[field].astype(trend_dtype)
+    return raws_update_sdf, psa_update_sdf
+
+def plain_types(sdf):
+    '''Convert the compact typed columns back to plain columns for the outputs: ids and trend codes to objects,
+    percentiles to float64.'''
+    for field in sdf.columns:
+        if(isinstance(sdf[field].dtype, pandas.CategoricalDtype)):
+            sdf[field] = sdf[field].astype('object')
+        elif(isinstance(sdf[field].dtype, pandas.Float32Dtype)):
+            # Percentiles are whole or averaged to 2 decimals, so a stored 55.33 comes back as 55.33 rather than 55.33000183
+            sdf[field] = sdf[field].astype('float64').round(2)
+    return sdf
+
+def publish_types(sdf):
+    '''Plain columns with None for missing values, as expected by the service. Converts sdf in place, pass a copy.'''
+    compact_fields = [c for c in sdf.columns if isinstance(sdf[c].dtype, (pandas.CategoricalDtype, pandas.Float32Dtype))]
+    sdf = plain_types(sdf)
+    for field in compact_fields:
+        sdf[field] = sdf[field].astype('object').where(sdf[field].notna(), None)
+    return sdf
+
+def query_layers(allstations, raws_layer, psa_layer):
+    '''Query the RAWS and PSA layers for the features in the analysis.'''
+
+    # Where clauses for the PSAs and stations in the analysis
+    wherefield = 'PSANationalCode'
+    wherevalues = str(tuple(allstations['PSA'].tolist()))
+    psa_where = '"' + wherefield + '"' + ' IN ' + wherevalues
+    wherefield = 'NWSID_clean'
+    wherevalues = str(tuple(list(str(n).zfill(6) for n in allstations['StationID'].tolist())))
+    raws_where = '"' + wherefield + '"' + ' IN ' + wherevalues
+
+    # Attribute-only queries if the static snapshot is up to date
+    if(toggle_static_snapshot == True):
+        print_both('.QUERY DYNAMIC ATTRIBUTES\r')
+        psa_update_sdf, raws_update_sdf = load_static_snapshot(psa_where, raws_where, psa_layer, raws_layer)
+        if(raws_update_sdf is not None):
+            psa_update_sdf = psa_update_sdf.sort_values(by=['PSANationalCode']) # Sort the dataframe by PSA Code
+            return compact_types(raws_update_sdf, psa_update_sdf)
+
+    # Query PSA feature service to subset to PSAs in the analysis
+    print_both('.SUBSET TO TARGET PSA DATA\r')
+    psa_query = psa_layer.query(where=psa_where)
+    psa_orig_sdf = psa_query.sdf
+    psa_update_sdf = psa_orig_sdf.sort_values(by=['PSANationalCode']) # Sort the dataframe by PSA Code
+
+    # Query RAWS feature service to subset to stations in the analysis
+    print_both('.SUBSET TO TARGET RAWS DATA\r')
+    raws_query = raws_layer.query(where=raws_where)
+    raws_update_sdf = raws_query.sdf
+
+    if(toggle_static_snapshot == True):
+        save_static_snapshot(psa_orig_sdf, raws_update_sdf)
+
+    return compact_types(raws_update_sdf, psa_update_sdf)
 
 
 #########################################################################################################################
-### RAWS NFDRS PERCENTILES AND 3-DAY TRENDS
+### DOWNLOAD WIMS DATA
 #########################################################################################################################
-print_both('\r')
-print_both('RAWS NFDRS PERCENTILES AND 3-DAY TRENDS\r')
 
-for i in range(0, raws_update_sdf.shape[0]):
-    
-    print_both('.Processing ' + raws_update_sdf['NWSID_Clean'][i] + ', ' + raws_update_sdf['StnName_Clean'][i] + '\r')
+def build_wims_urls(curr_NWSID, fuel_model):
+    '''Build the NFDRS, NFDRS forecast and observation urls for a station.'''
+
+    # Build the NFDRS url for the current station
+    curr_stationid_nfdrs_url = raws_nfdrs_url.replace('stn=', 'stn=' + curr_NWSID)
+    curr_stationid_nfdrs_url = curr_stationid_nfdrs_url.replace('fmodel=', 'fmodel=' + str(fuel_model))
+    curr_stationid_nfdrs_url = curr_stationid_nfdrs_url.replace('start=', 'start=' + datetime_nfdrs_start.strftime('%d-%b-%y'))
+    curr_stationid_nfdrs_url = curr_stationid_nfdrs_url.replace('end=', 'end=' + datetime_today.strftime('%d-%b-%y'))
+
+    # Build the NFDRS url with forecast information for the current station
+    curr_stationid_nfdrs_fcast_url = raws_nfdrs_fcast_url.replace('stn=', 'stn=' + curr_NWSID)
+    curr_stationid_nfdrs_fcast_url = curr_stationid_nfdrs_fcast_url.replace('fmodel=', 'fmodel=' + str(fuel_model))
+    curr_stationid_nfdrs_fcast_url = curr_stationid_nfdrs_fcast_url.replace('start=', 'start=' + datetime_today.strftime('%d-%b-%y'))
+    curr_stationid_nfdrs_fcast_url = curr_stationid_nfdrs_fcast_url.replace('end=', 'end=' + datetime_for_end.strftime('%d-%b-%y'))
+
+    # Build the Observation url for the current station
+    curr_stationid_obs_url = raws_obs_url.replace('stn=', 'stn=' + curr_NWSID)
+    curr_stationid_obs_url = curr_stationid_obs_url.replace('start=', 'start=' + datetime_today.strftime('%d-%b-%y'))
+    curr_stationid_obs_url = curr_stationid_obs_url.replace('end=', 'end=' + datetime_today.strftime('%d-%b-%y'))
+
+    return {'nfdrs': curr_stationid_nfdrs_url, 'fcast': curr_stationid_nfdrs_fcast_url, 'obs': curr_stationid_obs_url}
+
+# WIMS request rate control (NFDRS_rate.py), shared by all download threads. The number of requests in flight adapts
+# between the min and max to the WIMS response times and errors. After wims_breaker_failures consecutive failures all
+# requests pause for wims_breaker_cooldown seconds (doubled each time) instead of each retrying on its own, and after
+# wims_breaker_max_trips the remaining downloads of the run are skipped. Only timeouts, connection errors and HTTP 429
+# or 5xx answers count as failures and are retried (wims_transient_error), other errors skip the request right away.
+wims_min_concurrency = 1
+wims_max_concurrency = 4
+wims_latency_target = 10 # Seconds, slower responses lower the number of requests in flight
+wims_retries = 5 # Retries of a failed request, with exponential backoff
+wims_breaker_failures = 10
+wims_breaker_cooldown = 60
+wims_breaker_max_trips = 3
+
+# Optional pooled HTTP session for the WIMS requests (kept warm between runs by NFDRS_scheduler.py), urllib if None
+http_session = None
+
+def fetch_wims(url):
+    '''Download one WIMS request and return the xml bytes.'''
+    if(http_session is not None):
+        response = http_session.get(url, timeout=120)
+        response.raise_for_status()
+        return response.content
+    return urllib.request.urlopen(url, timeout=120).read()
+
+def parse_wims_xml(xml_bytes):
+    '''Convert WIMS xml data to a pandas dataframe with one row per record.'''
+    root = ET.XML(xml_bytes)
+    all_records = []
+    for k, elem in enumerate(root):
+        record = {}
+        for child in elem:
+            record[child.tag] = child.text
+        all_records.append(record)
+    return pandas.DataFrame(all_records)
+
+def wims_transient_error(e):
+    '''
+    True for download errors that count against WIMS in the rate controller and are retried: timeouts, connection errors
+    and HTTP 429 or 5xx answers. Other HTTP answers (e.g. 404) are failures of the request, not of the service.
+    '''
+    if(isinstance(e, urllib.error.HTTPError)):
+        status = e.code
+    elif(isinstance(e, requests.HTTPError)):
+        status = e.response.status_code if e.response is not None else None
+    else:
+        return isinstance(e, (requests.Timeout, requests.ConnectionError, urllib.error.URLError, TimeoutError, ConnectionError))
+    return status is None or status == 429 or status >= 500
+
+def wims_fuel_models(station_df):
+    '''Fuel model of each record of a WIMS NFDRS response, from the model code (msgc, e.g. 16Y).'''
+    if(len(station_df) == 0):
+        return pandas.Series(dtype='object')
+    if('msgc' not in station_df.columns):
+        raise ValueError('NO MODEL CODE (msgc) TO SPLIT THE FUEL MODELS')
+    return station_df['msgc'].astype(str).str.extract(r'^\s*\d*([A-Za-z])', expand=False).str.upper()
+
+def download_station(curr_NWSID, fuel_model, sources, wims_rate, station_fuel_models=()):
+    '''
+    Download the requested WIMS data of one station through the shared rate controller. Returns the urls and the data
+    frame of each request that succeeded, and whether the circuit breaker stopped the downloads. With station_fuel_models,
+    the NFDRS and forecast data of those fuel models are also returned as fm_nfdrs and fm_fcast, with a fuel_model column.
+    '''
+    station_data = {'urls': build_wims_urls(curr_NWSID, fuel_model)}
+    fuel_model = str(fuel_model).upper()
+    extra_fuel_models = [fm for fm in station_fuel_models if fm != fuel_model]
+    for source, source_name in [('nfdrs', 'NFDRS'), ('fcast', 'NFDRS FORECAST'), ('obs', 'OBS')]:
+        if(source not in sources):
+            continue
+        print_both('..DOWNLOADING %s DATA\r', source_name, station=curr_NWSID)
+        on_retry = lambda attempt, e: print_both('...%s XML DOWNLOAD FAIL, RE-TRYING\r', source_name, station=curr_NWSID, error=str(e))
+        fm_combined = (source != 'obs' and len(station_fuel_models) > 0 and len(extra_fuel_models) > 0 and wims_combined_fuel_models == True)
+        if(fm_combined == True):
+            # One request for the service's fuel model and the additional ones
+            source_url = build_wims_urls(curr_NWSID, ','.join([fuel_model] + extra_fuel_models))[source]
+        else:
+            source_url = station_data['urls'][source]
+        try:
+            station_df = download_source(source, source_url, wims_rate, on_retry, fuel_model if fm_combined == True else None)
+            if(fm_combined == True):
+                fm_df = station_df.assign(fuel_model=wims_fuel_models(station_df))
+                station_df = fm_df.loc[fm_df['fuel_model'] == fuel_model,].drop(columns=['fuel_model']).reset_index(drop=True)
+            station_data[source] = station_df
+            if(source != 'obs' and len(station_fuel_models) > 0 and fm_combined == False):
+                # One request per additional fuel model, a failed one only leaves out that fuel model
+                fm_dfs = [station_df.assign(fuel_model=fuel_model)]
+                for fm in extra_fuel_models:
+                    try:
+                        fm_dfs.append(download_source(source, build_wims_urls(curr_NWSID, fm)[source], wims_rate, on_retry).assign(fuel_model=fm))
+                    except NFDRS_rate.CircuitOpen:
+                        raise
+                    except Exception as e:
+                        print_both('...' + source_name + ' FUEL MODEL ' + fm + ' DOWNLOAD FAIL\r', level='WARNING', station=curr_NWSID, error=str(e))
+                fm_df = pandas.concat(fm_dfs, ignore_index=True)
+            if(source != 'obs' and len(station_fuel_models) > 0):
+                station_data['fm_' + source] = fm_df.loc[fm_df['fuel_model'].isin(station_fuel_models),].reset_index(drop=True)
+        except NFDRS_rate.CircuitOpen:
+            print_both('...WIMS CIRCUIT BREAKER OPEN, SKIPPING STATION\r', station=curr_NWSID)
+            return station_data, True
+        except Exception as e:
+            print_both('...' + source_name + ' XML DOWNLOAD FAIL, SKIPPING STATION\r', level='WARNING', station=curr_NWSID, error=str(e))
+    return station_data, False
+
+def download_source(source, source_url, wims_rate, on_retry, fuel_model=None):
+    '''
+    Download one WIMS request type of a station. NFDRS data is tried at 1300, then 1200, then 1400, until a time has
+    records (of fuel_model if given, for requests of several fuel models). Only the download goes through the rate
+    controller, the xml is parsed after the request slot is released so a bad response does not count against WIMS.
+    '''
+    if(source != 'nfdrs'):
+        return parse_wims_xml(wims_rate.call_with_retries(fetch_wims, source_url, retries=wims_retries, on_retry=on_retry))
+    for nfdrs_time in ['13', '12', '14']:
+        station_df = parse_wims_xml(wims_rate.call_with_retries(fetch_wims, source_url.replace('time=', 'time=' + nfdrs_time),
+                                                                retries=wims_retries, on_retry=on_retry))
+        if(len(station_df) > 0 and (fuel_model is None or (wims_fuel_models(station_df) == fuel_model).any())):
+            break
+    return station_df
+
+def download_wims(raws_update_sdf, sources=('nfdrs','fcast','obs'), fuel_model_dfs=None):
+    '''
+    Download the WIMS data for each station, several stations at a time under the adaptive rate controller. Stations that
+    fail to download are left out of the data frames, as are request types not listed in sources. If fuel_model_dfs is
+    given ({'nfdrs': {}, 'fcast': {}}), the NFDRS and forecast data of all fuel_models are filled in for each station.
+    '''
+    print_both('\r')
+    print_both('DOWNLOAD WIMS DATA\r')
+
+    # One rate controller for all WIMS requests of the download
+    wims_rate = NFDRS_rate.RateController(min_concurrency=wims_min_concurrency, max_concurrency=wims_max_concurrency,
+                                          start_concurrency=wims_min_concurrency, latency_target=wims_latency_target,
+                                          breaker_failures=wims_breaker_failures, breaker_cooldown=wims_breaker_cooldown,
+                                          breaker_max_trips=wims_breaker_max_trips, transient=wims_transient_error)
+
+    # Download the stations, checkpointing each one as it completes
+    station_ids = [str(s) for s in raws_update_sdf['NWSID_Clean']]
+    checkpoint_fields = set(checkpoint_wims_fields) | set(raws_update_sdf.columns)
+    station_results = {}
+    stations_stopped = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=wims_max_concurrency) as pool:
+        jobs = {}
+        for i in range(0, raws_update_sdf.shape[0]):
+            print_both('.Downloading %s, %s\r', raws_update_sdf['NWSID_Clean'][i], raws_update_sdf['StnName_Clean'][i], level='DEBUG',
+                       station=station_ids[i])
+            jobs[pool.submit(download_station, station_ids[i], raws_update_sdf['FuelModelCode'][i], sources, wims_rate,
+                             [str(fm).upper() for fm in fuel_models] if fuel_model_dfs is not None else [])] = station_ids[i]
+        for job in concurrent.futures.as_completed(jobs):
+            station_data, stopped = job.result()
+            station_results[jobs[job]] = station_data
+            stations_stopped = stations_stopped + int(stopped)
+            if(toggle_checkpoint == True):
+                write_checkpoint('wims', jobs[job], checkpoint_wims(station_data, checkpoint_fields))
+    sync_checkpoint()
+
+    # WIMS urls and data frames for each station in the station order, stations that fail to download are left out
+    wims_urls = {}
+    wims_nfdrs_dfs = {}
+    wims_fcast_dfs = {}
+    wims_obs_dfs = {}
+    for curr_NWSID in station_ids:
+        wims_urls[curr_NWSID] = station_results[curr_NWSID]['urls']
+        for source, source_dfs in [('nfdrs', wims_nfdrs_dfs), ('fcast', wims_fcast_dfs), ('obs', wims_obs_dfs)]:
+            if(source in station_results[curr_NWSID]):
+                source_dfs[curr_NWSID] = station_results[curr_NWSID][source]
+            if(fuel_model_dfs is not None and 'fm_' + source in station_results[curr_NWSID]):
+                fuel_model_dfs[source][curr_NWSID] = station_results[curr_NWSID]['fm_' + source]
+
+    failed_stations = [s for s in wims_urls if any(s not in d for k, d in [('nfdrs', wims_nfdrs_dfs), ('fcast', wims_fcast_dfs),
+                                                                          ('obs', wims_obs_dfs)] if k in sources)]
+    print_both('.DOWNLOADED ' + str(len(wims_urls) - len(failed_stations)) + ' OF ' + str(len(wims_urls)) + ' STATIONS\r',
+               failed_stations=failed_stations)
+    if(stations_stopped > 0):
+        print_both('.WIMS CIRCUIT BREAKER OPEN, ' + str(stations_stopped) + ' STATIONS NOT DOWNLOADED\r', level='WARNING')
+
+    # Rate controller state for the run metrics
+    wims_stats = wims_rate.stats()
+    print_both('.WIMS REQUESTS: ' + str(wims_stats['requests']) + ', FAILURES: ' + str(wims_stats['failures']) + ', IN FLIGHT: ' +
+               str(wims_stats['limit_min']) + '-' + str(wims_stats['limit_max']) + ', BREAKER: ' + wims_stats['state'].upper() + '\r',
+               event='wims_rate', **wims_stats)
+
+    return wims_urls, wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs
 
-    curr_NWSID = raws_update_sdf['NWSID_Clean'][i]
+
+#########################################################################################################################
+### QUALITY CONTROL OF WIMS DATA
+#########################################################################################################################
+
+def qc_wims(wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs):
+    '''Quality control of the WIMS data for all stations at once, flagged values are dropped in place if requested.'''
+    print_both('\r')
+    print_both('QUALITY CONTROL OF WIMS DATA\r')
 
     try:
-        
-        # Grab the station's ERC and BI Percentile tables
-        erc_per = percentiles.loc[(percentiles['StationID'] == curr_NWSID) & (percentiles['Component'] == 'ERC')]
-        bi_per = percentiles.loc[(percentiles['StationID'] == curr_NWSID) & (percentiles['Component'] == 'BI')]
-
-        ### GRAB DATA FROM WIMS
-        
-        # Build the NFDRS url for the current station
-        curr_stationid_nfdrs_url = raws_nfdrs_url.replace('stn=', 'stn=' + curr_NWSID)
-        curr_stationid_nfdrs_url = curr_stationid_nfdrs_url.replace('fmodel=', 'fmodel=' + str(raws_update_sdf['FuelModelCode'][i]))
-        curr_stationid_nfdrs_url = curr_stationid_nfdrs_url.replace('start=', 'start=' + datetime_obs_start.strftime('%d-%b-%y'))
-        curr_stationid_nfdrs_url = curr_stationid_nfdrs_url.replace('end=', 'end=' + datetime_today.strftime('%d-%b-%y'))
-
-        # Build the NFDRS url with forecast information for the current station
-        curr_stationid_nfdrs_fcast_url = raws_nfdrs_fcast_url.replace('stn=', 'stn=' + curr_NWSID)
-        curr_stationid_nfdrs_fcast_url = curr_stationid_nfdrs_fcast_url.replace('fmodel=', 'fmodel=' + str(raws_update_sdf['FuelModelCode'][i]))
-        curr_stationid_nfdrs_fcast_url = curr_stationid_nfdrs_fcast_url.replace('start=', 'start=' + datetime_today.strftime('%d-%b-%y'))
-        curr_stationid_nfdrs_fcast_url = curr_stationid_nfdrs_fcast_url.replace('end=', 'end=' + datetime_for_end.strftime('%d-%b-%y'))
-
-        # Build the Observation url for the current station
-        curr_stationid_obs_url = raws_obs_url.replace('stn=', 'stn=' + curr_NWSID)
-        curr_stationid_obs_url = curr_stationid_obs_url.replace('start=', 'start=' + datetime_today.strftime('%d-%b-%y'))
-        curr_stationid_obs_url = curr_stationid_obs_url.replace('end=', 'end=' + datetime_today.strftime('%d-%b-%y'))    
-
-        # Now convert the NFDRS xml data to a pandas dataframe
-        print_both('..DOWNLOADING NFDRS DATA\r')
-        nfdrs_xml_try = 0
-        nfdrs_xml_download = False
-        while(nfdrs_xml_download == False):
-            try:
-                # Try getting the 1300 data first
-                xml_data = urllib.request.urlopen(curr_stationid_nfdrs_url.replace('time=','time=13'))
-                root = ET.XML(xml_data.read())
-                all_records = []
-                for k, elem in enumerate(root):
-                    record = {}
-                    for child in elem:
-                        record[child.tag] = child.text
-                    all_records.append(record)
-                curr_station_nfdrs_df = pandas.DataFrame(all_records)
-                # If no results with the 1300 query, try getting the 1200 data
-                if(len(curr_station_nfdrs_df) == 0):
-                    xml_data = urllib.request.urlopen(curr_stationid_nfdrs_url.replace('time=','time=12'))
-                    root = ET.XML(xml_data.read())
-                    all_records = []
-                    for k, elem in enumerate(root):
-                        record = {}
-                        for child in elem:
-                            record[child.tag] = child.text
-                        all_records.append(record)
-                    curr_station_nfdrs_df = pandas.DataFrame(all_records)
-                # If no results with the 1300 query or the 1200 query, try getting the 1400 data
-                if(len(curr_station_nfdrs_df) == 0):
-                    xml_data = urllib.request.urlopen(curr_stationid_nfdrs_url.replace('time=','time=14'))
-                    root = ET.XML(xml_data.read())
-                    all_records = []
-                    for k, elem in enumerate(root):
-                        record = {}
-                        for child in elem:
-                            record[child.tag] = child.text
-                        all_records.append(record)
-                    curr_station_nfdrs_df = pandas.DataFrame(all_records)
-                nfdrs_xml_download = True
-            except:
-                if(nfdrs_xml_try < 5):
-                    print_both('...NFDRS XML DOWNLOAD FAIL, RE-TRYING\r')
-                    nfdrs_xml_try = nfdrs_xml_try + 1
-                else:
-                    print_both('...NFDRS XML DOWNLOAD FAIL 5 TIMES, SKIPPING STATION\r')
-                    break
-
-        # Now convert the NFDRS xml data to a pandas dataframe
-        print_both('..DOWNLOADING NFDRS FORECAST DATA\r')
-        nfdrs_xml_try = 0
-        nfdrs_xml_download = False
-        while(nfdrs_xml_download == False):
-            try:
-                xml_data = urllib.request.urlopen(curr_stationid_nfdrs_fcast_url)
-                root = ET.XML(xml_data.read())
-                all_records = []
-                for k, elem in enumerate(root):
-                    record = {}
-                    for child in elem:
-                        record[child.tag] = child.text
-                    all_records.append(record)
-                curr_station_nfdrs_fcast_df = pandas.DataFrame(all_records)
-                nfdrs_xml_download = True
-            except:
-                if(nfdrs_xml_try < 5):
-                    print_both('...NFDRS FORECAST XML DOWNLOAD FAIL, RE-TRYING\r')
-                    nfdrs_xml_try = nfdrs_xml_try + 1
-                else:
-                    print_both('...NFDRS FORECAST XML DOWNLOAD FAIL 5 TIMES, SKIPPING STATION\r')
-                    break
-
-        # Now convert the Observation xml data to a pandas dataframe
-        print_both('..DOWNLOADING OBS DATA\r')
-        obs_xml_try = 0
-        obs_xml_download = False
-        while(obs_xml_download == False):
-            try:
-                xml_data = urllib.request.urlopen(curr_stationid_obs_url)
-                root = ET.XML(xml_data.read())
-                all_records = []
-                for k, elem in enumerate(root):
-                    record = {}
-                    for child in elem:
-                        record[child.tag] = child.text
-                    all_records.append(record)
-                curr_station_obs_df = pandas.DataFrame(all_records)
-                obs_xml_download = True
-            except:
-                if(obs_xml_try < 5):
-                    print_both('...OBS XML DOWNLOAD FAIL, RE-TRYING\r')
-                    obs_xml_try = obs_xml_try + 1
-                else:
-                    print_both('...OBS XML DOWNLOAD FAIL 5 TIMES, SKIPPING STATION\r')
-                    break
-
-        # Sort NFDR Observation dataframe by 'nfdr_dt', then by 'mp'
-        # Then create a 'nfdr_dt_tm' field
-        # Then parse the 'nfdr_dt_tm' field to an actual datetime field, and sort by this field.
-        # Also sort by 'mp' (model priority). See further below for why this is important.
-        nfdr_dt_list = list(curr_station_nfdrs_df['nfdr_dt'])
-        nfdr_tm_list = list(curr_station_nfdrs_df['nfdr_tm'])
-        nfdr_dt_tm_list = [k + ' ' + l for k, l in zip(nfdr_dt_list, nfdr_tm_list)]
-        curr_station_nfdrs_df['nfdr_dt_tm'] = nfdr_dt_tm_list
-        curr_station_nfdrs_df['nfdr_datetime'] = pandas.to_datetime(curr_station_nfdrs_df['nfdr_dt_tm'], format='%m/%d/%Y %H')
-        curr_station_nfdrs_df = curr_station_nfdrs_df[(curr_station_nfdrs_df['nfdr_dt'] == datetime_obs_start.strftime('%m/%d/%Y')) | (curr_station_nfdrs_df['nfdr_dt'] == datetime_today.strftime('%m/%d/%Y'))]
-        curr_station_nfdrs_df = curr_station_nfdrs_df.sort_values(by=['nfdr_datetime', 'mp'], ascending = [True, True])
-        curr_station_nfdrs_df.reset_index(drop=True)
-
-        # Sort NFDR Forecast dataframe by 'nfdr_dt', then by 'mp'
-        # Then create a 'nfdr_dt_tm' field
-        # Then parse the 'nfdr_dt_tm' field to an actual datetime field, and sort by this field.
-        # Also sort by 'mp' (model priority). See further below for why this is important.
-        # Lastly, keep only forecasted observations, and only for the next 3 days ########### Moved to data call
-        if(curr_station_nfdrs_fcast_df.shape[0] > 0):
-            nfdr_dt_list = list(curr_station_nfdrs_fcast_df['nfdr_dt'])
-            nfdr_tm_list = list(curr_station_nfdrs_fcast_df['nfdr_tm'])
-            nfdr_dt_tm_list = [k + ' ' + l for k, l in zip(nfdr_dt_list, nfdr_tm_list)]
-            curr_station_nfdrs_fcast_df['nfdr_dt_tm'] = nfdr_dt_tm_list
-            curr_station_nfdrs_fcast_df['nfdr_datetime'] = pandas.to_datetime(curr_station_nfdrs_fcast_df['nfdr_dt_tm'], format='%m/%d/%Y %H')
-            curr_station_nfdrs_fcast_df = curr_station_nfdrs_fcast_df[(curr_station_nfdrs_fcast_df['nfdr_dt'] == datetime_tomorrow.strftime('%m/%d/%Y')) | (curr_station_nfdrs_fcast_df['nfdr_dt'] == datetime_for_end.strftime('%m/%d/%Y'))] 
-            curr_station_nfdrs_fcast_df = curr_station_nfdrs_fcast_df.sort_values(by=['nfdr_datetime', 'mp'], ascending = [True, True])
-            curr_station_nfdrs_fcast_df.reset_index(drop=True)
-
-        # Sort Observation dataframe by 'obs_dt' and 'obs_tm'
-        # Then create a 'obs_dt_tm' field
-        # Then parse the 'obs_dt_tm' field to an actual datetime field, and sort by this field.
-        obs_dt_list = list(curr_station_obs_df['obs_dt'])
-        obs_tm_list = list(curr_station_obs_df['obs_tm'])
-        obs_dt_tm_list = [k + ' ' + l for k, l in zip(obs_dt_list, obs_tm_list)]
-        curr_station_obs_df['obs_dt_tm'] = obs_dt_tm_list
-        curr_station_obs_df['obs_datetime'] = pandas.to_datetime(curr_station_obs_df['obs_dt_tm'], format='%m/%d/%Y %H')
-        curr_station_obs_df = curr_station_obs_df.sort_values(by=['obs_datetime'], ascending = [True])
-
-        # Subset to observation at assessment day's reporting time
-        nfdr_dt_aday = curr_station_nfdrs_df[curr_station_nfdrs_df['nfdr_dt'] == datetime_today.strftime('%m/%d/%Y')]['nfdr_datetime'][0]
-        curr_station_obs_df_filtered = curr_station_obs_df[curr_station_obs_df['obs_datetime'] == nfdr_dt_aday]
-
-        # Merge the NFDRS and Obs dataframes together
-        if( len(curr_station_obs_df_filtered) == 1 ):
-            curr_station_nfdrs_obs_df = pandas.merge(curr_station_nfdrs_df,curr_station_obs_df_filtered,how='left',
-                                                     left_on='nfdr_dt_tm',right_on='obs_dt_tm',suffixes=('', '_y'))
+        import NFDRS_qc
+
+        # Stack the records from all stations into one long table per WIMS request type and check them together.
+        # Only the NFDRS observations have the day-to-day history needed for the jump and stuck value checks.
+        qc_sources = [('NFDRS', wims_nfdrs_dfs, 'nfdr_dt', 'nfdr_tm', True),
+                      ('NFDRS FORECAST', wims_fcast_dfs, 'nfdr_dt', 'nfdr_tm', False),
+                      ('OBS', wims_obs_dfs, 'obs_dt', 'obs_tm', False)]
+        qc_flag_dfs = []
+        for qc_name, qc_dfs, qc_dt, qc_tm, qc_history in qc_sources:
+            qc_stations = {k: v for k, v in qc_dfs.items() if len(v) > 0}
+            if(len(qc_stations) == 0):
+                continue
+            qc_long = pandas.concat(qc_stations, names=['StationID','wims_row']).reset_index()
+            qc_long['qc_datetime'] = pandas.to_datetime(qc_long[qc_dt] + ' ' + qc_long[qc_tm], format='%m/%d/%Y %H', errors='coerce')
+
+            # Records without a valid date time are not checked, they are kept as they are
+            qc_valid = qc_long.loc[qc_long['qc_datetime'].notna(),]
+            if(len(qc_valid) < len(qc_long)):
+                print_both('.' + qc_name + ': ' + str(len(qc_long) - len(qc_valid)) + ' RECORDS WITHOUT A VALID DATE TIME NOT CHECKED\r', level='WARNING')
+            if(qc_history == True):
+                qc_flags = NFDRS_qc.qc_flags(qc_valid, 'StationID', 'qc_datetime', priority_col='mp', stuck_days=qc_stuck_days)
+            else:
+                qc_flags = NFDRS_qc.qc_flags(qc_valid, 'StationID', 'qc_datetime', jump_limits={}, stuck_fields=[])
+            print_both('.' + qc_name + ': ' + str(len(qc_flags)) + ' SUSPICIOUS VALUES FROM ' + str(qc_flags['StationID'].nunique()) + ' STATIONS\r')
+            if(len(qc_flags) == 0):
+                continue
+
+            # Drop the flagged values and split only the stations with dropped values back out of the long table
+            if(qc_action == 'Drop'):
+                qc_drop_stations = qc_flags.loc[~qc_flags['Check'].isin(NFDRS_qc.qc_report_only_checks),'StationID'].unique()
+                qc_long = qc_long.loc[qc_long['StationID'].isin(qc_drop_stations),]
+                qc_long = NFDRS_qc.drop_flagged(qc_long, qc_flags)
+                for qc_stn, qc_stn_df in qc_long.groupby('StationID', sort=False):
+                    qc_dfs[qc_stn] = qc_stn_df.drop(columns=['StationID','qc_datetime']).set_index('wims_row').rename_axis(None)
+            qc_flags.insert(0, 'Source', qc_name)
+            qc_flag_dfs.append(qc_flags)
+
+        # Save flagged values for review
+        if(len(qc_flag_dfs) > 0):
+            qc_flags = pandas.concat(qc_flag_dfs, ignore_index=True)
+            for qc_check, qc_count in qc_flags['Check'].value_counts().items():
+                qc_dropped = (qc_action == 'Drop' and qc_check not in NFDRS_qc.qc_report_only_checks)
+                print_both('.' + qc_check.upper() + ' CHECK: ' + str(qc_count) + ' VALUES ' + ('DROPPED' if qc_dropped == True else 'FLAGGED') + '\r')
+            qc_flags.to_csv(wdir + '/qc_flags.csv', index=False)
+
+    except Exception as e:
+
+        print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+        print_both('.QUALITY CONTROL FAILED, CONTINUING WITH UNCHECKED WIMS DATA\r')
+
+
+#########################################################################################################################
+### STACK WIMS DATA FOR ALL STATIONS
+#########################################################################################################################
+
+def stack_wims_long(wims_dfs, dt_col, tm_col):
+    '''
+    Stack the WIMS data frames of all stations into one long table with StationID and wims_row (the record's row in the
+    station's response) and a parsed date time (<prefix>_dt_tm and <prefix>_datetime, e.g. nfdr_datetime). Also returns
+    the stations with a date time that could not be parsed.
+    '''
+    prefix = dt_col[:-len('_dt')]
+    wims_stations = {k: v for k, v in wims_dfs.items() if v is not None and len(v) > 0}
+    if(len(wims_stations) == 0):
+        return pandas.DataFrame(columns=['StationID','wims_row',dt_col,tm_col,prefix + '_dt_tm',prefix + '_datetime']), set()
+    wims_long = pandas.concat(wims_stations, names=['StationID','wims_row']).reset_index()
+    wims_long[prefix + '_dt_tm'] = wims_long[dt_col] + ' ' + wims_long[tm_col]
+    wims_long[prefix + '_datetime'] = pandas.to_datetime(wims_long[prefix + '_dt_tm'], format='%m/%d/%Y %H', errors='coerce')
+    return wims_long, set(wims_long.loc[wims_long[prefix + '_datetime'].isna(), 'StationID'])
+
+def stack_wims(wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs):
+    '''
+    Prepare the WIMS data of all stations for the percentiles and trends in one pass over the whole network:
+    - NFDRS observations of the run day and two days prior, and forecasts of tomorrow and three days out
+    - sorted by date time and model priority (mp), keeping the lowest mp record of each day
+    - the weather observation at the run day's NFDRS time joined to the NFDRS records, if there is exactly one
+    Returns the prepared NFDRS/observation and forecast records of all stations as long tables (StationID, wims_row and
+    the WIMS fields, in date time order within each station), and the stations that cannot be processed with the reason.
+    '''
+    nfdrs_long, nfdrs_bad = stack_wims_long(wims_nfdrs_dfs, 'nfdr_dt', 'nfdr_tm')
+    fcast_long, fcast_bad = stack_wims_long(wims_fcast_dfs, 'nfdr_dt', 'nfdr_tm')
+    obs_long, obs_bad = stack_wims_long(wims_obs_dfs, 'obs_dt', 'obs_tm')
+    stack_errors = {stn: 'UNABLE TO PARSE WIMS DATE/TIME' for stn in nfdrs_bad | fcast_bad | obs_bad}
+
+    # Days used for the percentiles and trends, in date time and model priority order
+    nfdrs_long = nfdrs_long.loc[nfdrs_long['nfdr_dt'].isin([datetime_obs_start.strftime('%m/%d/%Y'), datetime_today.strftime('%m/%d/%Y')]),]
+    nfdrs_long = nfdrs_long.sort_values(by=['StationID','nfdr_datetime','mp'])
+    fcast_long = fcast_long.loc[fcast_long['nfdr_dt'].isin([datetime_tomorrow.strftime('%m/%d/%Y'), datetime_for_end.strftime('%m/%d/%Y')]),]
+    fcast_long = fcast_long.sort_values(by=['StationID','nfdr_datetime','mp'])
+
+    # NFDRS time of the run day (first run day record of each station's response), stations without one are skipped
+    nfdrs_aday = nfdrs_long.loc[nfdrs_long['nfdr_dt'] == datetime_today.strftime('%m/%d/%Y'),].sort_values(by=['wims_row'], kind='stable')
+    nfdrs_aday = nfdrs_aday.drop_duplicates(subset=['StationID'], keep='first').set_index('StationID')['nfdr_datetime']
+    for stn in set(wims_nfdrs_dfs) - set(nfdrs_aday.index):
+        stack_errors.setdefault(stn, 'NO NFDRS DATA FOR ' + datetime_today.strftime('%m/%d/%Y'))
+
+    # Join the observation at the run day's NFDRS time, only for stations with exactly one
+    obs_aday = obs_long.loc[obs_long['obs_datetime'] == obs_long['StationID'].map(nfdrs_aday),].drop(columns=['wims_row'])
+    obs_aday = obs_aday.loc[obs_aday.groupby('StationID')['StationID'].transform('size') == 1,]
+    nfdrs_obs_long = nfdrs_long.merge(obs_aday, how='left', left_on=['StationID','nfdr_dt_tm'], right_on=['StationID','obs_dt_tm'],
+                                      suffixes=('', '_y'))
+
+    # Keep the lowest model priority record of each day
+    nfdrs_obs_long = nfdrs_obs_long.drop_duplicates(subset=['StationID','nfdr_dt'], keep='first').reset_index(drop=True)
+    fcast_long = fcast_long.drop_duplicates(subset=['StationID','nfdr_dt'], keep='first').reset_index(drop=True)
+    return nfdrs_obs_long, fcast_long, stack_errors
+
+def station_rows(wims_long, stations):
+    '''
+    First, second and last record of each of stations in a long WIMS table (all NA for a station without records), and
+    the number of records of each station.
+    '''
+    wims_long = wims_long.reindex(columns=list(wims_long.columns) + [c for c in ['ec','bi'] if c not in wims_long.columns])
+    position = wims_long.groupby('StationID', sort=False).cumcount()
+    count = wims_long.groupby('StationID', sort=False)['StationID'].transform('size')
+    wims_rows = [wims_long.loc[rows,].set_index('StationID').reindex(stations) for rows in [position == 0, position == 1, position == count - 1]]
+    return wims_rows, wims_long.groupby('StationID', sort=False).size().reindex(stations, fill_value=0)
+
+def wims_text(values):
+    '''WIMS values as the text str() gives for each (None as 'None', NaN as 'nan'), unlike astype(str) that keeps them missing.'''
+    return pandas.Series(values.to_numpy(dtype='object').astype(str), index=values.index, dtype='object')
+
+def wims_floats(values):
+    '''
+    ERC/BI values as floats, read the way float() reads them: missing values (NaN) stay NaN, and values float() cannot
+    read (None, text) are flagged.
+    '''
+    text = wims_text(values).str.strip()
+    floats = pandas.to_numeric(text, errors='coerce').astype('float64')
+    return floats, floats.isna() & (text.str.lower() != 'nan')
+
+def float_error(value):
+    '''The error float() raises for a value.'''
+    try:
+        float(value)
+    except Exception as e:
+        return str(e)
+    return None
+
+def wims_values(values, column):
+    '''
+    Latest WIMS values of a column, typed the way they are inserted into the RAWS service: NA as NA, date times as they
+    are, whole numbers as int, decimals as float, staffing level (sl) as the integer of its first character and anything
+    else as it is. Also flags the values that cannot be converted.
+    '''
+    bad = pandas.Series(False, index=values.index)
+    if(pandas.api.types.is_datetime64_any_dtype(values)):
+        return values.astype('object'), bad
+    text = wims_text(values)
+    out = values.astype('object')
+    is_na = text.isin(['<NA>','nan'])
+    is_int = ~is_na & text.str.isnumeric()
+    is_float = ~is_na & ~is_int & text.str.contains('.', regex=False)
+    is_sl = ~is_na & ~is_int & ~is_float & (column == 'sl')
+    out[is_na] = pandas.NA
+    for rows, converted, converted_type in [(is_int, pandas.to_numeric(text[is_int], errors='coerce'), 'int64'),
+                                            (is_float, pandas.to_numeric(text[is_float].str.strip(), errors='coerce'), 'float64'),
+                                            (is_sl, pandas.to_numeric(text[is_sl].str[0], errors='coerce'), 'int64')]:
+        bad[rows] = converted.isna()
+        converted = converted.dropna()
+        out[converted.index] = converted.astype(converted_type).astype('object')
+    return out, bad
+
+
+#########################################################################################################################
+### RAWS NFDRS PERCENTILES AND 3-DAY TRENDS
+#########################################################################################################################
+
+def process_stations(raws_update_sdf, raws2psa_df, percentile_lookup, wims_urls, wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs,
+                     skip_stations=()):
+    '''
+    Determine RAWS percentiles and trends, filling in raws_update_sdf and raws2psa_df in place. Stations in
+    skip_stations (e.g. restored from checkpoints) are left as they are.
+    '''
+    print_both('\r')
+    print_both('RAWS NFDRS PERCENTILES AND 3-DAY TRENDS\r')
+
+    # Date parsing, filtering, deduplication and the observation join for all stations at once
+    nfdrs_obs_long, fcast_long, stack_errors = stack_wims(*[{k: v for k, v in d.items() if k not in skip_stations}
+                                                           for d in [wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs]])
+
+    # Stations to process, in the order of the RAWS service
+    raws_stations = raws_update_sdf['NWSID_Clean'].astype('object')
+    raws_todo = ~raws_stations.isin(list(skip_stations))
+    stations = pandas.Index(raws_stations[raws_todo].unique())
+    fuel_models = pandas.Series(raws_update_sdf['FuelModelCode'].values, index=raws_stations)
+    fuel_models = fuel_models.loc[~fuel_models.index.duplicated()].reindex(stations) # WIMS values are in the station's fuel model
+
+    # Stations without all WIMS downloads, or without prepared data (see stack_wims()) are not processed
+    station_errors = pandas.Series(stack_errors, dtype='object').reindex(stations)
+    station_errors.loc[[stn for stn in stations if any(d.get(stn) is None for d in [wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs])]] = 'WIMS DATA NOT DOWNLOADED'
+    failed = station_errors.notna()
+
+    # First, second and latest records of each station, only the latest observed day if it is the run day counts
+    (obs_first, obs_second, obs_last), obs_count = station_rows(nfdrs_obs_long, stations)
+    (fcast_first, fcast_second, _), fcast_count = station_rows(fcast_long, stations)
+    has_today = (obs_last['nfdr_dt'] == datetime_today.strftime('%m/%d/%Y'))
+    has_tomorrow = (fcast_first['nfdr_dt'] == datetime_tomorrow.strftime('%m/%d/%Y'))
+
+
+    #################################################################################################################
+    ### DETERMINE RAWS ERC/BI PERCENTILES AND 3-DAY TRENDS
+    #################################################################################################################
+
+    # Each step below used to run station by station in this order, a value that cannot be read stops the station there
+    # (steps before it have already filled in raws2psa_df)
+    results = {}
+    steps = []
+    for component, field in [('ERC','ec'), ('BI','bi')]:
+
+        # Percentile of the latest observed value, if it is from the run day
+        latest, latest_bad = wims_floats(obs_last[field])
+        results[field + '_percentile'] = pandas.Series(percentile_lookup.lookup(stations, [component] * len(stations), latest,
+                                                                                fuel_models=fuel_models), index=stations).where(has_today)
+        steps.append((has_today, latest_bad, obs_last[field], {component + '_per': results[field + '_percentile']}))
+
+        # Observed trend from the first to the second day, if both values are there
+        initial, initial_bad = wims_floats(obs_first[field])
+        final, final_bad = wims_floats(obs_second[field])
+        trend_rows = has_today & (obs_count >= 2) & obs_first[field].notna() & obs_second[field].notna()
+        results[field + '_diff'] = (final - initial).where(trend_rows)
+        results[field + '_trend'] = categorize_trends(results[field + '_diff'], 3)
+        steps.append((trend_rows, initial_bad | final_bad, obs_first[field].where(initial_bad, obs_second[field]),
+                      {component + '_initial': initial, component + '_final': final}))
+
+        # Percentile of tomorrow's forecast value
+        fcast, fcast_bad = wims_floats(fcast_first[field])
+        results[field + '_fcast'] = fcast.where(has_tomorrow)
+        results[field + '_fcast_percentile'] = pandas.Series(percentile_lookup.lookup(stations, [component] * len(stations), fcast,
+                                                                                      fuel_models=fuel_models), index=stations).where(has_tomorrow)
+        steps.append((has_tomorrow, fcast_bad, fcast_first[field], {component + '_fcast_per': results[field + '_fcast_percentile']}))
+
+        # Forecast trend from tomorrow to three days out, if both values are there
+        fcast_initial, fcast_initial_bad = wims_floats(fcast_first[field])
+        fcast_final, fcast_final_bad = wims_floats(fcast_second[field])
+        fcast_trend_rows = (fcast_count >= 2) & fcast_first[field].notna() & fcast_second[field].notna()
+        results[field + '_fcast_diff'] = (fcast_final - fcast_initial).where(fcast_trend_rows)
+        results[field + '_fcast_trend'] = categorize_trends(results[field + '_fcast_diff'], 3)
+        steps.append((fcast_trend_rows, fcast_initial_bad | fcast_final_bad, fcast_first[field].where(fcast_initial_bad, fcast_second[field]),
+                      {component + '_fcast_initial': fcast_initial, component + '_fcast_final': fcast_final}))
+
+    # Save to data frame for calculating PSA averages, percentiles only where there is one
+    r2p_stations = raws2psa_df['StationID'].astype('object')
+    for step_rows, step_bad, step_values, r2p_values in steps:
+        step_done = step_rows & ~step_bad & ~failed
+        step_failed = step_rows & step_bad & ~failed
+        station_errors[step_failed] = step_values[step_failed].map(float_error)
+        for r2p_column, values in r2p_values.items():
+            values = values[step_done & values.notna()] if r2p_column.endswith('_per') else values[step_done]
+            r2p_rows = r2p_stations.isin(values.index)
+            raws2psa_df.loc[r2p_rows, r2p_column] = r2p_stations[r2p_rows].map(values).astype('Float32')
+        failed = failed | step_failed
+
+    # Percentiles of stations with values and without a percentile table for them
+    for component, field in [('ERC','ec'), ('BI','bi')]:
+        no_percentile = (has_today & ~failed & results[field + '_percentile'].isna()).sum()
+        if(no_percentile > 0):
+            print_both('.UNABLE TO DETERMINE ' + component + ' PERCENTILE FOR ' + str(no_percentile) + ' STATIONS\r')
+    for stn, station_error in station_errors.dropna().items():
+        print_both('..ERROR: %s, INSERTING NULL VALUES INTO FEATURE SERVICE\r', station_error, level='ERROR', station=stn)
+    if(log_enabled('DEBUG') == True):
+        for stn in stations[has_today & ~failed]:
+            print_both('.%s ERC TREND %s (%s), BI TREND %s (%s)\r', stn, results['ec_trend'][stn], results['ec_diff'][stn],
+                       results['bi_trend'][stn], results['bi_diff'][stn], level='DEBUG', station=stn)
+
+
+    #############################################################################################
+    ### INSERT VALUES INTO RAWS UPDATE DATAFRAME
+    #############################################################################################
+
+    # Stations with run day data get the URLs, the results and the latest WIMS values, stations with errors get the URLs
+    # only and stations without run day data get NA
+    print_both('.INSERTING VALUES INTO UPDATE DATAFRAME\r')
+    updated = has_today & ~failed
+    urls = {'NFDRS_Data_URL': pandas.Series([wims_urls[stn]['nfdrs'] for stn in stations], index=stations, dtype='object'),
+            'Obs_Data_URL': pandas.Series([wims_urls[stn]['obs'] for stn in stations], index=stations, dtype='object')}
+    wims_columns = [c for c in nfdrs_obs_long.columns if c not in ['StationID','wims_row']]
+
+    # Columns in service order, a value that cannot be inserted leaves the station's later columns as they were
+    stopped = pandas.Series(False, index=stations)
+    column_errors = {}
+    for curr_column in [c for c in raws_update_sdf.columns if c not in RAWS_static_attrs]:
+        column_bad = pandas.Series(False, index=stations)
+        if(curr_column in urls):
+            values = urls[curr_column].where(updated | failed, pandas.NA)
+        elif(curr_column in RAWS_percentile_fields + RAWS_trend_fields + ['ec_fcast','bi_fcast']):
+            values = results[curr_column].where(updated)
+        elif(curr_column not in wims_columns):
+            values = pandas.Series(pandas.NA, index=stations, dtype='object')
         else:
-            curr_station_nfdrs_obs_df = curr_station_nfdrs_df
-
-        # Want only a single result for each day, and want to keep the record with the lowest 'mp' value (model priority).
-        # This is done by removing results that are duplicates based on date, and keeping only the first occurrence of the date.
-        # If there is a duplicate, it exists because the 'mp' value is different
-        curr_station_nfdrs_obs_df = curr_station_nfdrs_obs_df.drop_duplicates(subset='nfdr_dt',keep='first')
-        curr_station_nfdrs_fcast_df = curr_station_nfdrs_fcast_df.drop_duplicates(subset='nfdr_dt',keep='first')
-
-
-        #################################################################################################################
-        ### DETERMINE RAWS ERC PERCENTILE AND 3-DAY TRENDS
-        #################################################################################################################
-
-        print_both('..PROCESSING ERC\r')
-
-        # Create list of ERC values
-        curr_stationid_erc_list = list(curr_station_nfdrs_obs_df['ec'])
-        
-        ### Determine ERC Percentile if current day's data is available
-        latest_obs_datetime = max(curr_station_nfdrs_obs_df['nfdr_datetime'])
-        latest_obs_date_str = latest_obs_datetime.strftime('%Y%m%d')
-        
-        if(latest_obs_date_str == datetime_today.strftime('%Y%m%d')):
-
-            # Determine ERC Percentile
-            print_both('...DETERMINING ERC PERCENTILE\r')
-            latest_erc = float(list(curr_station_nfdrs_obs_df['ec'])[len(curr_station_nfdrs_obs_df['ec'])-1])
-            for k in range(0, len(erc_per)):
-
-                curr_erc_range_lowerbound = list(erc_per['GreaterThanEqualTo'])[k]
-                curr_erc_range_upperbound = list(erc_per['LessThan'])[k]
-                curr_erc_range_percentile = list(erc_per['Percentile'])[k]
-                if(curr_erc_range_lowerbound <= latest_erc < curr_erc_range_upperbound):
-                    curr_stationid_erc_percentile = curr_erc_range_percentile
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_per'] = curr_stationid_erc_percentile
-                    break
-
-                # If its the first iteration, and the erc value is lower than the lowerbound value, set erc percentile to 0
-                if(k == 0 and latest_erc < curr_erc_range_lowerbound):
-                    curr_stationid_erc_percentile = 0
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_per'] = curr_stationid_erc_percentile
-                    break
-
-                # If its the last iteration, and the erc value is higher than the upperbound value, set erc percentile to 100
-                if( (k == (len(erc_per) - 1)) and latest_erc > curr_erc_range_upperbound):
-                    curr_stationid_erc_percentile = 100
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_per'] = curr_stationid_erc_percentile
-                    break
-
-                # If its the last iteration, and no percentile has been found, warn user
-                if(k == (len(erc_per) - 1) ):
-                    print_both('....UNABLE TO DETERMINE ERC PERCENTILE FOR STATION ID: ' + curr_NWSID + ' (' + raws_update_sdf['StnName_Clean'][i] + ')\r')
-
-
-            # If have the last 3 days of data, determine trend
-            print_both('...DETERMINING ERC TREND (LAST 3-DAYS)\r')
-            if(len(curr_stationid_erc_list) < 2):
-                print_both('....DOES NOT HAVE 3 DAYS WORTH OF DATA, UNABLE TO DETERMINE TREND\r')
-                curr_stationid_erc_trend = pandas.NA
+            values, column_bad = wims_values(obs_last[curr_column], curr_column)
+            values = values.where(updated, pandas.NA)
+            column_bad = column_bad & updated
+        write = ~stopped & ~column_bad
+        raws_rows = raws_todo & raws_stations.isin(stations[write])
+        column_message = 'UNABLE TO CONVERT WIMS VALUE'
+        try:
+            raws_update_sdf.loc[raws_rows, curr_column] = raws_stations[raws_rows].map(values)
+        except Exception as e:
+            # The column cannot hold the WIMS values, only the NA of stations without run day values go in
+            column_bad = column_bad | (write & updated)
+            column_message = str(e)
+            raws_rows = raws_todo & raws_stations.isin(stations[write & ~updated])
+            raws_update_sdf.loc[raws_rows, curr_column] = pandas.NA
+        for stn in stations[column_bad & ~stopped]:
+            print_both('..COLUMN:' + curr_column + ' UNABLE TO INSERT VALUE, INSERTING NA: ' + column_message + '\r', level='WARNING', station=stn)
+            column_errors[stn] = [curr_column]
+        stopped = stopped | column_bad
+
+    # Checkpoint the results of the stations
+    if(toggle_checkpoint == True):
+        raws_results = raws_update_sdf.loc[raws_todo, [c for c in raws_update_sdf.columns if c not in RAWS_static_attrs]]
+        raws_results = raws_results.set_index(raws_stations[raws_todo])
+        raws_results = raws_results.loc[~raws_results.index.duplicated(),]
+        r2p_results = raws2psa_df.loc[r2p_stations.isin(stations), [c for c in raws2psa_df.columns if c not in ['StationID','StationName']]]
+        r2p_results = r2p_results.set_index(r2p_stations[r2p_stations.isin(stations)])
+        r2p_results = r2p_results.loc[~r2p_results.index.duplicated(),]
+        raws_records = dict(zip(raws_results.index, raws_results.to_dict('records')))
+        r2p_records = dict(zip(r2p_results.index, r2p_results.to_dict('records')))
+        for stn in stations:
+            write_checkpoint('result', stn, {'raws': raws_records.get(stn, {}), 'raws2psa': r2p_records.get(stn, {})})
+
+    # One summary record for each station
+    result_fields = [c for c in RAWS_percentile_fields + RAWS_trend_fields if c in raws_update_sdf.columns]
+    summary = raws_update_sdf.loc[raws_todo, result_fields].set_index(raws_stations[raws_todo])
+    summary = summary.loc[~summary.index.duplicated(),]
+    summary = summary.astype({c: 'float64' for c in result_fields if c in RAWS_percentile_fields}).round(2).astype('object')
+    summary = summary.where(summary.notna(), None)
+    for stn, station_results in zip(summary.index, summary.to_dict('records')):
+        log_context['station'] = stn
+        station_error = None if pandas.isna(station_errors[stn]) else station_errors[stn]
+        station_status = 'OK' if station_error is None and stn not in column_errors else 'ERROR'
+        print_both('.STATION ' + stn + ' ' + station_status + '\r', level='INFO' if station_status == 'OK' else 'WARNING',
+                   event='station_summary', status=station_status, error=station_error, column_errors=column_errors.get(stn, []),
+                   **station_results)
+
+    log_context['station'] = None
+    close_checkpoint()
+
+
+#####################################################################################################
+### PSA NFDRS PERCENTILES AND 3-DAY TRENDS
+#####################################################################################################
+
+def dirty_psas(allstations, raws2psa_df):
+    '''
+    PSAs that need to be re-aggregated: PSAs with member stations whose results changed since the last published run of
+    the same day, plus PSAs that were not published on that run. Returns None if every PSA needs to be updated. The PSAs
+    sent to the service are chosen after all PSA stages by changed_psas().
+    '''
+    if(not os.path.exists(psa_state_path)):
+        return None
+    psa_state = pandas.read_pickle(psa_state_path)
+    if(psa_state['run_date'] != datetime_today.strftime('%Y%m%d')):
+        return None
+
+    # Stations with any changed value, a missing value on both runs is not a change
+    curr_df = raws2psa_df.drop(columns=['StationName']).astype({'StationID': str}).set_index('StationID')
+    prev_df = psa_state['raws2psa'].drop(columns=['StationName']).astype({'StationID': str}).set_index('StationID')
+    prev_df = prev_df.reindex(index=curr_df.index, columns=curr_df.columns)
+    same = (curr_df == prev_df).fillna(False) | (curr_df.isna() & prev_df.isna())
+    changed_stations = curr_df.index[~same.all(axis=1) | ~curr_df.index.isin(psa_state['raws2psa']['StationID'].astype(str))]
+
+    # Stations -> PSAs
+    changed_psas = set(allstations.loc[allstations['StationID'].astype(str).isin(changed_stations),'PSA'].astype(str).tolist())
+    all_psas = set(allstations['PSA'].astype(str).tolist())
+    return changed_psas | (all_psas - psa_state['published_psas'])
+
+def changed_psas(psa_update_sdf):
+    '''
+    PSAs to publish: PSAs with any dynamic field (every field not in PSA_static_attrs, including those of the forecast
+    spread, trend windows and fuel models) changed since the last published run of the same day, plus PSAs that were not
+    published on that run. Returns None if every PSA needs to be published.
+    '''
+    if(not os.path.exists(psa_state_path)):
+        return None
+    psa_state = pandas.read_pickle(psa_state_path)
+    if(psa_state['run_date'] != datetime_today.strftime('%Y%m%d') or 'psa' not in psa_state):
+        return None
+
+    # PSAs with any changed value, a missing value on both runs is not a change
+    psa_fields = [c for c in psa_update_sdf.columns if c not in PSA_static_attrs]
+    curr_df = psa_update_sdf[['PSANationalCode'] + psa_fields].astype({'PSANationalCode': str}).set_index('PSANationalCode')
+    prev_df = psa_state['psa'].astype({'PSANationalCode': str}).set_index('PSANationalCode')
+    prev_df = prev_df.reindex(index=curr_df.index, columns=curr_df.columns)
+    same = pandas.DataFrame({c: (curr_df[c].astype('object') == prev_df[c].astype('object')).fillna(False).astype(bool) |
+                                (curr_df[c].isna() & prev_df[c].isna()) for c in psa_fields}, index=curr_df.index)
+    changed = set(curr_df.index[~same.all(axis=1) | ~curr_df.index.isin(psa_state['psa']['PSANationalCode'].astype(str))])
+    return changed | (set(curr_df.index) - psa_state['published_psas'])
+
+def save_psa_state(raws2psa_df, psa_update_sdf, psas, psa_published):
+    '''Save the station results, the PSA values and the PSAs published on this run for the next incremental update.'''
+    psa_published = set(psa_published)
+    if(psas is not None and os.path.exists(psa_state_path)):
+        # PSAs that were clean this run keep their published state
+        psa_published = psa_published | (pandas.read_pickle(psa_state_path)['published_psas'] - set(psas))
+    psa_fields = [c for c in psa_update_sdf.columns if c not in PSA_static_attrs]
+    psa_state = {'run_date': datetime_today.strftime('%Y%m%d'), 'raws2psa': raws2psa_df.copy(), 'published_psas': psa_published,
+                 'psa': pandas.DataFrame(psa_update_sdf[['PSANationalCode'] + psa_fields])}
+    pandas.to_pickle(psa_state, psa_state_path + '.tmp')
+    os.replace(psa_state_path + '.tmp', psa_state_path)
+
+def process_psas(allstations, raws2psa_df, psa_update_sdf, psas=None):
+    '''
+    Aggregate RAWS percentiles and trends to PSAs, filling in psa_update_sdf in place. If psas is given only those PSAs
+    are aggregated and the rest are left as they are.
+    '''
+    print_both('\r')
+    print_both('PSA NFDRS PERCENTILES AND 3-DAY TRENDS\r')
+
+    # Get list of PSAs to update
+    PSAs = sorted(list(set(allstations['PSA'].tolist())))
+    PSAs = [PSA for PSA in PSAs if PSA != 'Non-PSA'] # Ignore non-PSA stations
+    if(psas is not None):
+        print_both('.' + str(len([PSA for PSA in PSAs if PSA in psas])) + ' OF ' + str(len(PSAs)) + ' PSAS WITH CHANGED STATIONS\r')
+        PSAs = [PSA for PSA in PSAs if PSA in psas]
+
+    for i in range(0, len(PSAs)):
+
+        print_both('.Processing PSA %s\r', PSAs[i], level='DEBUG')
+
+        try:
+
+            # Get list of RAWS in PSA
+            RAWS_list = allstations.loc[allstations['PSA'] == PSAs[i],'StationID'].tolist()
+
+            # Loop through each station in the PSA
+            curr_psa_raws_df = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),]
+            curr_psa_erc_initial_list = curr_psa_raws_df['ERC_initial'].dropna().tolist()
+            curr_psa_erc_final_list = curr_psa_raws_df['ERC_final'].dropna().tolist()
+            curr_psa_erc_percentile_list = curr_psa_raws_df['ERC_per'].dropna().tolist()
+            curr_psa_erc_1day_fcast_percentile_list = curr_psa_raws_df['ERC_fcast_per'].dropna().tolist()
+            curr_psa_erc_3day_fcast_initial_list = curr_psa_raws_df['ERC_fcast_initial'].dropna().tolist()
+            curr_psa_erc_3day_fcast_final_list = curr_psa_raws_df['ERC_fcast_final'].dropna().tolist()
+            curr_psa_bi_initial_list = curr_psa_raws_df['BI_initial'].dropna().tolist()
+            curr_psa_bi_final_list = curr_psa_raws_df['BI_final'].dropna().tolist()
+            curr_psa_bi_percentile_list = curr_psa_raws_df['BI_per'].dropna().tolist()
+            curr_psa_bi_1day_fcast_percentile_list = curr_psa_raws_df['BI_fcast_per'].dropna().tolist()
+            curr_psa_bi_3day_fcast_initial_list = curr_psa_raws_df['BI_fcast_initial'].dropna().tolist()
+            curr_psa_bi_3day_fcast_final_list = curr_psa_raws_df['BI_fcast_final'].dropna().tolist()
+
+            ### ERC ####
+
+            # Calculate the PSA average ERC Percentile
+            if(len(curr_psa_erc_percentile_list) > 0):
+                curr_psa_avg_erc_percentile = statistics.mean(curr_psa_erc_percentile_list)
+                curr_psa_avg_erc_percentile_round = round(curr_psa_avg_erc_percentile, 2)
+                print_both('..PSA ERC PER MEAN: %s\r', curr_psa_avg_erc_percentile_round)
+            else:
+                curr_psa_avg_erc_percentile_round = pandas.NA
+                print_both('..PSA ERC PER MEAN: NO OBSERVATIONS\r')
+
+            # Calculate the PSA average ERC Forecast Percentile
+            if(len(curr_psa_erc_1day_fcast_percentile_list) > 0):
+                curr_psa_avg_erc_1day_fcast_percentile = statistics.mean(curr_psa_erc_1day_fcast_percentile_list)
+                curr_psa_avg_erc_1day_fcast_percentile_round = round(curr_psa_avg_erc_1day_fcast_percentile, 2)
+                print_both('..PSA ERC PER FORECAST MEAN: %s\r', curr_psa_avg_erc_1day_fcast_percentile_round)
             else:
-                # Get initial and final ERC value
-                curr_station_erc_initial = float(curr_stationid_erc_list[0])
-                curr_station_erc_final = float(curr_stationid_erc_list[1])
+                curr_psa_avg_erc_1day_fcast_percentile_round = pandas.NA
+                print_both('..PSA ERC PER FORECAST MEAN: NO OBSERVATIONS\r')
 
-                # Determine ERC trend
-                curr_station_erc_diff = curr_station_erc_final - curr_station_erc_initial
-                curr_station_erc_diff_abs = abs(curr_station_erc_diff)
+            # Determine PSA ERC trend
+            if( (len(curr_psa_erc_initial_list) > 0) & (len(curr_psa_erc_final_list) > 0) ):
+                # First, get PSA initial and final average ERC (average of 1st day, and average of 3rd day)
+                curr_psa_erc_initial_avg = statistics.mean(curr_psa_erc_initial_list)
+                curr_psa_erc_final_avg = statistics.mean(curr_psa_erc_final_list)
+
+                # Now determine the difference between the average 1st day, and average 3rd day
+                curr_psa_erc_diff = curr_psa_erc_final_avg - curr_psa_erc_initial_avg
+                curr_psa_erc_diff_abs = abs(curr_psa_erc_diff)
 
                 # Increasing
-                if((curr_station_erc_final - curr_station_erc_initial) >= 3):
-                    curr_stationid_erc_trend = 'Increase'
-                    print_both('....TRENDING: ' + curr_stationid_erc_trend + ' (UP ' + str(round(curr_station_erc_diff_abs, 1)) + ')\r')
+                if((curr_psa_erc_final_avg - curr_psa_erc_initial_avg) >= 3):
+                    curr_psa_erc_trend = 'Increase'
+                    print_both('..PSA ERC TRENDING: %s (UP %s)\r', curr_psa_erc_trend, round(curr_psa_erc_diff_abs, 1))
 
                 # Decreasing
-                if((curr_station_erc_final - curr_station_erc_initial) <= -3):
-                    curr_stationid_erc_trend = 'Decrease'
-                    print_both('....TRENDING: ' + curr_stationid_erc_trend + ' (DOWN ' + str(round(curr_station_erc_diff_abs, 1)) + ')\r')
+                if((curr_psa_erc_final_avg - curr_psa_erc_initial_avg) <= -3):
+                    curr_psa_erc_trend = 'Decrease'
+                    print_both('..PSA ERC TRENDING: %s (DOWN %s)\r', curr_psa_erc_trend, round(curr_psa_erc_diff_abs, 1))
 
                 # No Change
-                if(curr_station_erc_diff_abs < 3):
-                    curr_stationid_erc_trend = 'No Change'
-                    if(curr_station_erc_diff > 0):
-                        print_both('....TRENDING: ' + curr_stationid_erc_trend + ' (UP ' + str(round(curr_station_erc_diff_abs, 1)) + ')\r')
-                    if(curr_station_erc_diff < 0):
-                        print_both('....TRENDING: ' + curr_stationid_erc_trend + ' (DOWN ' + str(round(curr_station_erc_diff_abs, 1)) + ')\r')
-                    if(curr_station_erc_diff == 0):
-                        print_both('....TRENDING: ' + curr_stationid_erc_trend + ' (' + str(round(curr_station_erc_diff_abs, 1)) + ')\r')
-
-                # Save to data frame for calculating PSA average
-                raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_initial'] = curr_station_erc_initial
-                raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_final'] = curr_station_erc_final
+                if(curr_psa_erc_diff_abs < 3):
+                    curr_psa_erc_trend = 'No Change'
+                    if(curr_psa_erc_diff > 0):
+                        print_both('..PSA ERC TRENDING: %s (UP %s)\r', curr_psa_erc_trend, round(curr_psa_erc_diff_abs, 1))
+                    if(curr_psa_erc_diff < 0):
+                        print_both('..PSA ERC TRENDING: %s (DOWN %s)\r', curr_psa_erc_trend, round(curr_psa_erc_diff_abs, 1))
+                    if(curr_psa_erc_diff == 0):
+                        print_both('..PSA ERC TRENDING: %s (%s)\r', curr_psa_erc_trend, round(curr_psa_erc_diff_abs, 1))
+            else:
+                # Set to NA
+                curr_psa_erc_trend = pandas.NA
+                print_both('..PSA ERC TRENDING: NOT ENOUGH OBSERVATIONS TO CALCULATE TREND\r')
 
-        else:
-            # Failed the current date test
-            print_both('...NO NEW ERC DATA AVAILABLE FOR TODAY\r')
-
-        
-        ### Determine 1-Day Forecast ERC Percentile, if tomorrow's forecasted data is available
-        if(curr_station_nfdrs_fcast_df.shape[0] > 0):
-            fcast_obs_datetime = min(curr_station_nfdrs_fcast_df['nfdr_datetime'])
-            fcast_obs_date_str = fcast_obs_datetime.strftime('%Y%m%d')
-        else:
-            fcast_erc = pandas.NA
-            curr_stationid_erc_1day_fcast_percentile = pandas.NA
-            fcast_obs_date_str = 'No Data'
-        if(fcast_obs_date_str == datetime_tomorrow.strftime('%Y%m%d')):
-
-            # Determine ERC Percentile
-            print_both('...DETERMINING ERC PERCENTILE (NEXT 1-DAY FORECAST)\r')
-            fcast_erc = float(list(curr_station_nfdrs_fcast_df['ec'])[0])
-            for k in range(0, len(erc_per)):
-
-                curr_erc_range_lowerbound = list(erc_per['GreaterThanEqualTo'])[k]
-                curr_erc_range_upperbound = list(erc_per['LessThan'])[k]
-                curr_erc_range_percentile = list(erc_per['Percentile'])[k]
-                if(curr_erc_range_lowerbound <= fcast_erc < curr_erc_range_upperbound):
-                    curr_stationid_erc_1day_fcast_percentile = curr_erc_range_percentile
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_fcast_per'] = curr_stationid_erc_1day_fcast_percentile
-                    break
-
-                # If its the first iteration, and the erc value is lower than the lowerbound value, set erc percentile to 0
-                if(k == 0 and fcast_erc < curr_erc_range_lowerbound):
-                    curr_stationid_erc_1day_fcast_percentile = 0
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_fcast_per'] = curr_stationid_erc_1day_fcast_percentile
-                    break
-
-                # If its the last iteration, and the erc value is higher than the upperbound value, set erc percentile to 100
-                if( (k == (len(erc_per) - 1)) and fcast_erc > curr_erc_range_upperbound):
-                    curr_stationid_erc_1day_fcast_percentile = 100
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_fcast_per'] = curr_stationid_erc_1day_fcast_percentile
-                    break
-
-                # If its the last iteration, and no percentile has been found, warn user
-                if(k == (len(erc_per) - 1) ):
-                    print_both('....UNABLE TO DETERMINE ERC PERCENTILE FOR STATION ID: ' + curr_NWSID + ' (' + raws_update_sdf['StnName_Clean'][i] + ')\r')
-
-
-        # Determine 3-day Forecast ERC Trend, if the next 3 days of forecasted data is available
-        print_both('...DETERMINING ERC TREND (NEXT 3-DAY FORECAST)\r')
-        if(curr_station_nfdrs_fcast_df.shape[0] < 2):
-            print_both('....DOES NOT HAVE 3 DAYS WORTH OF DATA, UNABLE TO DETERMINE FORECAST TREND\r')
-            curr_stationid_erc_fcast_trend = pandas.NA
-        else:
-            # Create list of forecasted ERC values
-            curr_stationid_erc_fcast_list = list(curr_station_nfdrs_fcast_df['ec'])
-        
-            # Get initial and final ERC forecast value
-            curr_station_erc_fcast_initial = float(curr_stationid_erc_fcast_list[0])
-            curr_station_erc_fcast_final = float(curr_stationid_erc_fcast_list[1])
-
-            # Determine ERC forecast trend
-            curr_station_erc_fcast_diff = curr_station_erc_fcast_final - curr_station_erc_fcast_initial
-            curr_station_erc_fcast_diff_abs = abs(curr_station_erc_fcast_diff)
-
-            # Increasing
-            if((curr_station_erc_fcast_final - curr_station_erc_fcast_initial) >= 3):
-                curr_stationid_erc_fcast_trend = 'Increase'
-                print_both('....TRENDING: ' + curr_stationid_erc_fcast_trend + ' (UP ' + str(round(curr_station_erc_fcast_diff_abs, 1)) + ')\r')
-
-            # Decreasing
-            if((curr_station_erc_fcast_final - curr_station_erc_fcast_initial) <= -3):
-                curr_stationid_erc_fcast_trend = 'Decrease'
-                print_both('....TRENDING: ' + curr_stationid_erc_fcast_trend + ' (DOWN ' + str(round(curr_station_erc_fcast_diff_abs, 1)) + ')\r')
-
-            # No Change
-            if(curr_station_erc_fcast_diff_abs < 3):
-                curr_stationid_erc_fcast_trend = 'No Change'
-                if(curr_station_erc_fcast_diff > 0):
-                    print_both('....TRENDING: ' + curr_stationid_erc_fcast_trend + ' (UP ' + str(round(curr_station_erc_fcast_diff_abs, 1)) + ')\r')
-                if(curr_station_erc_fcast_diff < 0):
-                    print_both('....TRENDING: ' + curr_stationid_erc_fcast_trend + ' (DOWN ' + str(round(curr_station_erc_fcast_diff_abs, 1)) + ')\r')
-                if(curr_station_erc_fcast_diff == 0):
-                    print_both('....TRENDING: ' + curr_stationid_erc_fcast_trend + ' (' + str(round(curr_station_erc_fcast_diff_abs, 1)) + ')\r')
-
-            # Save to data frame for calculating PSA average
-            raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_fcast_initial'] = curr_station_erc_fcast_initial
-            raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'ERC_fcast_final'] = curr_station_erc_fcast_final
-
-        
-        #################################################################################################################
-        ### DETERMINE RAWS BI PERCENTILE AND 3-DAY TREND
-        #################################################################################################################
-
-        print_both('..PROCESSING BI\r')
-
-        # Create list of BI values
-        curr_stationid_bi_list = list(curr_station_nfdrs_obs_df['bi'])
-
-        # Determine BI Percentile if current day's data is available
-        latest_obs_datetime = max(curr_station_nfdrs_obs_df['nfdr_datetime'])
-        latest_obs_date_str = latest_obs_datetime.strftime('%Y%m%d')
-        if(latest_obs_date_str == datetime_today.strftime('%Y%m%d')):
-
-            # Determine BI Percentile
-            print_both('...DETERMINING BI PERCENTILE\r')
-            latest_bi = float(list(curr_station_nfdrs_obs_df['bi'])[len(curr_station_nfdrs_obs_df['bi'])-1])
-            for k in range(0, len(bi_per)):
-
-                curr_bi_range_lowerbound = list(bi_per['GreaterThanEqualTo'])[k]
-                curr_bi_range_upperbound = list(bi_per['LessThan'])[k]
-                curr_bi_range_percentile = list(bi_per['Percentile'])[k]
-                if(curr_bi_range_lowerbound <= latest_bi < curr_bi_range_upperbound):
-                    curr_stationid_bi_percentile = curr_bi_range_percentile
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_per'] = curr_stationid_bi_percentile
-                    break
-
-                # If its the first iteration, and the bi value is lower than the lowerbound value, set bi percentile to 0
-                if(k == 0 and latest_bi < curr_bi_range_lowerbound):
-                    curr_stationid_bi_percentile = 0
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_per'] = curr_stationid_bi_percentile
-                    break
-
-                # If its the last iteration, and the bi value is higher than the upperbound value, set bi percentile to 100
-                if( (k == (len(bi_per) - 1)) and latest_bi > curr_bi_range_upperbound):
-                    curr_stationid_bi_percentile = 100
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_per'] = curr_stationid_bi_percentile
-                    break
-
-                # If its the last iteration, and no percentile has been found, warn user
-                if(k == (len(bi_per) - 1) ):
-                    print_both('....UNABLE TO DETERMINE BI PERCENTILE FOR STATION ID: ' + curr_NWSID + ' (' + raws_update_sdf['StnName_Clean'][i] + ')\r')
-
-
-            # If have the last 3 days of data, determine trend
-            print_both('...DETERMINING BI TREND (LAST 3-DAYS)\r')
-            if(len(curr_stationid_bi_list) < 2):
-                print_both('....DOES NOT HAVE 3 DAYS WORTH OF DATA, UNABLE TO DETERMINE TREND\r')
-                curr_stationid_bi_trend = pandas.NA
+            # Determine PSA ERC Forecast trend
+            if( (len(curr_psa_erc_3day_fcast_initial_list) > 0) & (len(curr_psa_erc_3day_fcast_final_list) > 0) ):              
+                # First, get PSA initial and final average ERC forecast (average of 1st day, and average of 3rd day)
+                curr_psa_erc_fcast_initial_avg = statistics.mean(curr_psa_erc_3day_fcast_initial_list)
+                curr_psa_erc_fcast_final_avg = statistics.mean(curr_psa_erc_3day_fcast_final_list)
+
+                # Now determine the difference between the average 1st day, and average 3rd day
+                curr_psa_erc_fcast_diff = curr_psa_erc_fcast_final_avg - curr_psa_erc_fcast_initial_avg
+                curr_psa_erc_fcast_diff_abs = abs(curr_psa_erc_fcast_diff)
+
+                # Increasing
+                if((curr_psa_erc_fcast_final_avg - curr_psa_erc_fcast_initial_avg) >= 3):
+                    curr_psa_erc_fcast_trend = 'Increase'
+                    print_both('..PSA ERC FORECAST TRENDING: %s (UP %s)\r', curr_psa_erc_fcast_trend, round(curr_psa_erc_fcast_diff_abs, 1))
+
+                # Decreasing
+                if((curr_psa_erc_fcast_final_avg - curr_psa_erc_fcast_initial_avg) <= -3):
+                    curr_psa_erc_fcast_trend = 'Decrease'
+                    print_both('..PSA ERC TRENDING: %s (DOWN %s)\r', curr_psa_erc_fcast_trend, round(curr_psa_erc_fcast_diff_abs, 1))
+
+                # No Change
+                if(curr_psa_erc_fcast_diff_abs < 3):
+                    curr_psa_erc_fcast_trend = 'No Change'
+                    if(curr_psa_erc_fcast_diff > 0):
+                        print_both('..PSA ERC FORECAST TRENDING: %s (UP %s)\r', curr_psa_erc_fcast_trend, round(curr_psa_erc_fcast_diff_abs, 1))
+                    if(curr_psa_erc_fcast_diff < 0):
+                        print_both('..PSA ERC FORECAST TRENDING: %s (DOWN %s)\r', curr_psa_erc_fcast_trend, round(curr_psa_erc_fcast_diff_abs, 1))
+                    if(curr_psa_erc_fcast_diff == 0):
+                        print_both('..PSA ERC FORECAST TRENDING: %s (%s)\r', curr_psa_erc_fcast_trend, round(curr_psa_erc_fcast_diff_abs, 1))
+            else:
+                # Set to NA
+                curr_psa_erc_fcast_trend = pandas.NA
+                print_both('..PSA ERC FORECAST TRENDING: NOT ENOUGH OBSERVATIONS TO CALCULATE TREND\r')
+
+            # Insert the PSA average ERC Percentile, and Trend into 'psa_update_sdf' dataframe
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_percentile'] = curr_psa_avg_erc_percentile_round
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_trend'] = curr_psa_erc_trend
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_fcast_percentile'] = curr_psa_avg_erc_1day_fcast_percentile_round
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_fcast_trend'] = curr_psa_erc_fcast_trend
+
+
+            ### BI ####
+
+            # Calculate the PSA average BI Percentile
+            if(len(curr_psa_bi_percentile_list) > 0):
+                curr_psa_avg_bi_percentile = statistics.mean(curr_psa_bi_percentile_list)
+                curr_psa_avg_bi_percentile_round = round(curr_psa_avg_bi_percentile, 2)
+                print_both('..PSA BI PER MEAN: %s\r', curr_psa_avg_bi_percentile_round)
+            else:
+                curr_psa_avg_bi_percentile_round = pandas.NA
+                print_both('..PSA BI PER MEAN: NO OBSERVATIONS\r')
+
+            # Calculate the PSA average BI Forecast Percentile
+            if(len(curr_psa_bi_1day_fcast_percentile_list) > 0):
+                curr_psa_avg_bi_1day_fcast_percentile = statistics.mean(curr_psa_bi_1day_fcast_percentile_list)
+                curr_psa_avg_bi_1day_fcast_percentile_round = round(curr_psa_avg_bi_1day_fcast_percentile, 2)
+                print_both('..PSA BI PER FORECAST MEAN: %s\r', curr_psa_avg_bi_1day_fcast_percentile_round)
             else:
-                # Get initial and final BI value
-                curr_station_bi_initial = float(curr_stationid_bi_list[0])
-                curr_station_bi_final = float(curr_stationid_bi_list[1])
+                curr_psa_avg_bi_1day_fcast_percentile_round = pandas.NA
+                print_both('..PSA BI PER FORECAST MEAN: NO OBSERVATIONS\r')
 
-                # Determine BI trend
-                curr_station_bi_diff = curr_station_bi_final - curr_station_bi_initial
-                curr_station_bi_diff_abs = abs(curr_station_bi_diff)
+            # Determine PSA BI trend
+            if( (len(curr_psa_bi_initial_list) > 0) & (len(curr_psa_bi_final_list) > 0) ):
+                # First, get PSA initial and final average BI (average of 1st day, and average of 3rd day)
+                curr_psa_bi_initial_avg = statistics.mean(curr_psa_bi_initial_list)
+                curr_psa_bi_final_avg = statistics.mean(curr_psa_bi_final_list)
+
+                # Now determine the difference between the average 1st day, and average 3rd day
+                curr_psa_bi_diff = curr_psa_bi_final_avg - curr_psa_bi_initial_avg
+                curr_psa_bi_diff_abs = abs(curr_psa_bi_diff)
 
                 # Increasing
-                if((curr_station_bi_final - curr_station_bi_initial) >= 3):
-                    curr_stationid_bi_trend = 'Increase'
-                    print_both('....TRENDING: ' + curr_stationid_bi_trend + ' (UP ' + str(round(curr_station_bi_diff_abs, 1)) + ')\r')
+                if((curr_psa_bi_final_avg - curr_psa_bi_initial_avg) >= 3):
+                    curr_psa_bi_trend = 'Increase'
+                    print_both('..PSA BI TRENDING: %s (UP %s)\r', curr_psa_bi_trend, round(curr_psa_bi_diff_abs, 1))
 
                 # Decreasing
-                if((curr_station_bi_final - curr_station_bi_initial) <= -3):
-                    curr_stationid_bi_trend = 'Decrease'
-                    print_both('....TRENDING: ' + curr_stationid_bi_trend + ' (DOWN ' + str(round(curr_station_bi_diff_abs, 1)) + ')\r')
+                if((curr_psa_bi_final_avg - curr_psa_bi_initial_avg) <= -3):
+                    curr_psa_bi_trend = 'Decrease'
+                    print_both('..PSA BI TRENDING: %s (DOWN %s)\r', curr_psa_bi_trend, round(curr_psa_bi_diff_abs, 1))
 
                 # No Change
-                if(curr_station_bi_diff_abs < 3):
-                    curr_stationid_bi_trend = 'No Change'
-                    if(curr_station_bi_diff > 0):
-                        print_both('....TRENDING: ' + curr_stationid_bi_trend + ' (UP ' + str(round(curr_station_bi_diff_abs, 1)) + ')\r')
-                    if(curr_station_bi_diff < 0):
-                        print_both('....TRENDING: ' + curr_stationid_bi_trend + ' (DOWN ' + str(round(curr_station_bi_diff_abs, 1)) + ')\r')
-                    if(curr_station_bi_diff == 0):
-                        print_both('....TRENDING: ' + curr_stationid_bi_trend + ' (' + str(round(curr_station_bi_diff_abs, 1)) + ')\r')
-
-                # Save to data frame for calculating PSA average
-                raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_initial'] = curr_station_bi_initial
-                raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_final'] = curr_station_bi_final
+                if(curr_psa_bi_diff_abs < 3):
+                    curr_psa_bi_trend = 'No Change'
+                    if(curr_psa_bi_diff > 0):
+                        print_both('..PSA BI TRENDING: %s (UP %s)\r', curr_psa_bi_trend, round(curr_psa_bi_diff_abs, 1))
+                    if(curr_psa_bi_diff < 0):
+                        print_both('..PSA BI TRENDING: %s (DOWN %s)\r', curr_psa_bi_trend, round(curr_psa_bi_diff_abs, 1))
+                    if(curr_psa_bi_diff == 0):
+                        print_both('..PSA BI TRENDING: %s (%s)\r', curr_psa_bi_trend, round(curr_psa_bi_diff_abs, 1))
+            else:
+                # Set to NA
+                curr_psa_bi_trend = pandas.NA
+                print_both('..PSA BI TRENDING: NOT ENOUGH OBSERVATIONS TO CALCULATE TREND\r')
 
-        else:
-            # Failed the current date test
-            print_both('...NO NEW BI DATA AVAILABLE FOR TODAY\r')
-
-        
-        ### Determine 1-Day Forecast BI Percentile, if tomorrow's forecasted data is available
-        if(curr_station_nfdrs_fcast_df.shape[0] > 0):
-            fcast_obs_datetime = min(curr_station_nfdrs_fcast_df['nfdr_datetime'])
-            fcast_obs_date_str = fcast_obs_datetime.strftime('%Y%m%d')
-        else:
-            fcast_bi = pandas.NA
-            curr_stationid_bi_1day_fcast_percentile = pandas.NA
-            fcast_obs_date_str = 'No Data'
-        if(fcast_obs_date_str == datetime_tomorrow.strftime('%Y%m%d')):
-
-            # Determine BI Percentile
-            print_both('...DETERMINING BI PERCENTILE (NEXT 1-DAY FORECAST)\r')
-            fcast_bi = float(list(curr_station_nfdrs_fcast_df['bi'])[0])
-            for k in range(0, len(bi_per)):
-
-                curr_bi_range_lowerbound = list(bi_per['GreaterThanEqualTo'])[k]
-                curr_bi_range_upperbound = list(bi_per['LessThan'])[k]
-                curr_bi_range_percentile = list(bi_per['Percentile'])[k]
-                if(curr_bi_range_lowerbound <= fcast_bi < curr_bi_range_upperbound):
-                    curr_stationid_bi_1day_fcast_percentile = curr_bi_range_percentile
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_fcast_per'] = curr_stationid_bi_1day_fcast_percentile
-                    break
-
-                # If its the first iteration, and the bi value is lower than the lowerbound value, set bi percentile to 0
-                if(k == 0 and fcast_bi < curr_bi_range_lowerbound):
-                    curr_stationid_bi_1day_fcast_percentile = 0
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_fcast_per'] = curr_stationid_bi_1day_fcast_percentile
-                    break
-
-                # If its the last iteration, and the bi value is higher than the upperbound value, set bi percentile to 100
-                if( (k == (len(bi_per) - 1)) and fcast_bi > curr_bi_range_upperbound):
-                    curr_stationid_bi_1day_fcast_percentile = 100
-                    raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_fcast_per'] = curr_stationid_bi_1day_fcast_percentile
-                    break
-
-                # If its the last iteration, and no percentile has been found, warn user
-                if(k == (len(bi_per) - 1) ):
-                    print_both('....UNABLE TO DETERMINE BI PERCENTILE FOR STATION ID: ' + curr_NWSID + ' (' + raws_update_sdf['StnName_Clean'][i] + ')\r')
-
-        # Determine 3-day Forecast BI Trend, if the next 3 days of forecasted data is available
-        print_both('...DETERMINING BI TREND (NEXT 3-DAY FORECAST)\r')
-        if(curr_station_nfdrs_fcast_df.shape[0] < 2):
-            print_both('....DOES NOT HAVE 3 DAYS WORTH OF DATA, UNABLE TO DETERMINE FORECAST TREND\r')
-            curr_stationid_bi_fcast_trend = pandas.NA
-        else:
-            # Create list of forecasted BI values
-            curr_stationid_bi_fcast_list = list(curr_station_nfdrs_fcast_df['bi'])
-        
-            # Get initial and final BI forecast value
-            curr_station_bi_fcast_initial = float(curr_stationid_bi_fcast_list[0])
-            curr_station_bi_fcast_final = float(curr_stationid_bi_fcast_list[1])
-
-            # Determine BI forecast trend
-            curr_station_bi_fcast_diff = curr_station_bi_fcast_final - curr_station_bi_fcast_initial
-            curr_station_bi_fcast_diff_abs = abs(curr_station_bi_fcast_diff)
-
-            # Increasing
-            if((curr_station_bi_fcast_final - curr_station_bi_fcast_initial) >= 3):
-                curr_stationid_bi_fcast_trend = 'Increase'
-                print_both('....TRENDING: ' + curr_stationid_bi_fcast_trend + ' (UP ' + str(round(curr_station_bi_fcast_diff_abs, 1)) + ')\r')
-
-            # Decreasing
-            if((curr_station_bi_fcast_final - curr_station_bi_fcast_initial) <= -3):
-                curr_stationid_bi_fcast_trend = 'Decrease'
-                print_both('....TRENDING: ' + curr_stationid_bi_fcast_trend + ' (DOWN ' + str(round(curr_station_bi_fcast_diff_abs, 1)) + ')\r')
-
-            # No Change
-            if(curr_station_bi_fcast_diff_abs < 3):
-                curr_stationid_bi_fcast_trend = 'No Change'
-                if(curr_station_bi_fcast_diff > 0):
-                    print_both('....TRENDING: ' + curr_stationid_bi_fcast_trend + ' (UP ' + str(round(curr_station_bi_fcast_diff_abs, 1)) + ')\r')
-                if(curr_station_bi_fcast_diff < 0):
-                    print_both('....TRENDING: ' + curr_stationid_bi_fcast_trend + ' (DOWN ' + str(round(curr_station_bi_fcast_diff_abs, 1)) + ')\r')
-                if(curr_station_bi_fcast_diff == 0):
-                    print_both('....TRENDING: ' + curr_stationid_bi_fcast_trend + ' (' + str(round(curr_station_bi_fcast_diff_abs, 1)) + ')\r')
-
-            # Save to data frame for calculating PSA average
-            raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_fcast_initial'] = curr_station_bi_fcast_initial
-            raws2psa_df.loc[(raws2psa_df['StationID'] == curr_NWSID), 'BI_fcast_final'] = curr_station_bi_fcast_final
-        
-
-        #############################################################################################
-        ### INSERT VALUES INTO RAWS UPDATE DATAFRAME
-        #############################################################################################
-
-        # Create dataframe of latest observation values from WIMS
-        print_both('..INSERTING VALUES INTO UPDATE DATAFRAME\r')
-        max_datetime = max(curr_station_nfdrs_obs_df['nfdr_datetime'])
-        latest_stationid_df = curr_station_nfdrs_obs_df[curr_station_nfdrs_obs_df['nfdr_datetime'] == max_datetime]
-        wims_columns = list(latest_stationid_df.columns)
-
-        # Now loop through all columns of the raws_update_sdf, and insert the new values for the current station
-        raws_update_columns = list(raws_update_sdf.columns)
-        for k in range(0, len(raws_update_columns)):
-            try:
+            # Determine PSA BI Forecast trend
+            if( (len(curr_psa_bi_3day_fcast_initial_list) > 0) & (len(curr_psa_bi_3day_fcast_final_list) > 0) ):
+                # First, get PSA initial and final average BI forecast (average of 1st day, and average of 3rd day)
+                curr_psa_bi_fcast_initial_avg = statistics.mean(curr_psa_bi_3day_fcast_initial_list)
+                curr_psa_bi_fcast_final_avg = statistics.mean(curr_psa_bi_3day_fcast_final_list)
 
-                # Get current column, and it's value
-                curr_column = raws_update_columns[k]
+                # Now determine the difference between the average 1st day, and average 3rd day
+                curr_psa_bi_fcast_diff = curr_psa_bi_fcast_final_avg - curr_psa_bi_fcast_initial_avg
+                curr_psa_bi_fcast_diff_abs = abs(curr_psa_bi_fcast_diff)
 
-                # Skip any columns that aren't needed
-                if(curr_column in RAWS_static_attrs):
-                    continue
+                # Increasing
+                if((curr_psa_bi_fcast_final_avg - curr_psa_bi_fcast_initial_avg) >= 3):
+                    curr_psa_bi_fcast_trend = 'Increase'
+                    print_both('..PSA BI FORECAST TRENDING: %s (UP %s)\r', curr_psa_bi_fcast_trend, round(curr_psa_bi_fcast_diff_abs, 1))
 
-                # Enter NA into the 'raws_update_sdf' if there was a problem with the merge, or if there aren't any observations from WIMS for today
-                if( latest_obs_date_str != datetime_today.strftime('%Y%m%d') ):
-                    raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = pandas.NA
-                    continue
-                else:
-                    # If no issue with merge or observation date, insert actual value
-                    # If current column is any of the following fields that are not in WIMS, need to insert specific variable
-                    if(curr_column == 'NFDRS_Data_URL'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_nfdrs_url
-                        continue
-                    if(curr_column == 'Obs_Data_URL'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_obs_url
-                        continue
-                    if(curr_column == 'ec_percentile'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_erc_percentile
-                        continue
-                    if(curr_column == 'ec_trend'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_erc_trend
-                        continue
-                    if(curr_column == 'ec_fcast'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = fcast_erc
-                        continue
-                    if(curr_column == 'ec_fcast_percentile'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_erc_1day_fcast_percentile
-                        continue
-                    if(curr_column == 'ec_fcast_trend'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_erc_fcast_trend
-                        continue
-                    if(curr_column == 'bi_percentile'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_bi_percentile
-                        continue
-                    if(curr_column == 'bi_trend'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_bi_trend
-                        continue
-                    if(curr_column == 'bi_fcast'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = fcast_bi
-                        continue
-                    if(curr_column == 'bi_fcast_percentile'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_bi_1day_fcast_percentile
-                        continue
-                    if(curr_column == 'bi_fcast_trend'):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_bi_fcast_trend
-                        continue
-
-                    # If current column is not in WIMS, but is also not any of the fields above, Enter NA into the 'raws_update_sdf'
-                    if(curr_column not in wims_columns):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = pandas.NA
-                        continue
-
-                    # Otherwise, get the current value in WIMS for the column, and also get the type
-                    curr_value = latest_stationid_df[curr_column].iloc[0]
-                    curr_value_str = str(curr_value)
-                    curr_value_type = str(type(curr_value))
-
-                    # If value is NA, insert NA into 'raws_update_sdf'
-                    if(curr_value_str in ['<NA>', 'nan']):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = pandas.NA
-                        continue
-
-                    # If value is a pandas Timestamp type, insert as-is into 'raws_update_sdf'
-                    if('Timestamp' in curr_value_type):
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_value
-                        continue
-
-                    # If value is an integer, set to int before inserting into 'raws_update_sdf'
-                    if(curr_value_str.isnumeric()):
-                        curr_value = int(curr_value)
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_value
-                        continue
-
-                    # If value has a period, that means it is a float, set to float before inserting into 'raws_update_sdf'
-                    if('.' in curr_value_str):
-                        curr_value = float(curr_value)
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_value
-                        continue
-                    
-                    # If field is staffing level 'sl' only keep integer portion (first character)
-                    if(curr_column == 'sl'):
-                        curr_value = int(curr_value[0])
-                        raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_value
-                        continue
-                        
-                    # Otherwise, insert value as-is into 'raws_update_sdf'
-                    raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_value
-
-
-            except Exception as e:
-
-                print_both('...COLUMN:' + curr_column + '\r')
-                print_both('...UNABLE TO INSERT VALUE, INSERTING NA\r')
-                print_both('...' + str(e) + '\r')
-                break
-                raws_update_sdf.loc[(raws_update_sdf['NWSID'] == curr_NWSID), curr_column] = pandas.NA
-                
-    except Exception as e:
+                # Decreasing
+                if((curr_psa_bi_fcast_final_avg - curr_psa_bi_fcast_initial_avg) <= -3):
+                    curr_psa_bi_fcast_trend = 'Decrease'
+                    print_both('..PSA BI TRENDING: %s (DOWN %s)\r', curr_psa_bi_fcast_trend, round(curr_psa_bi_fcast_diff_abs, 1))
 
-        print_both('..ERROR:\r')
-        print_both(str(e))
-        print_both('\r')
-        print_both('..INSERTING NULL VALUES INTO FEATURE SERVICE\r')
+                # No Change
+                if(curr_psa_bi_fcast_diff_abs < 3):
+                    curr_psa_bi_fcast_trend = 'No Change'
+                    if(curr_psa_bi_fcast_diff > 0):
+                        print_both('..PSA BI FORECAST TRENDING: %s (UP %s)\r', curr_psa_bi_fcast_trend, round(curr_psa_bi_fcast_diff_abs, 1))
+                    if(curr_psa_bi_fcast_diff < 0):
+                        print_both('..PSA BI FORECAST TRENDING: %s (DOWN %s)\r', curr_psa_bi_fcast_trend, round(curr_psa_bi_fcast_diff_abs, 1))
+                    if(curr_psa_bi_fcast_diff == 0):
+                        print_both('..PSA BI FORECAST TRENDING: %s (%s)\r', curr_psa_bi_fcast_trend, round(curr_psa_bi_fcast_diff_abs, 1))
+
+                # Insert the PSA average BI Percentile, and Trend into 'psa_update_sdf' dataframe
+                psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_percentile'] = curr_psa_avg_bi_percentile_round
+                psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_trend'] = curr_psa_bi_trend
+                psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_fcast_percentile'] = curr_psa_avg_bi_1day_fcast_percentile_round
+                psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_fcast_trend'] = curr_psa_bi_fcast_trend
+            else:
+                # Set to NA
+                curr_psa_bi_fcast_trend = pandas.NA
+                print_both('..PSA BI FORECAST TRENDING: NOT ENOUGH OBSERVATIONS TO CALCULATE TREND\r')
 
-        # Now loop through all columns of the raws_update_sdf, and insert the values in for the current station
-        raws_update_columns = list(raws_update_sdf.columns)
-        for k in range(0, len(raws_update_columns)):
+            # Insert update date
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'nfdr_dt'] = datetime_today.strftime('%m/%d/%Y')
 
-                # Get current column, and it's value
-                curr_column = raws_update_columns[k]
+        except Exception as e:
 
-                # Skip any columns that aren't needed
-                if(curr_column in RAWS_static_attrs):
-                    continue
+            print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+            print_both('.INSERTING NULL VALUES INTO PSA UPDATE DATAFRAME\r')
 
-                # Enter the WIMS urls into the dataframe
-                if(curr_column == 'NFDRS_Data_URL'):
-                    raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_nfdrs_url
-                    continue
-                if(curr_column == 'Obs_Data_URL'):
-                    raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = curr_stationid_obs_url
-                    continue
+            # Insert NA into the PSA fields
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_percentile'] = pandas.NA
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_fcast_percentile'] = pandas.NA
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_trend'] = pandas.NA
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_fcast_trend'] = pandas.NA
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_percentile'] = pandas.NA
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_fcast_percentile'] = pandas.NA
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_trend'] = pandas.NA
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_fcast_trend'] = pandas.NA
 
-                # Insert NA for all other columns
-                raws_update_sdf.loc[(raws_update_sdf['NWSID_Clean'] == curr_NWSID), curr_column] = pandas.NA
+            # Insert update date
+            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'nfdr_dt'] = pandas.NA
 
-print_both('\r')
+
+#####################################################################################################
+### FORECAST PERCENTILE SPREAD
+#####################################################################################################
+
+def forecast_spread(allstations, raws_update_sdf, psa_update_sdf, percentile_lookup, wims_fcast_dfs):
+    '''
+    Spread of the next 1-day forecast ERC/BI percentiles across all model priority records, for all stations at once.
+    PSA values are means of the member station values. Fields with matching names in the update tables are filled in.
+    '''
+    print_both('\r')
+    print_both('FORECAST PERCENTILE SPREAD\r')
+
+    try:
+
+        # Stack tomorrow's forecast records of every station, keeping every model priority
+        fs_stations = {k: v[['nfdr_dt','mp','ec','bi']] for k, v in wims_fcast_dfs.items()
+                       if v is not None and set(['nfdr_dt','mp','ec','bi']).issubset(v.columns)}
+        if(len(fs_stations) == 0):
+            print_both('.NO FORECAST DATA\r')
+            return
+        fs_long = pandas.concat(fs_stations, names=['StationID','wims_row']).reset_index()
+        fs_long = fs_long.loc[fs_long['nfdr_dt'] == datetime_tomorrow.strftime('%m/%d/%Y'),]
+
+        # Percentile of every record in one lookup per index, in the station's fuel model, and the spread per station
+        fs_fuel_models = raws_update_sdf[['NWSID_Clean','FuelModelCode']].astype({'NWSID_Clean': str}).drop_duplicates(subset=['NWSID_Clean'])
+        fs_fuel_models = fs_long['StationID'].map(fs_fuel_models.set_index('NWSID_Clean')['FuelModelCode'])
+        fs_stats = []
+        for fs_comp, fs_col in [('ERC','ec'), ('BI','bi')]:
+            fs_per = pandas.Series(percentile_lookup.lookup(fs_long['StationID'], [fs_comp] * len(fs_long),
+                                                            pandas.to_numeric(fs_long[fs_col], errors='coerce'),
+                                                            fuel_models=fs_fuel_models), index=fs_long.index)
+            fs_grp = fs_per.groupby(fs_long['StationID'])
+            fs_stats.append(pandas.DataFrame({fs_col + '_fcast_per_min': fs_grp.min(), fs_col + '_fcast_per_med': fs_grp.median(),
+                                              fs_col + '_fcast_per_max': fs_grp.max(), fs_col + '_fcast_n': fs_grp.count()}))
+            for fs_t in fcast_spread_thresholds:
+                fs_above = fs_per.ge(fs_t).astype('float64').where(fs_per.notna())
+                fs_stats.append(fs_above.groupby(fs_long['StationID']).mean().rename(fs_col + '_fcast_frac_p' + str(fs_t)))
+        raws_spread_df = pandas.concat(fs_stats, axis=1).rename_axis('StationID').reset_index()
+
+        # PSA means of the station values
+        fs_psa = allstations.loc[allstations['PSA'] != 'Non-PSA', ['StationID','PSA']].astype(str)
+        fs_psa = fs_psa.merge(raws_spread_df, on='StationID', how='inner').drop(columns=['StationID'])
+        psa_spread_df = fs_psa.groupby('PSA').mean().round(2).add_prefix('avg_').reset_index()
+
+        # Fill in any matching service fields
+        fs_filled = []
+        for fs_df, fs_key, fs_sdf, fs_sdf_key in [(raws_spread_df, 'StationID', raws_update_sdf, 'NWSID_Clean'),
+                                                  (psa_spread_df, 'PSA', psa_update_sdf, 'PSANationalCode')]:
+            fs_fields = [c for c in fs_df.columns if c != fs_key and c in fs_sdf.columns]
+            for fs_field in fs_fields:
+                fs_sdf[fs_field] = fs_sdf[fs_sdf_key].astype(str).map(fs_df.set_index(fs_key)[fs_field])
+            fs_filled.append(str(len(fs_fields)))
+
+        raws_spread_df.to_csv(wdir + '/fcast_spread_raws.csv', index=False)
+        psa_spread_df.to_csv(wdir + '/fcast_spread_psa.csv', index=False)
+        print_both('.' + str(len(fs_long)) + ' FORECAST RECORDS FROM ' + str(len(raws_spread_df)) + ' STATIONS AND ' + str(len(psa_spread_df)) + ' PSAS\r')
+        print_both('.' + fs_filled[0] + ' RAWS AND ' + fs_filled[1] + ' PSA SERVICE FIELDS FILLED\r')
+
+    except Exception as e:
+
+        print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+        print_both('.UNABLE TO DETERMINE FORECAST PERCENTILE SPREAD\r')
 
 
 #####################################################################################################
-### PSA NFDRS PERCENTILES AND 3-DAY TRENDS
+### MULTI-WINDOW TRENDS
 #####################################################################################################
-print_both('\r')
-print_both('PSA NFDRS PERCENTILES AND 3-DAY TRENDS\r')
 
-# Get list of PSAs to update
-PSAs = sorted(list(set(allstations['PSA'].tolist())))
-PSAs = [PSA for PSA in PSAs if PSA != 'Non-PSA'] # Ignore non-PSA stations
+def categorize_trends(diff, threshold):
+    '''Increase (>= +threshold), Decrease (<= -threshold) or No Change for each difference, NA where it is missing.'''
+    trend = numpy.select([diff >= threshold, diff <= -threshold, diff.abs() < threshold], ['Increase','Decrease','No Change'], default='')
+    return pandas.Series(trend, index=diff.index).replace('', pandas.NA)
 
-for i in range(0, len(PSAs)):
+def window_trends(allstations, raws_update_sdf, psa_update_sdf, wims_nfdrs_dfs):
+    '''
+    Observed ERC/BI trends over each of trend_windows for all stations at once, from a station x date matrix of the
+    daily values (downloaded and stored). PSA trends use the mean of the member station differences.
+    '''
+    print_both('\r')
+    print_both('MULTI-WINDOW TRENDS\r')
 
-    print_both('.Processing PSA ' + PSAs[i] + '\r')
-    
     try:
 
-        # Get list of RAWS in PSA
-        RAWS_list = allstations.loc[allstations['PSA'] == PSAs[i],'StationID'].tolist()
-        
-        # Loop through each station in the PSA
-        curr_psa_erc_initial_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'ERC_initial'].dropna().tolist()
-        curr_psa_erc_final_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'ERC_final'].dropna().tolist()
-        curr_psa_erc_percentile_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'ERC_per'].dropna().tolist()
-        curr_psa_erc_1day_fcast_percentile_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'ERC_fcast_per'].dropna().tolist()
-        curr_psa_erc_3day_fcast_initial_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'ERC_fcast_initial'].dropna().tolist()
-        curr_psa_erc_3day_fcast_final_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'ERC_fcast_final'].dropna().tolist()
-        curr_psa_bi_initial_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'BI_initial'].dropna().tolist()
-        curr_psa_bi_final_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'BI_final'].dropna().tolist()
-        curr_psa_bi_percentile_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'BI_per'].dropna().tolist()
-        curr_psa_bi_1day_fcast_percentile_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'BI_fcast_per'].dropna().tolist()
-        curr_psa_bi_3day_fcast_initial_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'BI_fcast_initial'].dropna().tolist()
-        curr_psa_bi_3day_fcast_final_list = raws2psa_df.loc[raws2psa_df['StationID'].isin(RAWS_list),'BI_fcast_final'].dropna().tolist()
-        
-        ### ERC ####
-
-        # Calculate the PSA average ERC Percentile
-        if(len(curr_psa_erc_percentile_list) > 0):
-            curr_psa_avg_erc_percentile = statistics.mean(curr_psa_erc_percentile_list)
-            curr_psa_avg_erc_percentile_round = round(curr_psa_avg_erc_percentile, 2)
-            print_both('..PSA ERC PER MEAN: ' + str(curr_psa_avg_erc_percentile_round) + '\r')
-        else:
-            curr_psa_avg_erc_percentile_round = pandas.NA
-            print_both('..PSA ERC PER MEAN: NO OBSERVATIONS\r')
-            
-        # Calculate the PSA average ERC Forecast Percentile
-        if(len(curr_psa_erc_1day_fcast_percentile_list) > 0):
-            curr_psa_avg_erc_1day_fcast_percentile = statistics.mean(curr_psa_erc_1day_fcast_percentile_list)
-            curr_psa_avg_erc_1day_fcast_percentile_round = round(curr_psa_avg_erc_1day_fcast_percentile, 2)
-            print_both('..PSA ERC PER FORECAST MEAN: ' + str(curr_psa_avg_erc_1day_fcast_percentile_round) + '\r')
-        else:
-            curr_psa_avg_erc_1day_fcast_percentile_round = pandas.NA
-            print_both('..PSA ERC PER FORECAST MEAN: NO OBSERVATIONS\r')
-        
-        # Determine PSA ERC trend
-        if( (len(curr_psa_erc_initial_list) > 0) & (len(curr_psa_erc_final_list) > 0) ):
-            # First, get PSA initial and final average ERC (average of 1st day, and average of 3rd day)
-            curr_psa_erc_initial_avg = statistics.mean(curr_psa_erc_initial_list)
-            curr_psa_erc_final_avg = statistics.mean(curr_psa_erc_final_list)
-
-            # Now determine the difference between the average 1st day, and average 3rd day
-            curr_psa_erc_diff = curr_psa_erc_final_avg - curr_psa_erc_initial_avg
-            curr_psa_erc_diff_abs = abs(curr_psa_erc_diff)
-
-            # Increasing
-            if((curr_psa_erc_final_avg - curr_psa_erc_initial_avg) >= 3):
-                curr_psa_erc_trend = 'Increase'
-                print_both('..PSA ERC TRENDING: ' + curr_psa_erc_trend + ' (UP ' + str(round(curr_psa_erc_diff_abs, 1)) + ')\r')
-
-            # Decreasing
-            if((curr_psa_erc_final_avg - curr_psa_erc_initial_avg) <= -3):
-                curr_psa_erc_trend = 'Decrease'
-                print_both('..PSA ERC TRENDING: ' + curr_psa_erc_trend + ' (DOWN ' + str(round(curr_psa_erc_diff_abs, 1)) + ')\r')
-
-            # No Change
-            if(curr_psa_erc_diff_abs < 3):
-                curr_psa_erc_trend = 'No Change'
-                if(curr_psa_erc_diff > 0):
-                    print_both('..PSA ERC TRENDING: ' + curr_psa_erc_trend + ' (UP ' + str(round(curr_psa_erc_diff_abs, 1)) + ')\r')
-                if(curr_psa_erc_diff < 0):
-                    print_both('..PSA ERC TRENDING: ' + curr_psa_erc_trend + ' (DOWN ' + str(round(curr_psa_erc_diff_abs, 1)) + ')\r')
-                if(curr_psa_erc_diff == 0):
-                    print_both('..PSA ERC TRENDING: ' + curr_psa_erc_trend + ' (' + str(round(curr_psa_erc_diff_abs, 1)) + ')\r')
-        else:
-            # Set to NA
-            curr_psa_erc_trend = pandas.NA
-            print_both('..PSA ERC TRENDING: NOT ENOUGH OBSERVATIONS TO CALCULATE TREND\r')
-        
-        # Determine PSA ERC Forecast trend
-        if( (len(curr_psa_erc_3day_fcast_initial_list) > 0) & (len(curr_psa_erc_3day_fcast_final_list) > 0) ):              
-            # First, get PSA initial and final average ERC forecast (average of 1st day, and average of 3rd day)
-            curr_psa_erc_fcast_initial_avg = statistics.mean(curr_psa_erc_3day_fcast_initial_list)
-            curr_psa_erc_fcast_final_avg = statistics.mean(curr_psa_erc_3day_fcast_final_list)
-
-            # Now determine the difference between the average 1st day, and average 3rd day
-            curr_psa_erc_fcast_diff = curr_psa_erc_fcast_final_avg - curr_psa_erc_fcast_initial_avg
-            curr_psa_erc_fcast_diff_abs = abs(curr_psa_erc_fcast_diff)
-
-            # Increasing
-            if((curr_psa_erc_fcast_final_avg - curr_psa_erc_fcast_initial_avg) >= 3):
-                curr_psa_erc_fcast_trend = 'Increase'
-                print_both('..PSA ERC FORECAST TRENDING: ' + curr_psa_erc_fcast_trend + ' (UP ' + str(round(curr_psa_erc_fcast_diff_abs, 1)) + ')\r')
-
-            # Decreasing
-            if((curr_psa_erc_fcast_final_avg - curr_psa_erc_fcast_initial_avg) <= -3):
-                curr_psa_erc_fcast_trend = 'Decrease'
-                print_both('..PSA ERC TRENDING: ' + curr_psa_erc_fcast_trend + ' (DOWN ' + str(round(curr_psa_erc_fcast_diff_abs, 1)) + ')\r')
-
-            # No Change
-            if(curr_psa_erc_fcast_diff_abs < 3):
-                curr_psa_erc_fcast_trend = 'No Change'
-                if(curr_psa_erc_fcast_diff > 0):
-                    print_both('..PSA ERC FORECAST TRENDING: ' + curr_psa_erc_fcast_trend + ' (UP ' + str(round(curr_psa_erc_fcast_diff_abs, 1)) + ')\r')
-                if(curr_psa_erc_fcast_diff < 0):
-                    print_both('..PSA ERC FORECAST TRENDING: ' + curr_psa_erc_fcast_trend + ' (DOWN ' + str(round(curr_psa_erc_fcast_diff_abs, 1)) + ')\r')
-                if(curr_psa_erc_fcast_diff == 0):
-                    print_both('..PSA ERC FORECAST TRENDING: ' + curr_psa_erc_fcast_trend + ' (' + str(round(curr_psa_erc_fcast_diff_abs, 1)) + ')\r')
-        else:
-            # Set to NA
-            curr_psa_erc_fcast_trend = pandas.NA
-            print_both('..PSA ERC FORECAST TRENDING: NOT ENOUGH OBSERVATIONS TO CALCULATE TREND\r')
+        # Daily values of every station, keeping the record with the lowest model priority of each day
+        tw_stations = {k: v[['nfdr_dt','mp','ec','bi']] for k, v in wims_nfdrs_dfs.items()
+                       if v is not None and set(['nfdr_dt','mp','ec','bi']).issubset(v.columns)}
+        tw_cols = ['StationID','date','ec','bi']
+        tw_long = pandas.DataFrame(columns=tw_cols)
+        if(len(tw_stations) > 0):
+            tw_long = pandas.concat(tw_stations, names=['StationID','wims_row']).reset_index()
+            tw_long['date'] = pandas.to_datetime(tw_long['nfdr_dt'], format='%m/%d/%Y')
+            tw_long['mp'] = pandas.to_numeric(tw_long['mp'], errors='coerce')
+            tw_long[['ec','bi']] = tw_long[['ec','bi']].apply(pandas.to_numeric, errors='coerce')
+            tw_long = tw_long.sort_values(by=['StationID','date','mp']).drop_duplicates(subset=['StationID','date'], keep='first')[tw_cols]
+
+        # Fill in days missing from the download with the stored history, then store the combined history
+        if(os.path.exists(trend_history_path)):
+            tw_long = pandas.concat([tw_long, pandas.read_pickle(trend_history_path)]).drop_duplicates(subset=['StationID','date'], keep='first')
+        tw_long = tw_long.loc[tw_long['date'] > datetime_today - datetime.timedelta(days=trend_history_days),]
+        tw_long = tw_long.astype({'StationID': str, 'ec': 'float64', 'bi': 'float64'}).reset_index(drop=True)
+        pandas.to_pickle(tw_long, trend_history_path + '.tmp')
+        os.replace(trend_history_path + '.tmp', trend_history_path)
+
+        # Station x date matrix over the longest window, every day present so differences are over calendar days
+        tw_today = pandas.Timestamp(datetime_today.date())
+        tw_dates = pandas.date_range(tw_today - pandas.Timedelta(days=max(trend_windows)), tw_today, freq='D')
+        tw_ids = raws_update_sdf['NWSID_Clean'].astype(str).tolist()
+        raws_trend_df = pandas.DataFrame({'StationID': tw_ids})
+        for tw_col in ['ec','bi']:
+            tw_matrix = tw_long.pivot(index='StationID', columns='date', values=tw_col).reindex(index=tw_ids, columns=tw_dates)
+            for tw_days, tw_threshold in sorted(trend_windows.items()):
+                tw_diff = tw_matrix.diff(periods=tw_days, axis=1)[tw_today]
+                raws_trend_df[tw_col + '_diff_' + str(tw_days) + 'd'] = tw_diff.to_numpy()
+                raws_trend_df[tw_col + '_trend_' + str(tw_days) + 'd'] = categorize_trends(tw_diff, tw_threshold).to_numpy()
+
+        # PSA trends from the mean of the member station differences
+        tw_psa = allstations.loc[allstations['PSA'] != 'Non-PSA', ['StationID','PSA']].astype(str)
+        tw_diff_cols = [c for c in raws_trend_df.columns if '_diff_' in c]
+        tw_psa = tw_psa.merge(raws_trend_df[['StationID'] + tw_diff_cols], on='StationID', how='inner')
+        psa_trend_df = tw_psa.groupby('PSA')[tw_diff_cols].mean().round(2).add_prefix('avg_')
+        for tw_col in ['ec','bi']:
+            for tw_days, tw_threshold in sorted(trend_windows.items()):
+                psa_trend_df['avg_' + tw_col + '_trend_' + str(tw_days) + 'd'] = categorize_trends(
+                    psa_trend_df['avg_' + tw_col + '_diff_' + str(tw_days) + 'd'], tw_threshold)
+        psa_trend_df = psa_trend_df.reset_index()
+
+        # Fill in any matching service fields
+        tw_filled = []
+        for tw_df, tw_key, tw_sdf, tw_sdf_key in [(raws_trend_df, 'StationID', raws_update_sdf, 'NWSID_Clean'),
+                                                  (psa_trend_df, 'PSA', psa_update_sdf, 'PSANationalCode')]:
+            tw_fields = [c for c in tw_df.columns if c != tw_key and c in tw_sdf.columns]
+            for tw_field in tw_fields:
+                tw_sdf[tw_field] = tw_sdf[tw_sdf_key].astype(str).map(tw_df.set_index(tw_key)[tw_field])
+            tw_filled.append(str(len(tw_fields)))
+
+        raws_trend_df.to_csv(wdir + '/trend_windows_raws.csv', index=False)
+        psa_trend_df.to_csv(wdir + '/trend_windows_psa.csv', index=False)
+        print_both('.' + ', '.join(str(d) + '-DAY' for d in sorted(trend_windows)) + ' TRENDS FOR ' + str(len(raws_trend_df)) +
+                   ' STATIONS AND ' + str(len(psa_trend_df)) + ' PSAS\r')
+        print_both('.' + tw_filled[0] + ' RAWS AND ' + tw_filled[1] + ' PSA SERVICE FIELDS FILLED\r')
 
-        # Insert the PSA average ERC Percentile, and Trend into 'psa_update_sdf' dataframe
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_percentile'] = curr_psa_avg_erc_percentile_round
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_trend'] = curr_psa_erc_trend
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_fcast_percentile'] = curr_psa_avg_erc_1day_fcast_percentile_round
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_fcast_trend'] = curr_psa_erc_fcast_trend
+    except Exception as e:
 
+        print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+        print_both('.UNABLE TO DETERMINE MULTI-WINDOW TRENDS\r')
 
-        ### BI ####
 
-        # Calculate the PSA average BI Percentile
-        if(len(curr_psa_bi_percentile_list) > 0):
-            curr_psa_avg_bi_percentile = statistics.mean(curr_psa_bi_percentile_list)
-            curr_psa_avg_bi_percentile_round = round(curr_psa_avg_bi_percentile, 2)
-            print_both('..PSA BI PER MEAN: ' + str(curr_psa_avg_bi_percentile_round) + '\r')
-        else:
-            curr_psa_avg_bi_percentile_round = pandas.NA
-            print_both('..PSA BI PER MEAN: NO OBSERVATIONS\r')
-
-        # Calculate the PSA average BI Forecast Percentile
-        if(len(curr_psa_bi_1day_fcast_percentile_list) > 0):
-            curr_psa_avg_bi_1day_fcast_percentile = statistics.mean(curr_psa_bi_1day_fcast_percentile_list)
-            curr_psa_avg_bi_1day_fcast_percentile_round = round(curr_psa_avg_bi_1day_fcast_percentile, 2)
-            print_both('..PSA BI PER FORECAST MEAN: ' + str(curr_psa_avg_bi_1day_fcast_percentile_round) + '\r')
-        else:
-            curr_psa_avg_bi_1day_fcast_percentile_round = pandas.NA
-            print_both('..PSA BI PER FORECAST MEAN: NO OBSERVATIONS\r')
-            
-        # Determine PSA BI trend
-        if( (len(curr_psa_bi_initial_list) > 0) & (len(curr_psa_bi_final_list) > 0) ):
-            # First, get PSA initial and final average BI (average of 1st day, and average of 3rd day)
-            curr_psa_bi_initial_avg = statistics.mean(curr_psa_bi_initial_list)
-            curr_psa_bi_final_avg = statistics.mean(curr_psa_bi_final_list)
-
-            # Now determine the difference between the average 1st day, and average 3rd day
-            curr_psa_bi_diff = curr_psa_bi_final_avg - curr_psa_bi_initial_avg
-            curr_psa_bi_diff_abs = abs(curr_psa_bi_diff)
-
-            # Increasing
-            if((curr_psa_bi_final_avg - curr_psa_bi_initial_avg) >= 3):
-                curr_psa_bi_trend = 'Increase'
-                print_both('..PSA BI TRENDING: ' + curr_psa_bi_trend + ' (UP ' + str(round(curr_psa_bi_diff_abs, 1)) + ')\r')
-
-            # Decreasing
-            if((curr_psa_bi_final_avg - curr_psa_bi_initial_avg) <= -3):
-                curr_psa_bi_trend = 'Decrease'
-                print_both('..PSA BI TRENDING: ' + curr_psa_bi_trend + ' (DOWN ' + str(round(curr_psa_bi_diff_abs, 1)) + ')\r')
-
-            # No Change
-            if(curr_psa_bi_diff_abs < 3):
-                curr_psa_bi_trend = 'No Change'
-                if(curr_psa_bi_diff > 0):
-                    print_both('..PSA BI TRENDING: ' + curr_psa_bi_trend + ' (UP ' + str(round(curr_psa_bi_diff_abs, 1)) + ')\r')
-                if(curr_psa_bi_diff < 0):
-                    print_both('..PSA BI TRENDING: ' + curr_psa_bi_trend + ' (DOWN ' + str(round(curr_psa_bi_diff_abs, 1)) + ')\r')
-                if(curr_psa_bi_diff == 0):
-                    print_both('..PSA BI TRENDING: ' + curr_psa_bi_trend + ' (' + str(round(curr_psa_bi_diff_abs, 1)) + ')\r')
-        else:
-            # Set to NA
-            curr_psa_bi_trend = pandas.NA
-            print_both('..PSA BI TRENDING: NOT ENOUGH OBSERVATIONS TO CALCULATE TREND\r')
-            
-        # Determine PSA BI Forecast trend
-        if( (len(curr_psa_bi_3day_fcast_initial_list) > 0) & (len(curr_psa_bi_3day_fcast_final_list) > 0) ):
-            # First, get PSA initial and final average BI forecast (average of 1st day, and average of 3rd day)
-            curr_psa_bi_fcast_initial_avg = statistics.mean(curr_psa_bi_3day_fcast_initial_list)
-            curr_psa_bi_fcast_final_avg = statistics.mean(curr_psa_bi_3day_fcast_final_list)
-
-            # Now determine the difference between the average 1st day, and average 3rd day
-            curr_psa_bi_fcast_diff = curr_psa_bi_fcast_final_avg - curr_psa_bi_fcast_initial_avg
-            curr_psa_bi_fcast_diff_abs = abs(curr_psa_bi_fcast_diff)
-
-            # Increasing
-            if((curr_psa_bi_fcast_final_avg - curr_psa_bi_fcast_initial_avg) >= 3):
-                curr_psa_bi_fcast_trend = 'Increase'
-                print_both('..PSA BI FORECAST TRENDING: ' + curr_psa_bi_fcast_trend + ' (UP ' + str(round(curr_psa_bi_fcast_diff_abs, 1)) + ')\r')
-
-            # Decreasing
-            if((curr_psa_bi_fcast_final_avg - curr_psa_bi_fcast_initial_avg) <= -3):
-                curr_psa_bi_fcast_trend = 'Decrease'
-                print_both('..PSA BI TRENDING: ' + curr_psa_bi_fcast_trend + ' (DOWN ' + str(round(curr_psa_bi_fcast_diff_abs, 1)) + ')\r')
-
-            # No Change
-            if(curr_psa_bi_fcast_diff_abs < 3):
-                curr_psa_bi_fcast_trend = 'No Change'
-                if(curr_psa_bi_fcast_diff > 0):
-                    print_both('..PSA BI FORECAST TRENDING: ' + curr_psa_bi_fcast_trend + ' (UP ' + str(round(curr_psa_bi_fcast_diff_abs, 1)) + ')\r')
-                if(curr_psa_bi_fcast_diff < 0):
-                    print_both('..PSA BI FORECAST TRENDING: ' + curr_psa_bi_fcast_trend + ' (DOWN ' + str(round(curr_psa_bi_fcast_diff_abs, 1)) + ')\r')
-                if(curr_psa_bi_fcast_diff == 0):
-                    print_both('..PSA BI FORECAST TRENDING: ' + curr_psa_bi_fcast_trend + ' (' + str(round(curr_psa_bi_fcast_diff_abs, 1)) + ')\r')
-
-            # Insert the PSA average BI Percentile, and Trend into 'psa_update_sdf' dataframe
-            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_percentile'] = curr_psa_avg_bi_percentile_round
-            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_trend'] = curr_psa_bi_trend
-            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_fcast_percentile'] = curr_psa_avg_bi_1day_fcast_percentile_round
-            psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_fcast_trend'] = curr_psa_bi_fcast_trend
-        else:
-            # Set to NA
-            curr_psa_bi_fcast_trend = pandas.NA
-            print_both('..PSA BI FORECAST TRENDING: NOT ENOUGH OBSERVATIONS TO CALCULATE TREND\r')
-            
-        # Insert update date
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'nfdr_dt'] = datetime_today.strftime('%m/%d/%Y')
-        
+#####################################################################################################
+### FUEL MODEL PERCENTILES AND TRENDS
+#####################################################################################################
+
+def fuel_model_percentiles(allstations, raws_update_sdf, psa_update_sdf, percentile_lookup, fuel_model_dfs):
+    '''
+    ERC/BI percentiles and 3-day trends for every (station, fuel model) of fuel_models in one pass over a long table of
+    all stations' records, with one percentile lookup against the fuel model's Percentiles.csv tables. Same days, model
+    priority and trend thresholds as the service's values. PSA values are means of the member station values.
+    '''
+    print_both('\r')
+    print_both('FUEL MODEL PERCENTILES AND TRENDS\r')
+
+    try:
+
+        # Daily values of the observed (today and two days prior) and forecast (tomorrow and three days out) days,
+        # keeping the record with the lowest model priority of each station, fuel model and day
+        fm_cols = ['nfdr_dt','nfdr_tm','mp','ec','bi','fuel_model']
+        fm_days = {'nfdrs': (datetime_obs_start, datetime_today), 'fcast': (datetime_tomorrow, datetime_for_end)}
+        fm_daily = []
+        for fm_source in ['nfdrs','fcast']:
+            fm_stations = {k: v[fm_cols] for k, v in fuel_model_dfs[fm_source].items() if v is not None and set(fm_cols).issubset(v.columns)}
+            if(len(fm_stations) == 0):
+                continue
+            fm_long = pandas.concat(fm_stations, names=['StationID','wims_row']).reset_index()
+            fm_long['fm_datetime'] = pandas.to_datetime(fm_long['nfdr_dt'] + ' ' + fm_long['nfdr_tm'], format='%m/%d/%Y %H', errors='coerce')
+            fm_long['mp'] = pandas.to_numeric(fm_long['mp'], errors='coerce')
+            fm_long[['ec','bi']] = fm_long[['ec','bi']].apply(pandas.to_numeric, errors='coerce')
+            fm_long = fm_long.loc[fm_long['fm_datetime'].notna(),].reset_index(drop=True)
+
+            # Quality control per station and fuel model, as for the service's fuel model
+            if(toggle_qc == True):
+                import NFDRS_qc
+                fm_long['qc_id'] = fm_long['StationID'].astype(str) + '|' + fm_long['fuel_model']
+                if(fm_source == 'nfdrs'):
+                    fm_flags = NFDRS_qc.qc_flags(fm_long, 'qc_id', 'fm_datetime', priority_col='mp', stuck_days=qc_stuck_days)
+                else:
+                    fm_flags = NFDRS_qc.qc_flags(fm_long, 'qc_id', 'fm_datetime', jump_limits={}, stuck_fields=[])
+                if(qc_action == 'Drop' and len(fm_flags) > 0):
+                    fm_long = NFDRS_qc.drop_flagged(fm_long, fm_flags)
+
+            fm_initial, fm_final = [d.strftime('%m/%d/%Y') for d in fm_days[fm_source]]
+            fm_long = fm_long.loc[fm_long['nfdr_dt'].isin([fm_initial, fm_final]),]
+            fm_long = fm_long.sort_values(by=['StationID','fuel_model','fm_datetime','mp']).drop_duplicates(
+                subset=['StationID','fuel_model','nfdr_dt'], keep='first')
+            fm_long['day'] = numpy.where(fm_long['nfdr_dt'] == fm_final, fm_source + '_final', fm_source + '_initial')
+            fm_daily.append(fm_long[['StationID','fuel_model','day','ec','bi']])
+        if(len(fm_daily) == 0):
+            print_both('.NO FUEL MODEL DATA\r')
+            return
+
+        # (station, fuel model) x day values, percentiles of today's observation and tomorrow's forecast in one lookup
+        fm_wide = pandas.concat(fm_daily).pivot(index=['StationID','fuel_model'], columns='day', values=['ec','bi'])
+        fm_wide = fm_wide.reindex(columns=pandas.MultiIndex.from_product([['ec','bi'], ['nfdrs_initial','nfdrs_final','fcast_initial',
+                                                                                        'fcast_final']]))
+        fm_ids = fm_wide.index.to_frame(index=False)
+        raws_fm_df = fm_ids.rename(columns={'fuel_model': 'FuelModel'})
+        fm_queries = [(fm_col, fm_comp, fm_day) for fm_col, fm_comp in [('ec','ERC'), ('bi','BI')] for fm_day in ['nfdrs_final','fcast_initial']]
+        fm_per = percentile_lookup.lookup(pandas.concat([fm_ids['StationID']] * len(fm_queries)),
+                                          numpy.repeat([q[1] for q in fm_queries], len(fm_ids)),
+                                          numpy.concatenate([fm_wide[(q[0], q[2])].to_numpy(dtype='float64') for q in fm_queries]),
+                                          fuel_models=pandas.concat([fm_ids['fuel_model']] * len(fm_queries)))
+        fm_per = fm_per.reshape(len(fm_queries), len(fm_ids))
+
+        # Observed trends need today's value, forecast trends tomorrow's, with the same 3 point threshold as the service
+        for fm_col in ['ec','bi']:
+            fm_obs_diff = pandas.Series(fm_wide[(fm_col, 'nfdrs_final')] - fm_wide[(fm_col, 'nfdrs_initial')]).reset_index(drop=True)
+            fm_fcast_diff = pandas.Series(fm_wide[(fm_col, 'fcast_final')] - fm_wide[(fm_col, 'fcast_initial')]).reset_index(drop=True)
+            raws_fm_df[fm_col] = fm_wide[(fm_col, 'nfdrs_final')].to_numpy()
+            raws_fm_df[fm_col + '_percentile'] = fm_per[fm_queries.index((fm_col, 'ERC' if fm_col == 'ec' else 'BI', 'nfdrs_final'))]
+            raws_fm_df[fm_col + '_diff'] = fm_obs_diff
+            raws_fm_df[fm_col + '_trend'] = categorize_trends(fm_obs_diff, 3)
+            raws_fm_df[fm_col + '_fcast'] = fm_wide[(fm_col, 'fcast_initial')].to_numpy()
+            raws_fm_df[fm_col + '_fcast_percentile'] = fm_per[fm_queries.index((fm_col, 'ERC' if fm_col == 'ec' else 'BI', 'fcast_initial'))]
+            raws_fm_df[fm_col + '_fcast_diff'] = fm_fcast_diff
+            raws_fm_df[fm_col + '_fcast_trend'] = categorize_trends(fm_fcast_diff, 3)
+
+        # PSA means of the station percentiles and differences
+        fm_psa = allstations.loc[allstations['PSA'] != 'Non-PSA', ['StationID','PSA']].astype(str)
+        fm_psa = fm_psa.merge(raws_fm_df, on='StationID', how='inner')
+        fm_value_cols = [c for c in raws_fm_df.columns if c.endswith('_percentile') or c.endswith('_diff')]
+        psa_fm_df = fm_psa.groupby(['PSA','FuelModel'])[fm_value_cols].mean().round(2).add_prefix('avg_')
+        for fm_col in ['ec','ec_fcast','bi','bi_fcast']:
+            psa_fm_df['avg_' + fm_col + '_trend'] = categorize_trends(psa_fm_df['avg_' + fm_col + '_diff'], 3)
+        psa_fm_df = psa_fm_df.reset_index()
+
+        # Fill in any matching service fields, named with the fuel model appended
+        fm_filled = []
+        for fm_df, fm_key, fm_sdf, fm_sdf_key in [(raws_fm_df, 'StationID', raws_update_sdf, 'NWSID_Clean'),
+                                                  (psa_fm_df, 'PSA', psa_update_sdf, 'PSANationalCode')]:
+            fm_fields = fm_df.set_index([fm_key, 'FuelModel']).unstack('FuelModel')
+            fm_fields.columns = [c + '_' + fm for c, fm in fm_fields.columns]
+            fm_service_fields = [c for c in fm_fields.columns if c in fm_sdf.columns]
+            for fm_field in fm_service_fields:
+                fm_sdf[fm_field] = fm_sdf[fm_sdf_key].astype(str).map(fm_fields[fm_field])
+            fm_filled.append(str(len(fm_service_fields)))
+
+        raws_fm_df.to_csv(wdir + '/fuel_models_raws.csv', index=False)
+        psa_fm_df.to_csv(wdir + '/fuel_models_psa.csv', index=False)
+        print_both('.FUEL MODELS ' + ', '.join(sorted(raws_fm_df['FuelModel'].unique())) + ' FOR ' + str(raws_fm_df['StationID'].nunique()) +
+                   ' STATIONS AND ' + str(psa_fm_df['PSA'].nunique()) + ' PSAS\r')
+        print_both('.' + fm_filled[0] + ' RAWS AND ' + fm_filled[1] + ' PSA SERVICE FIELDS FILLED\r')
+
     except Exception as e:
 
-        print_both('.ERROR:\r')
-        print_both(str(e))
-        print_both('\r')
-        print_both('.INSERTING NULL VALUES INTO PSA UPDATE DATAFRAME\r')
-
-        # Insert NA into the PSA fields
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_percentile'] = pandas.NA
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_fcast_percentile'] = pandas.NA
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_trend'] = pandas.NA
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_ec_fcast_trend'] = pandas.NA
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_percentile'] = pandas.NA
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_fcast_percentile'] = pandas.NA
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_trend'] = pandas.NA
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'avg_bi_fcast_trend'] = pandas.NA
-        
-        # Insert update date
-        psa_update_sdf.loc[(psa_update_sdf['PSANationalCode'] == PSAs[i]), 'nfdr_dt'] = pandas.NA
+        print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+        print_both('.UNABLE TO DETERMINE FUEL MODEL PERCENTILES AND TRENDS\r')
 
 
 #####################################################################################################
-### UPDATE SERVICE
+### GRIDDED PERCENTILE SURFACES
 #####################################################################################################
 
-# Set the timezone for field 'nfdr_datetime' in raws_update_sdf
-raws_nfdr_datetime = pandas.to_datetime(raws_update_sdf['nfdr_datetime'])
-raws_nfdr_datetime_tzaware = raws_nfdr_datetime.dt.tz_localize('America/Los_Angeles')
-raws_update_sdf['nfdr_datetime'] = raws_nfdr_datetime_tzaware
+def sdf_crs(sdf):
+    '''EPSG code of a spatially enabled data frame's spatial reference.'''
+    sdf_sr = sdf.spatial.sr
+    return 'EPSG:' + str(sdf_sr.get('latestWkid', sdf_sr.get('wkid')))
+
+def build_grid(raws_update_sdf, raws2psa_df, psa_update_sdf):
+    '''Interpolate the RAWS percentiles to gridded surfaces.'''
+    print_both('\r')
+    print_both('GRIDDED PERCENTILE SURFACES\r')
+
+    try:
+        import NFDRS_grid
+
+        # Join the station percentiles to the RAWS locations
+        grid_stn_df = pandas.merge(raws_update_sdf[['NWSID_Clean','Latitude','Longitude']], raws2psa_df, how='inner',
+                                   left_on='NWSID_Clean', right_on='StationID')
+        grid_bands = {}
+        for grid_col in ['ERC_per','ERC_fcast_per','BI_per','BI_fcast_per']:
+            grid_bands[grid_col] = pandas.to_numeric(grid_stn_df[grid_col], errors='coerce').to_numpy(dtype='float64', na_value=numpy.nan)
+
+        # Get the PSA polygons for clipping
+        grid_clip_shapes = None
+        grid_clip_crs = None
+        if(grid_clip_to_psa == True):
+            grid_clip_crs = sdf_crs(psa_update_sdf)
+            grid_clip_shapes = [shp.__geo_interface__ for shp in psa_update_sdf['SHAPE'] if shp is not None]
+
+        # Interpolate and write the grid
+        grid_path = wdir + '/NFDRS_percentile_grid_' + datetime_today.strftime('%m%d%Y') + '.tif'
+        grid_info = NFDRS_grid.write_percentile_grid(grid_path, grid_stn_df['Longitude'], grid_stn_df['Latitude'], grid_bands,
+                                                     cell_size=grid_cell_size, method=grid_method, k=grid_neighbors,
+                                                     max_dist=grid_max_dist, clip_shapes=grid_clip_shapes, clip_crs=grid_clip_crs)
+        print_both('.WROTE ' + str(grid_info['ncols']) + ' x ' + str(grid_info['nrows']) + ' GRID TO ' + grid_path + '\r')
 
-# Set the timezone for field 'obs_datetime' in raws_update_sdf
-raws_obs_datetime = pandas.to_datetime(raws_update_sdf['obs_datetime'])
-raws_obs_datetime_tzaware = raws_obs_datetime.dt.tz_localize('America/Los_Angeles')
-raws_update_sdf['obs_datetime'] = raws_obs_datetime_tzaware
+    except Exception as e:
 
-# Fill NAs in dataframes with values of None, else will throw an error when updating service
-raws_update_sdf = raws_update_sdf.replace({numpy.nan: None})
-psa_update_sdf = psa_update_sdf.replace({numpy.nan: None})
+        print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+        print_both('.UNABLE TO BUILD GRIDDED PERCENTILE SURFACES\r')
 
-# Update the feature service with the new data
-print_both('\r')
-print_both('UPDATING FEATURES\r')
 
-print_both('.RAWS\r')
-raws_upload = False
-for i in range(0,5): # Try update up to 5 times
-    try:
-        raws_update_fset = arcgis.features.FeatureSet.from_dataframe(raws_update_sdf)
-        raws_layer.edit_features(updates = raws_update_fset)
-        raws_upload = True
-    except:
-        pass
-    if raws_upload == False:
-        print_both('..UPLOAD FAILED, RE-TRYING\r')
-        sleep(30) # Wait 30 seconds before trying again
-    else:
-        break
-if raws_upload == False:
-    print_both('..RAWS FAILED TO UPDATE AFTER 5 ATTEMPTS\r')
-
-print_both('.PSA\r')
-GACCs = sorted(list(set(psa_update_sdf['GACC'].tolist())))
-for i in range(0, len(GACCs)):
-    print_both('..Updating ' + GACCs[i])
-    psa_upload = False
-    for j in range(0,5): # Try update up to 5 times
+#####################################################################################################
+### UPDATE SERVICE
+#####################################################################################################
+
+def update_service(raws_layer, psa_layer, raws_update_sdf, psa_update_sdf, psas=None):
+    '''
+    Send the RAWS and PSA updates to the feature service. If psas is given only those PSAs (and GACCs containing them)
+    are sent. Returns the list of PSAs that were updated.
+    '''
+
+    # Set the timezone for field 'nfdr_datetime' in raws_update_sdf
+    raws_nfdr_datetime = pandas.to_datetime(raws_update_sdf['nfdr_datetime'])
+    raws_nfdr_datetime_tzaware = raws_nfdr_datetime.dt.tz_localize('America/Los_Angeles')
+    raws_update_sdf['nfdr_datetime'] = raws_nfdr_datetime_tzaware
+
+    # Set the timezone for field 'obs_datetime' in raws_update_sdf
+    raws_obs_datetime = pandas.to_datetime(raws_update_sdf['obs_datetime'])
+    raws_obs_datetime_tzaware = raws_obs_datetime.dt.tz_localize('America/Los_Angeles')
+    raws_update_sdf['obs_datetime'] = raws_obs_datetime_tzaware
+
+    # Attribute-only updates, the geometries and static attributes never change
+    raws_publish_df = pandas.DataFrame(raws_update_sdf[['OBJECTID'] + [c for c in raws_update_sdf.columns if c not in RAWS_static_attrs]])
+    psa_publish_df = pandas.DataFrame(psa_update_sdf[['OBJECTID','PSANationalCode','GACC'] + [c for c in psa_update_sdf.columns if c not in PSA_static_attrs]])
+
+    # Convert the copies sent to the service from the compact working types and fill NAs with values of None, else will
+    # throw an error when updating service
+    raws_publish_df = publish_types(raws_publish_df).replace({numpy.nan: None})
+    psa_publish_df = publish_types(psa_publish_df).replace({numpy.nan: None})
+    if(psas is not None):
+        psa_publish_df = psa_publish_df.loc[psa_publish_df['PSANationalCode'].isin(psas),]
+    psa_published = []
+
+    if(toggle_publish == False):
+        print_both('\r')
+        print_both('PUBLISHING TURNED OFF, FEATURE SERVICE NOT UPDATED\r')
+        return psa_published
+
+    # Update the feature service with the new data
+    print_both('\r')
+    print_both('UPDATING FEATURES\r')
+
+    print_both('.RAWS\r')
+    raws_upload = False
+    for i in range(0,5): # Try update up to 5 times
         try:
-            ga_sdf = psa_update_sdf.loc[psa_update_sdf['GACC'] == GACCs[i],]
-            psa_update_fset = arcgis.features.FeatureSet.from_dataframe(ga_sdf)
-            psa_layer.edit_features(updates = psa_update_fset)
-            psa_upload = True
+            raws_update_fset = arcgis.features.FeatureSet.from_dataframe(raws_publish_df)
+            raws_layer.edit_features(updates = raws_update_fset)
+            raws_upload = True
         except:
             pass
-        if psa_upload == False:
-            print_both('...UPLOAD FAILED, RE-TRYING\r')
+        if raws_upload == False:
+            print_both('..UPLOAD FAILED, RE-TRYING\r')
             sleep(30) # Wait 30 seconds before trying again
         else:
             break
-    if psa_upload == False:
-        print_both('...PSA FAILED TO UPDATE AFTER 5 ATTEMPTS\r')
-        
-# Save data for troubleshooting
-raws2psa_df.to_csv(wdir + '/raws2psa_data.csv')
-raws_update = raws_update_sdf.drop('SHAPE',axis=1)
-raws_update.to_csv(wdir + '/raws_data.csv')
-psa_update = psa_update_sdf.drop('SHAPE',axis=1)
-psa_update.to_csv(wdir + '/psa_data.csv')
-
-print_both('\r')
-print_both('DONE!\r')
-print_both('\r')
-
-# Close log file
-lf.close()
+    if raws_upload == False:
+        print_both('..RAWS FAILED TO UPDATE AFTER 5 ATTEMPTS\r')
+
+    print_both('.PSA\r')
+    GACCs = sorted(list(set(psa_publish_df['GACC'].tolist())))
+    for i in range(0, len(GACCs)):
+        print_both('..Updating %s', GACCs[i])
+        psa_upload = False
+        for j in range(0,5): # Try update up to 5 times
+            try:
+                ga_df = psa_publish_df.loc[psa_publish_df['GACC'] == GACCs[i],].drop(columns=['PSANationalCode','GACC'])
+                psa_update_fset = arcgis.features.FeatureSet.from_dataframe(ga_df)
+                psa_layer.edit_features(updates = psa_update_fset)
+                psa_upload = True
+            except:
+                pass
+            if psa_upload == False:
+                print_both('...UPLOAD FAILED, RE-TRYING\r')
+                sleep(30) # Wait 30 seconds before trying again
+            else:
+                break
+        if psa_upload == False:
+            print_both('...PSA FAILED TO UPDATE AFTER 5 ATTEMPTS\r')
+        else:
+            psa_published.extend(psa_publish_df.loc[psa_publish_df['GACC'] == GACCs[i],'PSANationalCode'].tolist())
+
+    return psa_published
+
+def save_outputs(raws2psa_df, raws_update_sdf, psa_update_sdf):
+    '''Save data for troubleshooting.'''
+    raws2psa_df.to_csv(wdir + '/raws2psa_data.csv')
+    raws_update = raws_update_sdf.drop('SHAPE',axis=1)
+    raws_update.to_csv(wdir + '/raws_data.csv')
+    psa_update = psa_update_sdf.drop('SHAPE',axis=1)
+    psa_update.to_csv(wdir + '/psa_data.csv')
+
+def write_outputs(raws2psa_df, raws_update_sdf, psa_update_sdf):
+    '''Write the final tables to the local output sinks.'''
+    print_both('\r')
+    print_both('WRITING LOCAL OUTPUTS\r')
+
+    try:
+        import NFDRS_sinks
+        os.makedirs(output_dir, exist_ok=True)
+        sink_layers = {'raws': NFDRS_sinks.to_geodataframe(raws_update_sdf, sdf_crs(raws_update_sdf)),
+                       'psa': NFDRS_sinks.to_geodataframe(psa_update_sdf, sdf_crs(psa_update_sdf))}
+        sink_results = NFDRS_sinks.write_sinks(output_dir, sink_layers, output_sinks, tables={'raws2psa': raws2psa_df})
+        for sink_path in sorted(sink_results.keys()):
+            if(sink_results[sink_path] is None):
+                print_both('.WROTE ' + sink_path + '\r')
+            else:
+                print_both('.ERROR WRITING ' + sink_path + ': ' + str(sink_results[sink_path]) + '\r', level='ERROR')
+
+    except Exception as e:
 
+        print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+        print_both('.UNABLE TO WRITE LOCAL OUTPUTS\r')
+
+def archive_outputs(raws_update_sdf, psa_update_sdf, psas=None):
+    '''
+    Append the final RAWS and PSA attributes of the run to the season archive. If psas is given (incremental PSA
+    updates) only those PSAs were re-aggregated and are archived for this run.
+    '''
+    print_both('\r')
+    print_both('ARCHIVING OUTPUTS\r')
+
+    try:
+        import NFDRS_archive
+        archive_psa_df = pandas.DataFrame(psa_update_sdf.drop(columns=['SHAPE']))
+        if(psas is not None):
+            archive_psa_df = archive_psa_df.loc[archive_psa_df['PSANationalCode'].astype(str).isin(psas),]
+        archive = NFDRS_archive.OutputArchive(archive_dir)
+        archive_paths = archive.append(datetime_today, {'raws': pandas.DataFrame(raws_update_sdf.drop(columns=['SHAPE'])),
+                                                        'psa': archive_psa_df})
+        for archive_path in archive_paths:
+            print_both('.WROTE ' + archive_path + '\r')
+
+    except Exception as e:
+
+        print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+        print_both('.UNABLE TO ARCHIVE OUTPUTS\r')
+
+def export_static(raws_update_sdf, psa_update_sdf, psas=None):
+    '''
+    Write the static dashboard files of the final RAWS and PSA values. If psas is given (incremental PSA updates) only
+    those PSAs are rendered again, the files of the others are kept.
+    '''
+    print_both('\r')
+    print_both('WRITING STATIC FILES\r')
+
+    try:
+        import NFDRS_static
+        psa_fields = ['PSANationalCode','PSANAME','PSAName','GACC'] + [c for c in psa_update_sdf.columns if c not in PSA_static_attrs]
+        station_fields = ['StnName_Clean','GACC','PSA','Latitude','Longitude'] + [
+            c for c in raws_update_sdf.columns if c not in RAWS_static_attrs and not c.endswith('_URL')]
+        static_counts = NFDRS_static.build_static(static_dir, psa_update_sdf, 'PSANationalCode', sdf_crs(psa_update_sdf), raws_update_sdf,
+                                                  'NWSID_Clean', psa_fields, station_fields, psas=psas, tolerance=static_simplify_tolerance)
+        print_both('.' + str(static_counts['psa_rendered']) + ' PSAS RENDERED, ' + str(static_counts['files_written']) + ' FILES WRITTEN TO ' +
+                   static_dir + '\r', **static_counts)
+
+    except Exception as e:
+
+        print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+        print_both('.UNABLE TO WRITE STATIC FILES\r')
+
+
+#####################################################################################################
+### SHARDED EXECUTION
+#####################################################################################################
+
+def shard_ids(raws_update_sdf):
+    '''All shard ids for the run, as strings.'''
+    if(shard_by == 'GACC'):
+        return sorted(list(set(raws_update_sdf['GACC'].astype(str).tolist())))
+    return [str(n) for n in range(0, shard_count)]
+
+def shard_of(raws_update_sdf):
+    '''Shard id of each RAWS. Hashing uses md5 of the station id so every host assigns stations the same way.'''
+    if(shard_by == 'GACC'):
+        return raws_update_sdf['GACC'].astype(str)
+    return raws_update_sdf['NWSID_Clean'].map(lambda s: str(int(hashlib.md5(str(s).encode('utf-8')).hexdigest(), 16) % shard_count))
+
+def select_shard(raws_update_sdf):
+    '''Subset the RAWS update table to the stations in shard_id.'''
+    print_both('.SUBSET TO SHARD ' + str(shard_id) + ' (BY ' + shard_by.upper() + ')\r')
+    shard_sdf = raws_update_sdf.loc[shard_of(raws_update_sdf) == str(shard_id),]
+    shard_sdf = shard_sdf.reset_index(drop=True)
+    print_both('..%s OF %s RAWS IN SHARD\r', shard_sdf.shape[0], raws_update_sdf.shape[0])
+    return shard_sdf
+
+def shard_paths(shard):
+    '''Partial result files for a shard on the run day.'''
+    run_dir = shard_dir + '/' + datetime_today.strftime('%Y%m%d')
+    return run_dir, run_dir + '/raws2psa_' + str(shard) + '.pkl', run_dir + '/raws_' + str(shard) + '.pkl'
+
+def write_shard(raws2psa_df, raws_update_sdf):
+    '''Save the partial raws2psa_df and RAWS update rows of this shard for the merge step.'''
+    print_both('\r')
+    print_both('SAVING SHARD ' + str(shard_id) + '\r')
+    run_dir, r2p_path, raws_path = shard_paths(shard_id)
+    os.makedirs(run_dir, exist_ok=True)
+
+    # Only the stations computed in this shard, written to a temporary file first so the merge never reads half a file
+    shard_r2p = raws2psa_df.loc[raws2psa_df['StationID'].isin(raws_update_sdf['NWSID_Clean']),]
+    for df, path in [(shard_r2p, r2p_path), (raws_update_sdf, raws_path)]:
+        df.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+    print_both('.' + str(shard_r2p.shape[0]) + ' STATIONS SAVED TO ' + run_dir + '\r')
+
+def merge_shards(raws2psa_df, raws_update_sdf):
+    '''Combine the saved shards of the run day into the full raws2psa_df and RAWS update rows.'''
+    print_both('\r')
+    print_both('MERGING SHARDS\r')
+    shard_r2p_dfs = []
+    shard_raws_dfs = []
+    for shard in shard_ids(raws_update_sdf):
+        run_dir, r2p_path, raws_path = shard_paths(shard)
+        if(os.path.exists(r2p_path) and os.path.exists(raws_path)):
+            shard_r2p_dfs.append(pandas.read_pickle(r2p_path))
+            shard_raws_dfs.append(pandas.read_pickle(raws_path))
+            print_both('.SHARD ' + shard + ': ' + str(shard_raws_dfs[-1].shape[0]) + ' RAWS\r')
+        else:
+            print_both('.SHARD ' + shard + ': MISSING, STATIONS TREATED AS NON-REPORTING AND NOT UPDATED\r')
+    if(len(shard_raws_dfs) == 0):
+        raise Exception('NO SHARDS FOUND IN ' + shard_paths('')[0])
+
+    # Stations missing from every shard keep NA values, so PSAs ignore them like any non-reporting station
+    shard_r2p = pandas.concat(shard_r2p_dfs).drop_duplicates(subset=['StationID'])
+    raws2psa_df = raws2psa_df[['StationID','StationName']].merge(shard_r2p.drop(columns=['StationName']), on='StationID', how='left')
+    # RAWS rows of the shards, back in the order of the RAWS layer query
+    raws_order = dict(zip(raws_update_sdf['NWSID_Clean'], range(0, raws_update_sdf.shape[0])))
+    raws_update_sdf = pandas.concat(shard_raws_dfs).drop_duplicates(subset=['NWSID_Clean'])
+    raws_update_sdf = raws_update_sdf.sort_values(by=['NWSID_Clean'], key=lambda s: s.map(raws_order)).reset_index(drop=True)
+    return raws2psa_df, raws_update_sdf
+
+
+#####################################################################################################
+### MAIN
+#####################################################################################################
+
+def run_pipeline(allstations, percentile_lookup, raws_layer, psa_layer, raws_update_sdf, psa_update_sdf, raws2psa_df,
+                 fcast_only=False, wims_cache=None):
+    '''
+    Run the stages of an update once the tables are loaded and the layers queried: WIMS downloads and quality control,
+    RAWS and PSA percentiles and trends, the optional outputs, the service update and the saved outputs (or the partial
+    results of a shard). Used by main() and by the scheduler (NFDRS_scheduler.py), which keeps wims_cache between runs:
+    full runs store the observed NFDRS and weather data of the run day in it, and runs with fcast_only reuse that data
+    and only download the forecasts. A run with fcast_only before a full run of the same day is skipped, so the
+    observed fields in the service are never replaced. Returns the aggregated PSA update table, or None for a shard or
+    a skipped run.
+    '''
+    if(fcast_only == True and (wims_cache is None or wims_cache.get('day') != datetime_today.date())):
+        print_both('.NO DAILY RUN YET ON ' + str(datetime_today.date()) + ', FORECAST REFRESH SKIPPED\r', level='WARNING')
+        return None
+    if(toggle_shard_mode == 'Merge'):
+        with profile_stage('merge_shards'):
+            raws2psa_df, raws_update_sdf = merge_shards(raws2psa_df, raws_update_sdf)
+    else:
+        if(toggle_shard_mode == 'Shard'):
+            raws_update_sdf = select_shard(raws_update_sdf)
+
+        # Stations already finished or downloaded on an interrupted run of the same day
+        wims_checkpoints = {}
+        done_stations = set()
+        fuel_model_checkpoints = {}
+        if(toggle_checkpoint == True):
+            clean_checkpoints()
+            if(toggle_resume == True):
+                wims_checkpoints, done_stations, fuel_model_checkpoints = resume_stations(raws_update_sdf, raws2psa_df)
+
+        # WIMS data for the remaining stations, observed data from earlier in the day is reused by forecast refreshes
+        download_sdf = raws_update_sdf.loc[~raws_update_sdf['NWSID_Clean'].isin(done_stations | set(wims_checkpoints.keys())),]
+        fuel_model_dfs = {'nfdrs': {}, 'fcast': {}} if len(fuel_models) > 0 else None
+        reuse_obs = (fcast_only == True)
+        with profile_stage('download_wims'):
+            if(reuse_obs == True):
+                print_both('.REUSING OBSERVED WIMS DATA FROM ' + str(datetime_today.date()) + '\r')
+                wims_urls, _, wims_fcast_dfs, _ = download_wims(download_sdf.reset_index(drop=True), sources=('fcast',),
+                                                                fuel_model_dfs=fuel_model_dfs)
+                wims_nfdrs_dfs = {k: v.copy() for k, v in wims_cache['nfdrs'].items()}
+                wims_obs_dfs = {k: v.copy() for k, v in wims_cache['obs'].items()}
+                if(fuel_model_dfs is not None):
+                    fuel_model_dfs['nfdrs'] = {k: v.copy() for k, v in wims_cache.get('fm_nfdrs', {}).items()}
+            else:
+                wims_urls, wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs = download_wims(download_sdf.reset_index(drop=True),
+                                                                                        fuel_model_dfs=fuel_model_dfs)
+
+        # WIMS data of the checkpointed stations, finished ones included for the forecast spread and trend windows
+        for curr_NWSID, wims_checkpoint in wims_checkpoints.items():
+            wims_urls[curr_NWSID] = wims_checkpoint['urls']
+            wims_nfdrs_dfs[curr_NWSID] = wims_checkpoint['nfdrs']
+            wims_fcast_dfs[curr_NWSID] = wims_checkpoint['fcast']
+            wims_obs_dfs[curr_NWSID] = wims_checkpoint['obs']
+        if(fuel_model_dfs is not None):
+            for curr_NWSID, fuel_model_checkpoint in fuel_model_checkpoints.items():
+                for source in ['nfdrs','fcast']:
+                    if('fm_' + source in fuel_model_checkpoint):
+                        fuel_model_dfs[source][curr_NWSID] = fuel_model_checkpoint['fm_' + source]
+        if(wims_cache is not None and reuse_obs == False):
+            wims_cache.update({'day': datetime_today.date(), 'nfdrs': {k: v.copy() for k, v in wims_nfdrs_dfs.items()},
+                               'obs': {k: v.copy() for k, v in wims_obs_dfs.items()},
+                               'fm_nfdrs': {k: v.copy() for k, v in fuel_model_dfs['nfdrs'].items()} if fuel_model_dfs is not None else {}})
+        if(toggle_qc == True):
+            with profile_stage('qc_wims'):
+                qc_wims(wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs)
+
+        # RAWS percentiles and trends
+        with profile_stage('process_stations'):
+            process_stations(raws_update_sdf, raws2psa_df, percentile_lookup, wims_urls, wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs,
+                             skip_stations=done_stations)
+
+    # Shards stop here, the merge step aggregates PSAs and updates the service once
+    if(toggle_shard_mode == 'Shard'):
+        with profile_stage('write_shard'):
+            write_shard(raws2psa_df, raws_update_sdf)
+        return None
+
+    # PSA percentiles and trends, only for PSAs with changed stations if already published earlier in the day
+    with profile_stage('process_psas'):
+        aggregate_psas = None
+        if(toggle_incremental_psa == True):
+            aggregate_psas = dirty_psas(allstations, raws2psa_df)
+        process_psas(allstations, raws2psa_df, psa_update_sdf, psas=aggregate_psas)
+    # Shards do not keep the WIMS data, so the forecast spread, trend windows and fuel models are only available on unsharded runs
+    if(toggle_fcast_spread == True and toggle_shard_mode != 'Merge'):
+        with profile_stage('forecast_spread'):
+            forecast_spread(allstations, raws_update_sdf, psa_update_sdf, percentile_lookup, wims_fcast_dfs)
+    if(toggle_trend_windows == True and toggle_shard_mode != 'Merge'):
+        with profile_stage('window_trends'):
+            window_trends(allstations, raws_update_sdf, psa_update_sdf, wims_nfdrs_dfs)
+    if(len(fuel_models) > 0 and toggle_shard_mode != 'Merge'):
+        with profile_stage('fuel_models'):
+            fuel_model_percentiles(allstations, raws_update_sdf, psa_update_sdf, percentile_lookup, fuel_model_dfs)
+    if(toggle_grid_output == True):
+        with profile_stage('build_grid'):
+            build_grid(raws_update_sdf, raws2psa_df, psa_update_sdf)
+
+    # Update the service and save outputs, keeping the aggregated PSAs in their compact types. Only PSAs with changed
+    # values are published, archived and rendered if already published earlier in the day
+    psa_aggregated_sdf = psa_update_sdf.copy()
+    with profile_stage('update_service'):
+        psas = None
+        if(toggle_incremental_psa == True):
+            psas = changed_psas(psa_aggregated_sdf)
+            if(psas is not None):
+                print_both('\r')
+                print_both('INCREMENTAL PSA UPDATE\r')
+                print_both('.' + str(len(psas)) + ' OF ' + str(len(psa_aggregated_sdf)) + ' PSAS WITH CHANGED VALUES\r')
+        psa_published = update_service(raws_layer, psa_layer, raws_update_sdf, psa_update_sdf, psas=psas)
+        if(toggle_incremental_psa == True):
+            save_psa_state(raws2psa_df, psa_aggregated_sdf, psas, psa_published)
+    with profile_stage('save_outputs'):
+        raws_update_sdf = plain_types(raws_update_sdf)
+        psa_update_sdf = plain_types(psa_update_sdf)
+        save_outputs(raws2psa_df, raws_update_sdf, psa_update_sdf)
+        if(len(output_sinks) > 0):
+            write_outputs(raws2psa_df, raws_update_sdf, psa_update_sdf)
+        if(toggle_archive == True):
+            archive_outputs(raws_update_sdf, psa_update_sdf, psas=psas)
+        if(toggle_static_export == True):
+            export_static(raws_update_sdf, psa_update_sdf, psas=psas)
+
+    return psa_aggregated_sdf
+
+def main():
+    '''Run the update of the feature service for the run day, or one shard of it.'''
+    set_run_date(toggle_run_date)
+    if(toggle_shard_mode == 'Shard'):
+        open_log('_shard_' + str(shard_id))
+    else:
+        open_log()
+
+    # Data setup
+    with profile_stage('load_tables'):
+        allstations, percentiles, percentile_lookup = load_tables()
+        raws2psa_df = create_raws2psa_table(allstations)
+    with profile_stage('query_layers'):
+        gis, raws_layer, psa_layer = connect_service()
+        raws_update_sdf, psa_update_sdf = query_layers(allstations, raws_layer, psa_layer)
+
+    # Download, compute, update the service and save outputs
+    run_pipeline(allstations, percentile_lookup, raws_layer, psa_layer, raws_update_sdf, psa_update_sdf, raws2psa_df)
+
+    print_both('\r')
+    print_both('DONE!\r')
+    print_both('\r')
+
+    # Close log file
+    close_log()
+
+
+if __name__ == '__main__':
+    # Shard settings can be given on the command line so several processes or hosts can share one copy of the script
+    parser = argparse.ArgumentParser(description='Update the NFDRS percentile and trend feature service.')
+    parser.add_argument('--shard-mode', choices=['None','Shard','Merge'], default=toggle_shard_mode)
+    parser.add_argument('--shard-id', default=shard_id)
+    parser.add_argument('--resume', action='store_true', default=toggle_resume, help='Skip stations checkpointed earlier in the run day')
+    parser.add_argument('--profile', choices=['Deterministic','Sampling'], default=profile_mode if toggle_profile == True else None,
+                        help='Profile each stage of the run, writing the results next to the log file')
+    parser.add_argument('--fuel-models', nargs='*', default=fuel_models, help='Fuel models computed for every station, e.g. V W X Y')
+    args = parser.parse_args()
+    toggle_shard_mode = args.shard_mode
+    fuel_models = args.fuel_models
+    shard_id = args.shard_id
+    toggle_resume = args.resume
+    if(args.profile is not None):
+        toggle_profile = True
+        profile_mode = args.profile
+    if(toggle_shard_mode == 'Shard' and shard_id is None):
+        parser.error('--shard-id is required with --shard-mode Shard')
+    main()
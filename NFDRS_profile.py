@@ -0,0 +1,137 @@
+'''
+Per-stage profiling of a run of the NFDRS percentile and trend analysis.
+
+Each pipeline stage (download, QC, station and PSA processing, service update, ...) is wrapped in a profiler and its
+allocations are traced with tracemalloc, so hot paths and memory peaks can be found from a real production run.
+
+    profiler = StageProfiler('Sampling', 'C:/.../NFDRS_profile_10192026')
+    with profiler.stage('download_wims'):
+        ...
+    profiler.finish()
+
+'Deterministic' mode uses cProfile and writes one pstats file per stage (<prefix>_<stage>.prof, readable with
+pstats, snakeviz, ...). 'Sampling' mode samples the stack of the profiled thread every sample_interval seconds and
+writes collapsed stacks (<prefix>_<stage>.collapsed) for flamegraph.pl, speedscope or inferno. Both modes write
+<prefix>_stages.csv with the time and traced memory of each stage, and <prefix>_alloc.txt with the largest
+allocation sites still held at the end of each stage.
+'''
+
+# Import libraries and modules
+import cProfile, os, sys, threading, time, tracemalloc
+import pandas
+
+
+class _Sampler(threading.Thread):
+    '''Background thread that samples the stack of one thread and counts the collapsed stacks.'''
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while(not self._stop_event.wait(self.interval)):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while(frame is not None):
+                code = frame.f_code
+                stack.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')')
+                frame = frame.f_back
+            if(len(stack) > 0):
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class _Stage:
+    '''Context manager profiling one stage.'''
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        p = self.profiler
+        if(p.trace_memory == True):
+            tracemalloc.reset_peak()
+            self.mem_start = tracemalloc.get_traced_memory()[0]
+        if(p.mode == 'Deterministic'):
+            self.prof = cProfile.Profile()
+            self.prof.enable()
+        else:
+            self.sampler = _Sampler(threading.get_ident(), p.sample_interval)
+            self.sampler.start()
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        p = self.profiler
+        elapsed = time.perf_counter() - self.t_start
+        path = p.prefix + '_' + self.name
+        if(p.mode == 'Deterministic'):
+            self.prof.disable()
+            self.prof.dump_stats(path + '.prof')
+        else:
+            self.sampler.stop()
+            with open(path + '.collapsed', 'w') as f:
+                for stack, n in sorted(self.sampler.counts.items()):
+                    f.write(stack + ' ' + str(n) + '\n')
+
+        row = {'stage': self.name, 'seconds': round(elapsed, 3), 'failed': exc_type is not None}
+        if(p.trace_memory == True):
+            mem_end, mem_peak = tracemalloc.get_traced_memory()
+            row['peak_mb'] = round(mem_peak / 2**20, 2)
+            row['net_mb'] = round((mem_end - self.mem_start) / 2**20, 2)
+            top = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('lineno')
+            p.alloc_lines.append(self.name + ' (peak ' + str(row['peak_mb']) + ' MB, net ' + str(row['net_mb']) + ' MB)')
+            for s in top[:p.top_allocations]:
+                p.alloc_lines.append('    ' + str(round(s.size / 2**20, 3)) + ' MB in ' + str(s.count) + ' blocks: ' +
+                                     str(s.traceback[0].filename) + ':' + str(s.traceback[0].lineno))
+        p.stages.append(row)
+        return False
+
+
+class StageProfiler:
+    '''Profile the stages of a run and write the results next to the run's log file.'''
+
+    def __init__(self, mode, prefix, sample_interval=0.005, trace_memory=True, top_allocations=10):
+        '''
+        mode: 'Deterministic' (cProfile) or 'Sampling'.
+        prefix: path prefix of the output files, e.g. the log file path without '.txt'.
+        sample_interval: seconds between stack samples in Sampling mode.
+        trace_memory: trace allocations with tracemalloc (slows down allocation heavy stages).
+        top_allocations: number of allocation sites listed per stage.
+        '''
+        if(mode not in ('Deterministic', 'Sampling')):
+            raise ValueError('Unknown profile mode ' + str(mode) + ', expected Deterministic or Sampling')
+        self.mode = mode
+        self.prefix = prefix
+        self.sample_interval = sample_interval
+        self.trace_memory = trace_memory
+        self.top_allocations = top_allocations
+        self.stages = []
+        self.alloc_lines = []
+        self.started_tracing = False # Tracing started by the caller or python -X tracemalloc is left running
+        if(trace_memory == True and not tracemalloc.is_tracing()):
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def stage(self, name):
+        '''Context manager profiling the stage name.'''
+        return _Stage(self, name)
+
+    def finish(self):
+        '''Write the stage summary and allocation report, and stop tracing memory if the profiler started it.'''
+        pandas.DataFrame(self.stages).to_csv(self.prefix + '_stages.csv', index=False)
+        if(self.trace_memory == True):
+            with open(self.prefix + '_alloc.txt', 'w') as f:
+                f.write('\n'.join(self.alloc_lines) + '\n')
+            if(self.started_tracing == True):
+                tracemalloc.stop()
+                self.started_tracing = False
+        return self.stages
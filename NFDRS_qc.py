@@ -0,0 +1,105 @@
+'''
+Quality control of WIMS values across all stations at once. Checks for values outside of plausible limits, large
+day-over-day jumps and values that are stuck at the same number for several days, using array operations over a long
+table of all station records rather than per-station loops.
+'''
+
+# Import libraries and modules
+import numpy, pandas
+
+# Plausible limits (inclusive) for WIMS NFDRS and observation fields. Fields not in the data are skipped.
+qc_range_limits = {'ec': (0, 150), 'bi': (0, 500), 'sc': (0, 300), 'ic': (0, 100), 'kbdi': (0, 800),
+                   'one_hr': (0, 100), 'ten_hr': (0, 100), 'hu_hr': (0, 100), 'th_hr': (0, 100),
+                   'dry_temp': (-60, 130), 'rh': (0, 100), 'wind_sp': (0, 100), 'wind_dir': (0, 360),
+                   'tmp_max': (-60, 130), 'tmp_min': (-60, 130), 'rh_max': (0, 100), 'rh_min': (0, 100),
+                   'pp_amt': (0, 20)}
+
+# Largest plausible absolute change from the previous day. BI is driven by wind and is not checked.
+qc_jump_limits = {'ec': 30}
+
+# Checks that only report values and never drop them. A rise on the latest day cannot be confirmed as a spike until
+# the next day's value is in, and may be the start of a real event.
+qc_report_only_checks = ['Rise']
+
+# Fields checked for values stuck at the same (non-zero) number on consecutive days
+qc_stuck_fields = ['ec', 'bi']
+
+
+def qc_flags(long_df, id_col, dt_col, priority_col=None, range_limits=qc_range_limits, jump_limits=qc_jump_limits,
+             stuck_fields=qc_stuck_fields, stuck_days=5):
+    '''
+    Find suspicious values in a long table of station records.
+
+    long_df: one row per WIMS record with a station id column, a datetime column and the value fields. The index must
+             be unique, it is used to point back to the flagged records.
+    priority_col: optional model priority column, the jump and stuck checks only use the top priority record per day.
+    Returns a data frame of flags with the record index, station id, datetime, field, check name and value.
+    '''
+    flags = []
+    checked = {}
+
+    # Range limits
+    for field, (lo, hi) in range_limits.items():
+        if(field not in long_df.columns):
+            continue
+        vals = pandas.to_numeric(long_df[field], errors='coerce')
+        bad = (vals < lo) | (vals > hi)
+        if(bad.any()):
+            flags.append(pandas.DataFrame({'Field': field, 'Check': 'Range', 'Value': vals[bad]}))
+        checked[field] = vals.mask(bad)
+
+    # Day-over-day jumps and stuck values on a single record per station and day
+    day_fields = [f for f in list(jump_limits.keys()) + list(stuck_fields) if f in checked]
+    if(len(day_fields) > 0 and len(long_df) > 0):
+        sort_cols = [id_col, dt_col] + ([priority_col] if priority_col is not None else [])
+        daily = long_df[sort_cols].assign(**{f: checked[f] for f in set(day_fields)})
+        daily['qc_date'] = daily[dt_col].dt.normalize()
+        daily = daily.sort_values(by=sort_cols).drop_duplicates(subset=[id_col, 'qc_date'], keep='first')
+
+        # Consecutive days for the same station
+        same_stn = daily[id_col].eq(daily[id_col].shift())
+        next_day = (daily['qc_date'] - daily['qc_date'].shift()).dt.days.eq(1)
+        consecutive = same_stn & next_day
+
+        # A jump is a spike out and back on consecutive days. A rise on the latest day cannot be confirmed yet and is
+        # only reported (Rise). Large drops on their own are left alone since wetting rain can legitimately cause them.
+        latest = ~daily[id_col].eq(daily[id_col].shift(-1))
+        for field, limit in jump_limits.items():
+            if(field not in checked):
+                continue
+            d_in = (daily[field] - daily[field].shift()).where(consecutive)
+            d_out = (daily[field].shift(-1) - daily[field]).where(consecutive.shift(-1, fill_value=False))
+            spike = d_in.abs().gt(limit) & d_out.abs().gt(limit) & (numpy.sign(d_in) != numpy.sign(d_out))
+            rise = latest & d_in.gt(limit)
+            if(spike.any()):
+                flags.append(pandas.DataFrame({'Field': field, 'Check': 'Jump', 'Value': daily.loc[spike, field]}))
+            if(rise.any()):
+                flags.append(pandas.DataFrame({'Field': field, 'Check': 'Rise', 'Value': daily.loc[rise, field]}))
+
+        for field in stuck_fields:
+            if(field not in checked):
+                continue
+            # Runs of identical values on consecutive days, zero is a legitimate resting value. Only the days from the
+            # stuck_days-th day of a run on are flagged, the first days of a plateau are legitimate values.
+            new_run = ~(consecutive & daily[field].eq(daily[field].shift()))
+            run_day = daily.groupby(new_run.cumsum()).cumcount() + 1
+            stuck = (run_day >= stuck_days) & daily[field].ne(0) & daily[field].notna()
+            if(stuck.any()):
+                flags.append(pandas.DataFrame({'Field': field, 'Check': 'Stuck', 'Value': daily.loc[stuck, field]}))
+
+    if(len(flags) == 0):
+        return pandas.DataFrame(columns=['Record', id_col, dt_col, 'Field', 'Check', 'Value'])
+    flags = pandas.concat(flags)
+    flags.insert(0, dt_col, long_df.loc[flags.index, dt_col].values)
+    flags.insert(0, id_col, long_df.loc[flags.index, id_col].values)
+    flags = flags.rename_axis('Record').reset_index()
+    return flags
+
+
+def drop_flagged(long_df, flags):
+    '''Set flagged values to NaN, leaving the rest of each record intact. Report-only checks are not dropped.'''
+    long_df = long_df.copy()
+    flags = flags.loc[~flags['Check'].isin(qc_report_only_checks),]
+    for field, recs in flags.groupby('Field')['Record']:
+        long_df.loc[numpy.unique(recs.values), field] = numpy.nan
+    return long_df
@@ -0,0 +1,179 @@
+'''
+Adaptive rate control for the WIMS requests of a run, shared by all download threads.
+
+The number of requests in flight is adjusted AIMD-style: it grows by one after a run of fast, successful requests and
+is halved after a failure or a slow response. After a number of consecutive failures the circuit breaker opens and all
+requests wait out a cool-down instead of each retrying on its own; one probe request is then let through, and the
+breaker closes again if it succeeds. If the breaker trips too many times the service is treated as down and the
+remaining requests fail right away.
+
+Only errors that say the service is struggling (as decided by the transient function, e.g. timeouts, connection errors
+and HTTP 429 or 5xx answers) count as failures and are retried. Any other error is an answer from a working service: it
+is raised right away and does not change the limit or the breaker.
+
+    controller = RateController(max_concurrency=4, transient=wims_transient_error)
+    xml_bytes = controller.call(fetch_wims, url)
+    controller.stats()
+'''
+
+# Import libraries and modules
+import random, threading, time
+
+
+class CircuitOpen(Exception):
+    '''Raised for requests made after the circuit breaker gave up on the service.'''
+
+
+class RateController:
+    '''AIMD concurrency limit and circuit breaker for requests to one service.'''
+
+    def __init__(self, min_concurrency=1, max_concurrency=4, start_concurrency=2, latency_target=10.0, increase_after=5,
+                 breaker_failures=10, breaker_cooldown=60.0, breaker_max_trips=3, transient=None, sleep=time.sleep):
+        '''
+        min_concurrency, max_concurrency, start_concurrency: bounds and start of the number of requests in flight.
+        latency_target: seconds, slower responses count as congestion and lower the limit.
+        increase_after: number of fast successful requests before the limit is raised by one.
+        breaker_failures: consecutive failures that open the circuit breaker.
+        breaker_cooldown: seconds the breaker stays open before a probe, doubled each time it trips.
+        breaker_max_trips: trips after which the remaining requests fail right away.
+        transient: function of an error, True if it counts as a failure of the service and is retried. None counts every
+        error.
+        '''
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.increase_after = increase_after
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_max_trips = breaker_max_trips
+        self.transient = transient
+        self.sleep = sleep
+
+        self._cond = threading.Condition()
+        self.limit = float(max(min_concurrency, min(start_concurrency, max_concurrency)))
+        self.in_flight = 0
+        self.state = 'closed' # 'closed', 'open', 'half-open' or 'failed'
+        self._open_until = 0.0
+        self._probe_out = False
+        self._successes = 0
+        self._consecutive_failures = 0
+
+        # Run metrics
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.trips = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.limit_min = self.limit
+        self.limit_max = self.limit
+        self.wait_total = 0.0
+
+    def _acquire(self):
+        '''Wait for a free slot, the breaker cool-down or the probe slot. Returns True if this request is the probe.'''
+        t_wait = time.monotonic()
+        with self._cond:
+            while(True):
+                if(self.state == 'failed'):
+                    self.rejected = self.rejected + 1
+                    raise CircuitOpen('WIMS CIRCUIT BREAKER OPEN AFTER ' + str(self.trips) + ' TRIPS')
+                if(self.state == 'open'):
+                    remaining = self._open_until - time.monotonic()
+                    if(remaining > 0):
+                        self._cond.wait(min(remaining, 1.0))
+                        continue
+                    self.state = 'half-open'
+                if(self.state == 'half-open'):
+                    if(self._probe_out == False and self.in_flight == 0):
+                        self._probe_out = True
+                        self.in_flight = self.in_flight + 1
+                        self.wait_total = self.wait_total + time.monotonic() - t_wait
+                        return True
+                    self._cond.wait(1.0)
+                    continue
+                if(self.in_flight < int(self.limit)):
+                    self.in_flight = self.in_flight + 1
+                    self.wait_total = self.wait_total + time.monotonic() - t_wait
+                    return False
+                self._cond.wait(1.0)
+
+    def _release(self, ok, latency, probe):
+        '''Record the outcome of a request and adjust the limit and the breaker.'''
+        with self._cond:
+            self.in_flight = self.in_flight - 1
+            self.requests = self.requests + 1
+            self.latency_total = self.latency_total + latency
+            self.latency_max = max(self.latency_max, latency)
+            if(probe == True):
+                self._probe_out = False
+            if(ok == True):
+                self._consecutive_failures = 0
+                if(probe == True):
+                    self.state = 'closed'
+                    self.limit = float(self.min_concurrency)
+                if(latency > self.latency_target):
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    self._successes = 0
+                else:
+                    self._successes = self._successes + 1
+                    if(self._successes >= self.increase_after):
+                        self.limit = min(float(self.max_concurrency), self.limit + 1)
+                        self._successes = 0
+            else:
+                self.failures = self.failures + 1
+                self._consecutive_failures = self._consecutive_failures + 1
+                self._successes = 0
+                self.limit = max(float(self.min_concurrency), self.limit / 2)
+                if(probe == True or (self.state == 'closed' and self._consecutive_failures >= self.breaker_failures)):
+                    self.trips = self.trips + 1
+                    if(self.trips >= self.breaker_max_trips):
+                        self.state = 'failed'
+                    else:
+                        self.state = 'open'
+                        self._open_until = time.monotonic() + self.breaker_cooldown * 2 ** (self.trips - 1)
+            self.limit_min = min(self.limit_min, self.limit)
+            self.limit_max = max(self.limit_max, self.limit)
+            self._cond.notify_all()
+
+    def is_transient(self, e):
+        '''True if the error counts as a failure of the service.'''
+        return self.transient is None or self.transient(e) == True
+
+    def call(self, func, *args, **kwargs):
+        '''Run one request through the controller, raising its error or CircuitOpen.'''
+        probe = self._acquire()
+        t_start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._release(not self.is_transient(e), time.monotonic() - t_start, probe)
+            raise
+        self._release(True, time.monotonic() - t_start, probe)
+        return result
+
+    def call_with_retries(self, func, *args, retries=5, backoff=2.0, backoff_max=30.0, on_retry=None, **kwargs):
+        '''
+        Run a request with up to retries more attempts, waiting an exponential backoff with jitter between them.
+        Requests rejected by the breaker and errors that are not transient are not retried.
+        '''
+        attempt = 0
+        while(True):
+            try:
+                return self.call(func, *args, **kwargs)
+            except CircuitOpen:
+                raise
+            except Exception as e:
+                if(attempt >= retries or not self.is_transient(e)):
+                    raise
+                attempt = attempt + 1
+                if(on_retry is not None):
+                    on_retry(attempt, e)
+                self.sleep(min(backoff_max, backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0))
+
+    def stats(self):
+        '''State of the controller for the run metrics.'''
+        with self._cond:
+            return {'state': self.state, 'limit': int(self.limit), 'limit_min': int(self.limit_min), 'limit_max': int(self.limit_max),
+                    'requests': self.requests, 'failures': self.failures, 'rejected': self.rejected, 'breaker_trips': self.trips,
+                    'latency_mean_s': round(self.latency_total / self.requests, 3) if self.requests > 0 else None,
+                    'latency_max_s': round(self.latency_max, 3), 'wait_s': round(self.wait_total, 3)}
@@ -0,0 +1,212 @@
+'''
+Synthetic scalability harness for the NFDRS percentile and trend analysis.
+
+Generates synthetic AllStation/Percentiles tables, RAWS/PSA update tables and WIMS xml payloads for a range of station
+counts, then runs the compute stages of NFDRS_percentile_trend_analysis_v5 without any network or ArcGIS Online access.
+The time and peak memory of each stage are appended to a CSV so that superlinear stages can be caught and tracked from
+one version of the code to the next.
+
+    python NFDRS_scalability_harness.py --sizes 1000 2000 5000 --out scalability_results.csv
+'''
+
+# Import libraries and modules
+import argparse, contextlib, datetime, os, time, tracemalloc, numpy, pandas
+import NFDRS_percentile_trend_analysis_v5 as nfdrs
+
+# Fixed run date so payloads and results are repeatable
+harness_run_date = '2024-07-22 14:00:00'
+
+# Dynamic RAWS layer fields filled in by the station stage
+harness_raws_fields = ['nfdr_dt','nfdr_tm','nfdr_datetime','obs_datetime','ec','bi','sl','dry_temp','rh','wind_sp',
+                       'ec_percentile','ec_trend','ec_fcast','ec_fcast_percentile','ec_fcast_trend','bi_percentile',
+                       'bi_trend','bi_fcast','bi_fcast_percentile','bi_fcast_trend','NFDRS_Data_URL','Obs_Data_URL']
+
+# PSA layer fields filled in by the PSA stage
+harness_psa_fields = ['avg_ec_percentile','avg_ec_trend','avg_ec_fcast_percentile','avg_ec_fcast_trend',
+                      'avg_bi_percentile','avg_bi_trend','avg_bi_fcast_percentile','avg_bi_fcast_trend','nfdr_dt']
+
+
+def make_tables(n_stations, stations_per_psa=6, n_gaccs=10, n_breakpoints=100, seed=0):
+    '''
+    Synthetic AllStation and Percentiles tables plus the RAWS and PSA update tables that would come from the service.
+    Returns allstations, percentiles, raws_update_sdf, psa_update_sdf.
+    '''
+    rng = numpy.random.default_rng(seed)
+    stations = numpy.char.zfill((100000 + numpy.arange(n_stations)).astype(str), 6)
+    n_psas = max(1, n_stations // stations_per_psa)
+    psa_idx = rng.integers(0, n_psas, n_stations)
+    psas = numpy.char.add('PSA', numpy.char.zfill(psa_idx.astype(str), 5))
+    gacc_of_psa = numpy.char.add('GACC', rng.integers(0, n_gaccs, n_psas).astype(str))
+    gaccs = gacc_of_psa[psa_idx]
+
+    allstations = pandas.DataFrame({'StationID': stations, 'StationName': numpy.char.add('Station ', stations),
+                                    'PSA': psas, 'GACC': gaccs})
+
+    # Evenly spaced breakpoints per station, scaled so stations differ
+    pct = numpy.arange(1, n_breakpoints + 1)
+    frames = []
+    for comp, top in [('ERC', 100.0), ('BI', 200.0)]:
+        scale = rng.uniform(0.6, 1.4, n_stations)[:,None]
+        lb = (pct - 1)[None,:] / n_breakpoints * top * scale
+        ub = pct[None,:] / n_breakpoints * top * scale
+        frames.append(pandas.DataFrame({'StationID': numpy.repeat(stations, n_breakpoints), 'Component': comp,
+                                        'GreaterThanEqualTo': lb.ravel().round(1), 'LessThan': ub.ravel().round(1),
+                                        'Percentile': numpy.tile(pct, n_stations)}))
+    percentiles = pandas.concat(frames, ignore_index=True)
+
+    raws_update_sdf = pandas.DataFrame({'OBJECTID': numpy.arange(1, n_stations + 1), 'StationName': allstations['StationName'],
+                                        'NWSID_Clean': stations, 'StnName_Clean': allstations['StationName'],
+                                        'Latitude': rng.uniform(31, 49, n_stations), 'Longitude': rng.uniform(-124, -100, n_stations),
+                                        'GACC': gaccs, 'PSA': psas, 'FuelModelCode': 'Y'})
+    for field in harness_raws_fields:
+        raws_update_sdf[field] = None
+
+    psa_codes = sorted(set(psas.tolist()))
+    psa_update_sdf = pandas.DataFrame({'OBJECTID': numpy.arange(1, len(psa_codes) + 1), 'PSANationalCode': psa_codes,
+                                       'GACC': [gacc_of_psa[int(c[3:])] for c in psa_codes]})
+    for field in harness_psa_fields:
+        psa_update_sdf[field] = None
+
+    return allstations, percentiles, raws_update_sdf, psa_update_sdf
+
+
+def _rows_xml(rows):
+    '''Format a list of record dicts the way WIMS returns them.'''
+    out = ['<ROWSET>']
+    for row in rows:
+        out.append('<ROW>' + ''.join('<' + k + '>' + str(v) + '</' + k + '>' for k, v in row.items()) + '</ROW>')
+    out.append('</ROWSET>')
+    return ''.join(out).encode('utf-8')
+
+
+def make_wims_payloads(raws_update_sdf, seed=0):
+    '''
+    Synthetic NFDRS, NFDRS forecast and observation xml payloads for each station, covering the same date windows as
+    the real WIMS requests. Records are newest first, as WIMS returns them.
+    '''
+    rng = numpy.random.default_rng(seed)
+    obs_days = (nfdrs.datetime_today - nfdrs.datetime_nfdrs_start).days
+    fcast_days = (nfdrs.datetime_for_end - nfdrs.datetime_today).days
+    payloads = {}
+    for stn in raws_update_sdf['NWSID_Clean']:
+        erc0 = rng.uniform(10, 80)
+        bi0 = rng.uniform(10, 120)
+        nfdrs_rows = []
+        for d in range(obs_days, -1, -1):
+            day = nfdrs.datetime_today - datetime.timedelta(days=d)
+            nfdrs_rows.insert(0, {'sta_id': stn, 'nfdr_dt': day.strftime('%m/%d/%Y'), 'nfdr_tm': '13', 'nfdr_type': 'O',
+                                  'mp': '1', 'msgc': '16Y', 'ec': max(0, int(erc0 + rng.normal(0, 3))),
+                                  'bi': max(0, int(bi0 + rng.normal(0, 8))), 'sl': '3H'})
+        fcast_rows = []
+        for d in range(fcast_days, -1, -1):
+            day = nfdrs.datetime_today + datetime.timedelta(days=d)
+            for mp in ['1', '2']:
+                fcast_rows.append({'sta_id': stn, 'nfdr_dt': day.strftime('%m/%d/%Y'), 'nfdr_tm': '13', 'nfdr_type': 'F',
+                                   'mp': mp, 'msgc': '16Y', 'ec': max(0, int(erc0 + rng.normal(0, 4))),
+                                   'bi': max(0, int(bi0 + rng.normal(0, 10))), 'sl': '3H'})
+        obs_rows = [{'sta_id': stn, 'obs_dt': nfdrs.datetime_today.strftime('%m/%d/%Y'), 'obs_tm': '13',
+                     'dry_temp': int(rng.uniform(40, 105)), 'rh': int(rng.uniform(5, 80)), 'wind_sp': int(rng.uniform(0, 25))}]
+        payloads[stn] = {'nfdrs': _rows_xml(nfdrs_rows), 'fcast': _rows_xml(fcast_rows), 'obs': _rows_xml(obs_rows)}
+    return payloads
+
+
+def _measure(stage, n_stations, fn, memory):
+    '''Run one stage and return its result with a timing/memory record.'''
+    if(memory == True):
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - t0
+    peak_mb = numpy.nan
+    if(memory == True):
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return result, {'n_stations': n_stations, 'stage': stage, 'seconds': seconds, 'peak_mb': peak_mb}
+
+
+def run_stages(n_stations, memory=True, grid=False, seed=0):
+    '''Run the compute stages on synthetic data for one station count and return one record per stage.'''
+    nfdrs.set_run_date(harness_run_date)
+    allstations, percentiles, raws_update_sdf, psa_update_sdf = make_tables(n_stations, seed=seed)
+    raws_update_sdf, psa_update_sdf = nfdrs.compact_types(raws_update_sdf, psa_update_sdf)
+    payloads = make_wims_payloads(raws_update_sdf, seed=seed)
+    records = []
+
+    def tables_stage():
+        lookup = nfdrs.NFDRS_percentile_lookup.PercentileLookup(percentiles)
+        return lookup, nfdrs.create_raws2psa_table(allstations)
+
+    def parse_stage():
+        wims_urls, wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs = {}, {}, {}, {}
+        for stn, fuel_model in zip(raws_update_sdf['NWSID_Clean'], raws_update_sdf['FuelModelCode']):
+            wims_urls[stn] = nfdrs.build_wims_urls(stn, fuel_model)
+            wims_nfdrs_dfs[stn] = nfdrs.parse_wims_xml(payloads[stn]['nfdrs'])
+            wims_fcast_dfs[stn] = nfdrs.parse_wims_xml(payloads[stn]['fcast'])
+            wims_obs_dfs[stn] = nfdrs.parse_wims_xml(payloads[stn]['obs'])
+        return wims_urls, wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs
+
+    # The stages print their progress, keep the console quiet while timing them
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        (lookup, raws2psa_df), rec = _measure('tables', n_stations, tables_stage, memory)
+        records.append(rec)
+        (wims_urls, wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs), rec = _measure('parse', n_stations, parse_stage, memory)
+        records.append(rec)
+        if(nfdrs.toggle_qc == True):
+            _, rec = _measure('qc', n_stations, lambda: nfdrs.qc_wims(wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs), memory)
+            records.append(rec)
+        _, rec = _measure('stations', n_stations, lambda: nfdrs.process_stations(raws_update_sdf, raws2psa_df, lookup, wims_urls,
+                                                                                 wims_nfdrs_dfs, wims_fcast_dfs, wims_obs_dfs), memory)
+        records.append(rec)
+        _, rec = _measure('psas', n_stations, lambda: nfdrs.process_psas(allstations, raws2psa_df, psa_update_sdf), memory)
+        records.append(rec)
+        if(grid == True):
+            _, rec = _measure('grid', n_stations, lambda: nfdrs.build_grid(raws_update_sdf, raws2psa_df, None), memory)
+            records.append(rec)
+
+    return records
+
+
+def scaling_exponents(results):
+    '''
+    Log-log slope of time against station count for each stage. About 1 is linear, clearly above 1 is superlinear.
+    '''
+    out = {}
+    for stage, grp in results.groupby('stage'):
+        grp = grp[grp['seconds'] > 0]
+        if(grp['n_stations'].nunique() < 2):
+            continue
+        out[stage] = numpy.polyfit(numpy.log(grp['n_stations']), numpy.log(grp['seconds']), 1)[0]
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory curve of the NFDRS compute stages on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000], help='Station counts to run')
+    parser.add_argument('--out', default='scalability_results.csv', help='CSV to append the results to')
+    parser.add_argument('--no-memory', action='store_true', help='Skip tracemalloc (it slows pandas down)')
+    parser.add_argument('--grid', action='store_true', help='Include the gridded surface stage (without PSA clipping)')
+    parser.add_argument('--superlinear', type=float, default=1.2, help='Scaling exponent reported as superlinear')
+    args = parser.parse_args()
+
+    # QC flags and grids are written next to the results instead of the production working directory
+    nfdrs.wdir = os.path.dirname(os.path.abspath(args.out))
+    nfdrs.toggle_checkpoint = False # Time the compute stages only
+    if(args.grid == True):
+        nfdrs.grid_clip_to_psa = False
+
+    run_timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    all_records = []
+    for n in args.sizes:
+        records = run_stages(n, memory=not args.no_memory, grid=args.grid)
+        for rec in records:
+            print(str(rec['n_stations']).rjust(7) + '  ' + rec['stage'].ljust(10) + ('%10.2f s' % rec['seconds']) +
+                  ('%10.1f MB' % rec['peak_mb']))
+        all_records.extend(records)
+
+    results = pandas.DataFrame(all_records)
+    results.insert(0, 'run_timestamp', run_timestamp)
+    results.to_csv(args.out, mode='a', index=False, header=not os.path.exists(args.out))
+
+    print('')
+    for stage, slope in scaling_exponents(results).items():
+        print(stage.ljust(10) + ' scaling exponent ' + ('%.2f' % slope) + ('  SUPERLINEAR' if slope > args.superlinear else ''))
@@ -0,0 +1,159 @@
+'''
+Long-running scheduler for the NFDRS percentile and trend analysis.
+
+Keeps the ArcGIS Online session, the RAWS/PSA layer handles and queried features, the loaded percentile tables and a
+pooled HTTP session warm between runs, and fires the daily 16:30 Pacific update plus optional forecast refreshes.
+Forecast refreshes on a day that already has a daily run only re-download the WIMS forecasts, reusing that day's
+observed NFDRS and weather data. Refreshes before the daily run of their day (or before the first daily run after a
+restart) are skipped, so the published observed percentiles and trends are kept until the daily run replaces them.
+
+    python NFDRS_scheduler.py
+    python NFDRS_scheduler.py --fcast-times 18:00 21:00
+    python NFDRS_scheduler.py --run-now
+'''
+
+# Import libraries and modules
+import argparse, datetime, os, time, requests
+from zoneinfo import ZoneInfo
+from requests.adapters import HTTPAdapter
+import NFDRS_percentile_trend_analysis_v5 as nfdrs
+
+# Daily run time and optional forecast refresh times (HH:MM in sched_timezone)
+sched_daily_time = '16:30'
+sched_fcast_times = []
+sched_timezone = 'America/Los_Angeles'
+
+# Reconnect to ArcGIS Online and re-query the layers after this many hours
+sched_reconnect_hours = 12
+
+# Number of pooled WIMS connections
+sched_http_pool = 8
+
+
+class WarmState:
+    '''Session, layers, tables and data kept between runs.'''
+
+    def __init__(self):
+        self.gis = None
+        self.raws_layer = None
+        self.psa_layer = None
+        self.connected_at = None
+        self.raws_sdf = None
+        self.psa_sdf = None
+        self.allstations = None
+        self.percentile_lookup = None
+        self.tables_mtime = None
+        self.wims_cache = {} # Observed WIMS data of the last full run, see nfdrs.run_pipeline()
+
+        # Pooled, keep-alive HTTP connections for the WIMS requests
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=sched_http_pool, pool_maxsize=sched_http_pool))
+        nfdrs.http_session = session
+
+    def load_tables(self):
+        '''Load the AllStation and Percentiles tables, again only if either file has changed.'''
+        mtime = (os.path.getmtime(nfdrs.allstations_csv), os.path.getmtime(nfdrs.percentiles_csv))
+        if(self.tables_mtime != mtime):
+            nfdrs.print_both('.LOADING PERCENTILE TABLES\r')
+            self.allstations, percentiles, self.percentile_lookup = nfdrs.load_tables()
+            self.tables_mtime = mtime
+            self.raws_sdf = None # Analysis stations may have changed
+
+    def connect(self, force=False):
+        '''Connect to the service and query the layers, reusing the connection until it is sched_reconnect_hours old.'''
+        stale = (self.connected_at is None or
+                 datetime.datetime.now() - self.connected_at > datetime.timedelta(hours=sched_reconnect_hours))
+        if(force == True or stale == True):
+            self.gis, self.raws_layer, self.psa_layer = nfdrs.connect_service()
+            self.connected_at = datetime.datetime.now()
+            self.raws_sdf = None
+        if(self.raws_sdf is None):
+            self.raws_sdf, self.psa_sdf = nfdrs.query_layers(self.allstations, self.raws_layer, self.psa_layer)
+        else:
+            nfdrs.print_both('.USING WARM SESSION AND LAYERS\r')
+
+
+def run_update(state, run_time, fcast_only=False):
+    '''
+    Run one update of the service with the warm state. With fcast_only, the observed NFDRS and weather data of an
+    earlier run on the same day are reused and only the forecasts are downloaded; without a daily run on the same day
+    the refresh is skipped.
+    '''
+    nfdrs.set_run_date(run_time.strftime('%Y-%m-%d %H:%M:%S'))
+    nfdrs.open_log('' if fcast_only == False else '_fcast_' + run_time.strftime('%H%M'))
+    try:
+        nfdrs.print_both('\r')
+        nfdrs.print_both('SCHEDULED ' + ('FORECAST REFRESH' if fcast_only == True else 'DAILY RUN') + '\r')
+        if(fcast_only == True and state.wims_cache.get('day') != run_time.date()):
+            nfdrs.print_both('.NO DAILY RUN YET ON ' + str(run_time.date()) + ', FORECAST REFRESH SKIPPED\r', level='WARNING')
+            return
+        with nfdrs.profile_stage('load_tables'):
+            state.load_tables()
+        with nfdrs.profile_stage('query_layers'):
+            try:
+                state.connect()
+            except Exception as e:
+                nfdrs.print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+                nfdrs.print_both('.RECONNECTING\r')
+                state.connect(force=True)
+
+        # Fresh copies so the warm features are not changed by the run, then the same stages as a single run
+        raws2psa_df = nfdrs.create_raws2psa_table(state.allstations)
+        psa_aggregated_sdf = nfdrs.run_pipeline(state.allstations, state.percentile_lookup, state.raws_layer, state.psa_layer,
+                                                state.raws_sdf.copy(), state.psa_sdf.copy(), raws2psa_df, fcast_only=fcast_only,
+                                                wims_cache=state.wims_cache)
+
+        # Keep the aggregated PSAs so PSAs left clean by the next refresh still carry the values in the service
+        if(psa_aggregated_sdf is not None):
+            state.psa_sdf = psa_aggregated_sdf
+
+        nfdrs.print_both('\r')
+        nfdrs.print_both('DONE!\r')
+        nfdrs.print_both('\r')
+    except Exception as e:
+        nfdrs.print_both('.ERROR: ' + str(e) + '\r', level='ERROR')
+        nfdrs.print_both('.RUN FAILED, WAITING FOR THE NEXT SCHEDULED RUN\r', level='ERROR')
+    finally:
+        nfdrs.close_log()
+
+
+def next_run(now, daily_time, fcast_times):
+    '''Next scheduled (time, fcast_only) after now.'''
+    runs = [(daily_time, False)] + [(t, True) for t in fcast_times if t != daily_time]
+    upcoming = []
+    for hhmm, fcast_only in runs:
+        hh, mm = [int(x) for x in hhmm.split(':')]
+        t = now.replace(hour=hh, minute=mm, second=0, microsecond=0)
+        if(t <= now):
+            t = t + datetime.timedelta(days=1)
+        upcoming.append((t, fcast_only))
+    return min(upcoming)
+
+
+def serve(daily_time=sched_daily_time, fcast_times=sched_fcast_times, run_now=False):
+    '''Run updates on schedule until interrupted.'''
+    tz = ZoneInfo(sched_timezone)
+    state = WarmState()
+    if(run_now == True):
+        run_update(state, datetime.datetime.now(tz).replace(tzinfo=None))
+    while(True):
+        run_time, fcast_only = next_run(datetime.datetime.now(tz), daily_time, fcast_times)
+        print('NEXT RUN: ' + run_time.strftime('%Y-%m-%d %H:%M %Z') + (' (FORECAST REFRESH)' if fcast_only else ''))
+        # Sleep in short steps so clock changes and suspends do not delay the run
+        while(datetime.datetime.now(tz) < run_time):
+            time.sleep(min(60, max(1, (run_time - datetime.datetime.now(tz)).total_seconds())))
+        run_update(state, run_time.replace(tzinfo=None), fcast_only=fcast_only)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep the NFDRS percentile and trend service updates warm and on schedule.')
+    parser.add_argument('--daily-time', default=sched_daily_time, help='Daily run time, HH:MM ' + sched_timezone)
+    parser.add_argument('--fcast-times', nargs='*', default=sched_fcast_times, help='Forecast refresh times, HH:MM')
+    parser.add_argument('--run-now', action='store_true', help='Run a full update immediately, then follow the schedule')
+    parser.add_argument('--profile', choices=['Deterministic','Sampling'], default=None,
+                        help='Profile each stage of every run, writing the results next to the log files')
+    args = parser.parse_args()
+    if(args.profile is not None):
+        nfdrs.toggle_profile = True
+        nfdrs.profile_mode = args.profile
+    serve(args.daily_time, args.fcast_times, args.run_now)
@@ -0,0 +1,92 @@
+'''
+Writes the final RAWS, PSA and RAWS-to-PSA tables of a run to local files so they can be used without querying the
+feature service: GeoParquet, GeoJSON, FlatGeobuf and GeoPackage (SQLite). The requested outputs are written
+concurrently, each to a temporary file that replaces the previous output only once it is complete.
+'''
+
+# Import libraries and modules
+import concurrent.futures, os, geopandas, pandas, pyogrio
+from shapely.geometry import shape
+
+# File extension of each output sink
+sink_extensions = {'GeoParquet': '.parquet', 'GeoJSON': '.geojson', 'FlatGeobuf': '.fgb', 'GeoPackage': '.gpkg'}
+
+
+def to_geodataframe(sdf, crs):
+    '''Convert a data frame with a SHAPE column of ArcGIS geometries to a GeoDataFrame.'''
+    geoms = [shape(g.__geo_interface__) if g is not None else None for g in sdf['SHAPE']]
+    df = pandas.DataFrame(sdf.drop(columns=['SHAPE'])).infer_objects()
+    return geopandas.GeoDataFrame(df, geometry=geoms, crs=crs)
+
+
+def _tmp_path(path):
+    '''Temporary file next to the output, so readers never see a partly written file.'''
+    return os.path.join(os.path.dirname(path), '.tmp_' + os.path.basename(path))
+
+
+def _write_parquet(df, path):
+    df.to_parquet(_tmp_path(path), compression='zstd', index=False)
+    os.replace(_tmp_path(path), path)
+
+
+def _write_ogr(gdf, path, driver):
+    # GeoJSON is always WGS84 (RFC 7946)
+    if(driver == 'GeoJSON' and gdf.crs is not None):
+        gdf = gdf.to_crs('EPSG:4326')
+    # The FlatGeobuf spatial index cannot hold features without geometry (e.g. stations with no location)
+    options = {}
+    if(driver == 'FlatGeobuf' and gdf.geometry.isna().any()):
+        options['SPATIAL_INDEX'] = 'NO'
+    if(os.path.exists(_tmp_path(path))):
+        os.remove(_tmp_path(path))
+    pyogrio.write_dataframe(gdf, _tmp_path(path), driver=driver, layer_options=options)
+    os.replace(_tmp_path(path), path)
+
+
+def _write_geopackage(layers, tables, path):
+    # One SQLite file, layers and tables are written one after the other
+    if(os.path.exists(_tmp_path(path))):
+        os.remove(_tmp_path(path))
+    for name, df in list(layers.items()) + list(tables.items()):
+        pyogrio.write_dataframe(df, _tmp_path(path), layer=name, driver='GPKG', append=os.path.exists(_tmp_path(path)))
+    os.replace(_tmp_path(path), path)
+
+
+def write_sinks(out_dir, layers, sinks, tables=None, prefix='NFDRS_', max_workers=4):
+    '''
+    Write the outputs of a run.
+
+    layers: dict of name -> GeoDataFrame, written to every sink.
+    tables: dict of name -> data frame without geometry, written to GeoParquet (as plain Parquet) and GeoPackage.
+    sinks: list of sink names from sink_extensions.
+    Returns a dict of output path -> None if written, or the error message.
+    '''
+    tables = {} if tables is None else tables
+    jobs = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for sink in sinks:
+            if(sink not in sink_extensions):
+                raise ValueError('Unknown output sink ' + str(sink) + ', expected one of ' + ', '.join(sink_extensions))
+            ext = sink_extensions[sink]
+            if(sink == 'GeoPackage'):
+                path = os.path.join(out_dir, prefix + 'outputs' + ext)
+                jobs[pool.submit(_write_geopackage, layers, tables, path)] = path
+                continue
+            for name, df in layers.items():
+                path = os.path.join(out_dir, prefix + name + ext)
+                if(sink == 'GeoParquet'):
+                    jobs[pool.submit(_write_parquet, df, path)] = path
+                else:
+                    jobs[pool.submit(_write_ogr, df, path, sink)] = path
+            if(sink == 'GeoParquet'):
+                for name, df in tables.items():
+                    path = os.path.join(out_dir, prefix + name + ext)
+                    jobs[pool.submit(_write_parquet, df, path)] = path
+
+        results = {}
+        for job in concurrent.futures.as_completed(jobs):
+            err = job.exception()
+            results[jobs[job]] = None if err is None else str(err)
+            if(err is not None and os.path.exists(_tmp_path(jobs[job]))):
+                os.remove(_tmp_path(jobs[job]))
+    return results
@@ -0,0 +1,169 @@
+'''
+Static files of the final RAWS and PSA values for dashboards, so viewers can be served from any static host or cache
+instead of querying the feature service:
+
+    <static_dir>/manifest.json                        current file of each artifact (the only file changed in place)
+    <static_dir>/psa/<PSA>.<hash>.geojson             one feature per PSA, simplified geometry in WGS84
+    <static_dir>/psa_all.<hash>.geojson               feature collection of all PSAs
+    <static_dir>/stations.<hash>.json                 station id -> values
+
+The hash is taken from the file's content, so a file name always refers to the same bytes and can be cached forever;
+clients read manifest.json (short cache lifetime) to find the current files. Builds are incremental: only the PSAs
+listed as changed are rendered again, simplified geometries are reused while the source geometry is unchanged, and a
+file whose content did not change keeps its name and is not written again. Files no longer referenced by the current
+or the previous manifest are deleted.
+
+    build_static(static_dir, psa_df, 'PSANationalCode', 'EPSG:3857', station_df, 'NWSID_Clean', psa_fields, station_fields)
+'''
+
+# Import libraries and modules
+import datetime, hashlib, json, math, os
+import numpy, pandas, shapely
+from pyproj import Transformer
+from shapely.geometry import mapping, shape
+from shapely.ops import transform
+
+
+def _tmp_path(path):
+    '''Temporary file next to the output, so readers never see a partly written file.'''
+    return os.path.join(os.path.dirname(path), '.tmp_' + os.path.basename(path))
+
+
+def _json_value(v):
+    '''JSON value of a data frame cell, missing values as null.'''
+    if(v is None or v is pandas.NA or v is pandas.NaT):
+        return None
+    if(isinstance(v, numpy.generic)):
+        v = v.item()
+    if(isinstance(v, float)):
+        return None if math.isnan(v) else v
+    if(isinstance(v, (int, bool, str))):
+        return v
+    if(isinstance(v, (datetime.datetime, datetime.date, pandas.Timestamp))):
+        return v.isoformat()
+    return str(v)
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def _hashed_name(stem, data, ext):
+    '''File name with the first 12 hex digits of the content's SHA-256.'''
+    return stem + '.' + hashlib.sha256(data).hexdigest()[:12] + ext
+
+def _write_once(static_dir, rel_path, data):
+    '''Write a content-addressed file unless it already exists. Returns True if written.'''
+    path = os.path.join(static_dir, rel_path)
+    if(os.path.exists(path)):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(_tmp_path(path), 'wb') as f:
+        f.write(data)
+    os.replace(_tmp_path(path), path)
+    return True
+
+
+def simplify_geometry(geom, to_wgs84, tolerance, precision=5):
+    '''
+    GeoJSON geometry of an ArcGIS or GeoJSON-like geometry, simplified with tolerance (in the source units, before
+    reprojection), reprojected with to_wgs84 and rounded to precision decimal degrees.
+    '''
+    src = shape(geom.__geo_interface__ if hasattr(geom, '__geo_interface__') else geom)
+    simple = src.simplify(tolerance, preserve_topology=True) if tolerance > 0 else src
+    if(simple.is_empty):
+        simple = src
+    wgs84 = transform(to_wgs84.transform, simple)
+    wgs84 = shapely.set_precision(wgs84, 10 ** -precision)
+    return mapping(wgs84) if not wgs84.is_empty else None
+
+
+def build_static(static_dir, psa_df, psa_key, psa_crs, station_df, station_key, psa_fields, station_fields, psas=None,
+                 tolerance=500, precision=5):
+    '''
+    Write the static files of a run and return the counts of PSAs rendered and files written.
+
+    psa_df: PSAs with a SHAPE column of geometries in psa_crs and the psa_fields attributes, keyed by psa_key.
+    station_df: stations with the station_fields attributes, keyed by station_key.
+    psas: PSAs whose values changed since the last build, None to render every PSA.
+    tolerance: geometry simplification tolerance in psa_crs units.
+    '''
+    os.makedirs(static_dir, exist_ok=True)
+    manifest_path = os.path.join(static_dir, 'manifest.json')
+    prev_manifest = {}
+    if(os.path.exists(manifest_path)):
+        with open(manifest_path, 'rb') as f:
+            prev_manifest = json.load(f)
+    prev_psa = prev_manifest.get('psa', {})
+
+    # Simplified geometries of earlier builds, keyed by PSA with the hash of the source geometry
+    cache_path = os.path.join(static_dir, '_geometry_cache.json')
+    geom_cache = {}
+    if(os.path.exists(cache_path)):
+        with open(cache_path, 'rb') as f:
+            geom_cache = json.load(f)
+    to_wgs84 = Transformer.from_crs(psa_crs, 'EPSG:4326', always_xy=True)
+
+    # One feature file per PSA, rendered again only if the PSA changed or has no current file
+    counts = {'psa_rendered': 0, 'files_written': 0}
+    psa_files = {}
+    psa_features = {}
+    psa_props = [c for c in psa_fields if c in psa_df.columns]
+    for row in psa_df[[psa_key, 'SHAPE'] + psa_props].itertuples(index=False, name=None):
+        psa_id = str(row[0])
+        prev_file = prev_psa.get(psa_id)
+        if(psas is not None and psa_id not in psas and prev_file is not None and os.path.exists(os.path.join(static_dir, prev_file))):
+            psa_files[psa_id] = prev_file
+            continue
+        geom = row[1]
+        geom_json = None
+        if(geom is not None):
+            src_hash = hashlib.sha256(shape(geom.__geo_interface__ if hasattr(geom, '__geo_interface__') else geom).wkb).hexdigest()
+            if(psa_id in geom_cache and geom_cache[psa_id][0] == src_hash):
+                geom_json = geom_cache[psa_id][1]
+            else:
+                geom_json = simplify_geometry(geom, to_wgs84, tolerance, precision)
+                geom_cache[psa_id] = [src_hash, geom_json]
+        feature = {'type': 'Feature', 'id': psa_id, 'geometry': geom_json,
+                   'properties': {c: _json_value(v) for c, v in zip(psa_props, row[2:])}}
+        data = _dumps(feature)
+        psa_files[psa_id] = 'psa/' + _hashed_name(psa_id, data, '.geojson')
+        psa_features[psa_id] = data
+        counts['psa_rendered'] = counts['psa_rendered'] + 1
+        counts['files_written'] = counts['files_written'] + int(_write_once(static_dir, psa_files[psa_id], data))
+
+    # Feature collection of all PSAs, from the feature files
+    features = []
+    for psa_id in sorted(psa_files):
+        if(psa_id not in psa_features):
+            with open(os.path.join(static_dir, psa_files[psa_id]), 'rb') as f:
+                psa_features[psa_id] = f.read()
+        features.append(psa_features[psa_id])
+    collection = b'{"type":"FeatureCollection","features":[' + b','.join(features) + b']}'
+    collection_file = _hashed_name('psa_all', collection, '.geojson')
+    counts['files_written'] = counts['files_written'] + int(_write_once(static_dir, collection_file, collection))
+
+    # Station index
+    station_props = [c for c in station_fields if c != station_key and c in station_df.columns]
+    stations = {}
+    for row in station_df[[station_key] + station_props].itertuples(index=False, name=None):
+        stations[str(row[0])] = {c: _json_value(v) for c, v in zip(station_props, row[1:])}
+    stations_data = _dumps(stations)
+    stations_file = _hashed_name('stations', stations_data, '.json')
+    counts['files_written'] = counts['files_written'] + int(_write_once(static_dir, stations_file, stations_data))
+
+    # Manifest and geometry cache, then remove files of older builds
+    manifest = {'generated': datetime.datetime.now().isoformat(timespec='seconds'), 'psa_all': collection_file,
+                'stations': stations_file, 'psa': psa_files}
+    for path, data in [(cache_path, _dumps({k: v for k, v in geom_cache.items() if k in psa_files})), (manifest_path, _dumps(manifest))]:
+        with open(_tmp_path(path), 'wb') as f:
+            f.write(data)
+        os.replace(_tmp_path(path), path)
+    keep = set([collection_file, stations_file] + list(psa_files.values()))
+    keep = keep | set([prev_manifest.get('psa_all'), prev_manifest.get('stations')] + list(prev_psa.values()))
+    for rel_dir in ['', 'psa']:
+        if(not os.path.isdir(os.path.join(static_dir, rel_dir))):
+            continue
+        for name in os.listdir(os.path.join(static_dir, rel_dir)):
+            rel_path = (rel_dir + '/' + name) if rel_dir != '' else name
+            if(name.endswith(('.geojson', '.json')) and name.count('.') >= 2 and rel_path not in keep):
+                os.remove(os.path.join(static_dir, rel_path))
+    return counts
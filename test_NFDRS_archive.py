@@ -0,0 +1,45 @@
+'''
+Regression tests for NFDRS_archive.py.
+
+    python -m pytest test_NFDRS_archive.py
+'''
+
+# Import libraries and modules
+import datetime, pytest
+pytest.importorskip('pyarrow')
+pytest.importorskip('arcgis')
+import pandas, pyarrow, pyarrow.parquet
+import NFDRS_archive
+import NFDRS_percentile_trend_analysis_v5 as nfdrs
+
+
+def make_tables(ec):
+    '''RAWS and PSA update tables as queried and filled by a run, in the compact working types.'''
+    raws = pandas.DataFrame({'OBJECTID': [1, 2], 'NWSID_Clean': ['051234', '051235'], 'nfdr_dt': ['07/01/2024'] * 2,
+                             'nfdr_tm': ['13', '13'], 'ec': pandas.Series(ec, dtype='object'),
+                             'ec_percentile': [55.0, None], 'ec_trend': ['Increase', None],
+                             'NFDRS_Data_URL': ['https://example', None]})
+    psa = pandas.DataFrame({'OBJECTID': [1], 'PSANationalCode': ['NW01'], 'GACC': ['NWCC'],
+                            'avg_ec_percentile': [55.33], 'avg_ec_trend': ['Increase']})
+    return nfdrs.compact_types(raws, psa)
+
+
+def test_archive_types_after_publish_types(tmp_path):
+    # Frames converted for the service (object columns with None) must still be archived as numbers
+    archive = NFDRS_archive.OutputArchive(str(tmp_path))
+    for day, ec in [(1, ['82', None]), (2, [None, None])]:
+        raws, psa = make_tables(ec)
+        archive.append(datetime.datetime(2024, 7, day, 16, 30), {'raws': nfdrs.publish_types(raws.copy()),
+                                                                 'psa': nfdrs.publish_types(psa.copy())})
+    raws_schema = pyarrow.parquet.read_schema(str(tmp_path / 'raws' / 'run_month=2024-07' / 'part.parquet'))
+    psa_schema = pyarrow.parquet.read_schema(str(tmp_path / 'psa' / 'run_month=2024-07' / 'part.parquet'))
+    for schema, field, arrow_type in [(raws_schema, 'OBJECTID', pyarrow.float64()), (raws_schema, 'ec', pyarrow.float64()),
+                                      (raws_schema, 'ec_percentile', pyarrow.float64()), (raws_schema, 'nfdr_tm', pyarrow.large_string()),
+                                      (raws_schema, 'ec_trend', pyarrow.large_string()), (raws_schema, 'NFDRS_Data_URL', pyarrow.large_string()),
+                                      (psa_schema, 'avg_ec_percentile', pyarrow.float64()), (psa_schema, 'avg_ec_trend', pyarrow.large_string())]:
+        assert schema.field(field).type == arrow_type, field
+
+    series = archive.series('psa', 'NW01', columns=['avg_ec_percentile'])
+    assert series['avg_ec_percentile'].tolist() == [55.33, 55.33]
+    series = archive.series('raws', '051234', columns=['ec', 'ec_percentile'])
+    assert series['ec'].tolist()[0] == 82.0 and pandas.isna(series['ec'].tolist()[1])
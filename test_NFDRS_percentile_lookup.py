@@ -0,0 +1,44 @@
+'''
+Regression tests for NFDRS_percentile_lookup.py.
+
+    python -m pytest test_NFDRS_percentile_lookup.py
+'''
+
+# Import libraries and modules
+import numpy, pandas
+from NFDRS_percentile_lookup import PercentileLookup
+
+
+def make_lookup():
+    '''Two stations with ten 10 point ERC breakpoints, plus a V fuel model table for the first station.'''
+    rows = []
+    for stn, fm, scale in [('051234', None, 1), ('051235', None, 2), ('051234', 'V', 2)]:
+        for p in range(10):
+            rows.append({'StationID': stn, 'Component': 'ERC', 'GreaterThanEqualTo': p * 10 * scale,
+                         'LessThan': (p + 1) * 10 * scale, 'Percentile': (p + 1) * 10, 'FuelModel': fm})
+    return PercentileLookup(pandas.DataFrame(rows))
+
+
+def test_lookup_default_index():
+    lookup = make_lookup()
+    out = lookup.lookup(['051234','051235','051234'], ['ERC','ERC','erc'], [15, 15, 250])
+    numpy.testing.assert_array_equal(out, [20, 10, 100])
+
+
+def test_lookup_non_default_index():
+    # Queries filtered out of a larger table keep their index, they must still be answered by position
+    lookup = make_lookup()
+    stations = pandas.Series(['051234','051235','051234'], index=[5, 7, 9])
+    components = pandas.Series(['ERC'] * 3, index=[2, 0, 1])
+    values = pandas.Series([15.0, 15.0, -1.0], index=[9, 5, 7])
+    numpy.testing.assert_array_equal(lookup.lookup(stations, components, values), [20, 10, 0])
+    fuel_models = pandas.Series(['V','Y','V'], index=[3, 1, 2])
+    numpy.testing.assert_array_equal(lookup.lookup(stations, components, values, fuel_models=fuel_models), [10, 10, 0])
+
+
+def test_percentile_single_query():
+    lookup = make_lookup()
+    assert lookup.percentile('051234', 'ERC', 15) == 20
+    assert lookup.percentile('051234', 'ERC', 15, 'V') == 10
+    assert lookup.percentile('999999', 'ERC', 15) is None
+    assert numpy.isnan(lookup.lookup(['051234'], ['ERC'], [numpy.nan])[0])
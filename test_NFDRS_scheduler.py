@@ -0,0 +1,54 @@
+'''
+Regression tests for NFDRS_scheduler.py. The service and WIMS stages are replaced by recorders, only the scheduling
+and the forecast refresh decisions are tested.
+
+    python -m pytest test_NFDRS_scheduler.py
+'''
+
+# Import libraries and modules
+import datetime, pytest
+pytest.importorskip('arcgis')
+import NFDRS_scheduler
+nfdrs = NFDRS_scheduler.nfdrs
+
+
+@pytest.fixture
+def state(monkeypatch):
+    '''Warm state whose pipeline records its calls, full runs fill wims_cache like nfdrs.run_pipeline() does.'''
+    calls = []
+
+    def run_pipeline(*args, fcast_only=False, wims_cache=None):
+        calls.append(fcast_only)
+        if(fcast_only == False):
+            wims_cache['day'] = nfdrs.datetime_today.date()
+        return None
+
+    monkeypatch.setattr(nfdrs, 'open_log', lambda suffix='': None)
+    monkeypatch.setattr(nfdrs, 'close_log', lambda: None)
+    monkeypatch.setattr(nfdrs, 'print_both', lambda ptext, *args, level=None, **fields: None)
+    monkeypatch.setattr(nfdrs, 'create_raws2psa_table', lambda allstations: None)
+    monkeypatch.setattr(nfdrs, 'run_pipeline', run_pipeline)
+    st = NFDRS_scheduler.WarmState()
+    st.load_tables = lambda: None
+    st.connect = lambda force=False: None
+    st.raws_sdf = st.psa_sdf = nfdrs.pandas.DataFrame()
+    st.calls = calls
+    return st
+
+
+def test_refresh_before_daily_run_is_skipped(state):
+    # 06:00 refresh of the README example fires before the 16:30 daily run, it must not publish anything
+    day = datetime.datetime(2026, 7, 1)
+    when, fcast_only = NFDRS_scheduler.next_run(day.replace(hour=5), '16:30', ['06:00', '18:00'])
+    assert (when.hour, when.minute, fcast_only) == (6, 0, True)
+    NFDRS_scheduler.run_update(state, when, fcast_only=True)
+    assert state.calls == []
+
+    # Daily run, then a refresh on the same day reuses its observed data
+    NFDRS_scheduler.run_update(state, day.replace(hour=16, minute=30))
+    NFDRS_scheduler.run_update(state, day.replace(hour=18), fcast_only=True)
+    assert state.calls == [False, True]
+
+    # Next morning the cached observed data is a day old, the refresh is skipped again
+    NFDRS_scheduler.run_update(state, day.replace(day=2, hour=6), fcast_only=True)
+    assert state.calls == [False, True]